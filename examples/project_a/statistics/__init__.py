@@ -2,7 +2,7 @@ import json
 import re
 import requests
 
-from nudgebot.statistics.base import statistic
+from nudgebot.statistics.base import statistic, cpu_bound_statistic
 from nudgebot.statistics.github import PullRequestStatistics, RepositoryStatistics, IssueStatistics
 from nudgebot.settings import CurrentProject
 from nudgebot.utils import Age
@@ -17,6 +17,7 @@ from nudgebot.utils import Age
 class MyPrStatistics(PullRequestStatistics):
     """In this statistics class we collect all the statistics that related to pull request."""
     key = 'my_pulls_statistics'  # This key will be used to access this statistics in the tasks
+    HISTORY = ['total_comments', 'reviewers', 'title_tags']  # Keep the history of these statistics
 
     # We decorate this getter with `statistic` decorator to indicate that this
     # is a statistic that we would like to collect and save
@@ -65,9 +66,13 @@ class MyPrStatistics(PullRequestStatistics):
     def total_comments(self):
         return self.scope.comments
 
-    @statistic
+    @cpu_bound_statistic
     def title_tags(self):
-        return re.findall('\[ *([\w\d_\-]+) *\]', self.title())
+        return self.title()
+
+    @title_tags.compute
+    def title_tags(title):  # noqa
+        return re.findall('\[ *([\w\d_\-]+) *\]', title)
 
     @title_tags.pretty
     def title_tags(title_tags):  # noqa
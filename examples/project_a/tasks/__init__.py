@@ -13,6 +13,7 @@ from nudgebot.thirdparty.irc.base import IRCendpoint
 from nudgebot.thirdparty.irc.bot import MessageMentionedMeEvent
 from nudgebot.thirdparty.irc.message import Message
 from nudgebot.settings import CurrentProject
+from nudgebot.statistics.aggregation import aggregate, Count, Sum, AgeBuckets, DAY, WEEK
 from nudgebot.config.user import User
 
 
@@ -87,6 +88,7 @@ class AlertOnMentionedUser(ConditionalTask):
     EndpointScope = PullRequest
     NAME = 'AlertOnMentionedUser'
     RUN_ONCE = False
+    RECORDS_RETENTION = 30 * 24 * 3600  # Keep the records of the last 30 days
 
     def get_artifacts(self):
         return [str(self.event.data['id'])]
@@ -125,6 +127,7 @@ class IRCAnswerQuestion(ConditionalTask):
     EndpointScope = Message       # The scope of this task is pull request.
     NAME = 'IRCAnswerQuestion'    # The name of the task.
     RUN_ONCE = False              # Indicate that the task will always run. not only in the first occurrence.
+    RECORDS_RETENTION = 24 * 3600  # Keep the records of the last day
 
     @property
     def condition(self):
@@ -135,20 +138,21 @@ class IRCAnswerQuestion(ConditionalTask):
         content, sender, channel = self.scope.content, self.scope.sender, self.scope.channel
 
         def answer(content):
-            return self.Endpoint.client.msg(channel.name, f'{sender}, {content}')
+            return self.Endpoint.client.msg(channel.name, f'{sender}, {content}', server=channel.server.url)
 
         if f'{me}, ping' == content:
             answer('pong')
         elif f'{me}, #pr' == content:
             answer(', '.join([
                 f'{repo.name}: {repo.number_of_open_issues}'
-                for repo in self.all_statistics.github_repository
+                for repo in self.all_statistics.github_repository.find(projection=['name', 'number_of_open_issues'])
             ]))
         else:
             answer(f'Unknown option "{content}"')
-            self.Endpoint.client.msg(channel.name, 'options:')
-            self.Endpoint.client.msg(channel.name, '    ping - Get pong back.')
-            self.Endpoint.client.msg(channel.name, '    #pr - Number of open pull requests per repository.')
+            self.Endpoint.client.msg(channel.name, 'options:', server=channel.server.url)
+            self.Endpoint.client.msg(channel.name, '    ping - Get pong back.', server=channel.server.url)
+            self.Endpoint.client.msg(channel.name, '    #pr - Number of open pull requests per repository.',
+                                     server=channel.server.url)
 
 
 class DailyReport(PeriodicTask):
@@ -163,23 +167,28 @@ class DailyReport(PeriodicTask):
         for pr_stats in self.all_statistics.github_pull_request:
             if pr_stats.repository not in data:
                 data[pr_stats.repository] = {}
-            data[pr_stats.repository][pr_stats.issue_number] = pr_stats
+            # The statistics documents are shared, so we copy before adding fields
+            data[pr_stats.repository][pr_stats.issue_number] = dict(pr_stats)
             data[pr_stats.repository][pr_stats.issue_number].update({
                 'comments': pr_stats.total_comments,
                 'commits': pr_stats.number_of_commits,
                 'reviewers': pr_stats.reviewers
             })
+        # A summary line per repository, aggregated over the shared statistics snapshot
+        summary = aggregate('github_pull_request', group_by=['repository'], snapshot=self.all_statistics,
+                            prs=Count(), comments=Sum('total_comments'), commits=Sum('number_of_commits'),
+                            age=AgeBuckets('last_update', [DAY, WEEK]))
         with open(os.path.join(os.path.dirname(__file__), 'daily_report.j2'), 'r') as t:
             template = Template(t.read())
-        return template.render(data=data)
+        return template.render(data=data, summary={row['repository']: row for row in summary})
 
     def run(self):
         maintainers_emails = set()
         for repo_data in CurrentProject().config.config.github.repositories:
             for maintainer in repo_data.maintainers:
-                for user_data in CurrentProject().config.users:
-                    if user_data.github_login == maintainer:
-                        maintainers_emails.add(user_data.email)
+                user = User.get_user(github_login=maintainer)
+                if user:
+                    maintainers_emails.add(user.email)
 
         send_email(CurrentProject().config.credentials.email.address, list(maintainers_emails),
                    'Daily report', self.get_report(), text_format='html')
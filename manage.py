@@ -1,6 +1,8 @@
 import os
+import sys
 import shutil
 import argparse
+import importlib
 from pydoc import ispath
 
 from nudgebot.config import Config
@@ -38,15 +40,72 @@ def startproject(name_or_path: str):
     print('Done')
 
 
+def load_project(path: str):
+    """
+    Loading the project in the given path, i.e. its assets which setup the current project.
+
+    @param path: `str` The path of the project directory.
+    """
+    sys.path.insert(0, os.path.abspath(path))
+    return importlib.import_module('assets')
+
+
+def get_database_client(project: str):
+    """
+    Loading the project and returning the database client to backup.
+
+    The data of the memory backend lives only in the process of the bot, so it can't be reached from here, it should
+    be dumped and restored from within the bot, i.e. `DatabaseBackup(MemoryBackend())`.
+
+    @param project: `str` The path of the project directory.
+    """
+    from nudgebot.settings import CurrentProject
+    assets = load_project(project)
+    backend = CurrentProject().config.get('config', 'database', 'backend', default='mongo')
+    if backend == 'memory':
+        sys.exit('The project uses the memory database backend, its data lives only in the process of the bot. '
+                 'Use DatabaseBackup(MemoryBackend()) from within the bot instead.')
+    return assets.db_client
+
+
+def dump(project: str, path: str, databases=None, fmt='json'):
+    """Dumping the databases of the project, see `nudgebot.db.backup`."""
+    from nudgebot.db.backup import DatabaseBackup
+    for name, count in DatabaseBackup(get_database_client(project)).dump(path, databases, fmt).items():
+        print(f'{name}: {count} documents')
+
+
+def restore(project: str, path: str, databases=None, drop=False, workers=4):
+    """Restoring the databases of the project from a dump, see `nudgebot.db.backup`."""
+    from nudgebot.db.backup import DatabaseBackup
+    for name, count in DatabaseBackup(get_database_client(project)).restore(path, databases, drop, workers).items():
+        print(f'{name}: {count} documents')
+
+
 argparser = argparse.ArgumentParser()
 subparsers = argparser.add_subparsers(help='Operations', dest='operation')
 startproject_parser = subparsers.add_parser('startproject', help='Creating a new project')
 startproject_parser.add_argument('name_or_path', help='The name or the path of the project')
+dump_parser = subparsers.add_parser('dump', help='Dumping the project databases')
+dump_parser.add_argument('path', help='The path of the dump directory')
+dump_parser.add_argument('--project', required=True, help='The path of the project')
+dump_parser.add_argument('--databases', nargs='*', help='The databases to dump, default is all of them')
+dump_parser.add_argument('--format', choices=['json', 'bson'], default='json', help='The format of the documents')
+restore_parser = subparsers.add_parser('restore', help='Restoring the project databases from a dump')
+restore_parser.add_argument('path', help='The path of the dump directory')
+restore_parser.add_argument('--project', required=True, help='The path of the project')
+restore_parser.add_argument('--databases', nargs='*', help='The databases to restore, default is all of them')
+restore_parser.add_argument('--drop', action='store_true', help='Dropping the collections before the restore')
+restore_parser.add_argument('--workers', type=int, default=4, help='The number of collections to restore in parallel')
 
 
 def parse_command(namespace):
     if namespace.operation == 'startproject':
         startproject(namespace.name_or_path)
+    elif namespace.operation == 'dump':
+        dump(namespace.project, namespace.path, namespace.databases, namespace.format)
+    elif namespace.operation == 'restore':
+        restore(namespace.project, namespace.path, namespace.databases, namespace.drop, namespace.workers)
 
 
 if __name__ == '__main__':
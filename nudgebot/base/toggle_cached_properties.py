@@ -26,17 +26,29 @@ class toggled_cached_property(object):
     def __init__(self, getter):
         self.__doc__ = getattr(getter, '__doc__')
         self.getter = getter
+        self.obj = None  # Set on the bound copies, see `bind`
 
     def uncache(self):
         """Un-cache the property"""
         if self.getter.__name__ in self.obj._toggled_cached_properties:
             del self.obj._toggled_cached_properties[self.getter.__name__]
 
+    def bind(self, obj):
+        """
+        Return a copy of the property that's bound to the object. The property itself is shared by all the instances
+        of the class (and the threads that access them), so it never holds the object.
+        """
+        bound = object.__new__(self.__class__)
+        bound.__dict__.update(self.__dict__)
+        bound.obj = obj
+        return bound
+
     def __get__(self, obj, cls):
-        self.obj = obj
-        if not hasattr(self.obj, '_toggled_cached_properties'):
-            self.obj._toggled_cached_properties = {}
-        return self
+        if obj is None:
+            return self
+        if not hasattr(obj, '_toggled_cached_properties'):
+            obj._toggled_cached_properties = {}
+        return self.bind(obj)
 
     def __call__(self):
         if self.getter.__name__ in self.obj._toggled_cached_properties:
@@ -4,15 +4,25 @@ The bot package.
 Include the Bot class and its functionality.
 
 """
+import signal
+import sys
 import time
+from threading import current_thread, main_thread
 
 from nudgebot.log import Loggable
+from nudgebot.db.backends import get_backend
+from nudgebot.db.db import CachedStack
+from nudgebot.db.indexes import IndexManager
+from nudgebot.statistics.process_pool import StatisticsProcessPool
+from nudgebot.tasks import ConditionalTask
+from nudgebot.tasks.executor import TaskExecutor
 from nudgebot.thirdparty.github.bot import GithubBot
 from nudgebot.thirdparty.irc.bot import IRCbot
 from nudgebot.exceptions import SubThreadException
 
 
 class Bot(Loggable):
+    STOP_TIMEOUT = 30  # Max number of seconds to wait for each slave to stop
 
     def __init__(self, statistics: list, tasks: list):
         """Instantiate.
@@ -31,16 +41,66 @@ class Bot(Loggable):
             slave = slave_cls(slave_stats, slave_tasks)
             self._slaves.append(slave)
 
+    def get_slave(self, endpoint_key: str):
+        """
+        Return the bot slave of the endpoint.
+
+        @param endpoint_key: `str` The key of the endpoint.
+        @rtype: `BotSlave`
+        """
+        return next(slave for slave in self._slaves if slave.Endpoint.key == endpoint_key)
+
     def mainloop(self):
         """
         Run the bot's mainloop.
         """
+        self.logger.info('Checking database health')
+        get_backend().health_check()
+        self.logger.info('Migrating legacy documents')
+        migrated = CachedStack.migrate_legacy_stacks()
+        if migrated:
+            self.logger.info(f'Migrated {migrated} cached stacks')
+        for task_cls in self._tasks:
+            if issubclass(task_cls, ConditionalTask):
+                migrated = task_cls.migrate_legacy_documents()
+                if migrated:
+                    self.logger.info(f'Migrated {migrated} documents of task {task_cls.NAME}')
+        self.logger.info('Ensuring database indexes')
+        IndexManager(self._statistics + self._tasks).ensure_indexes()
+        # Starting the statistics process pool ahead, rather than on the first submission
+        if any(statistics_cls.cpu_bound_statistics_names() for statistics_cls in self._statistics):
+            StatisticsProcessPool().start()
+        if current_thread() is main_thread():  # Stopping gracefully on SIGTERM as well, see `stop`
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         # Starting slaves
         for slave in self._slaves:
             slave.start()
         #
-        while True:
-            if not slave.isAlive():
-                self.logger.error('Bot slave died.')
-                raise SubThreadException(slave)
-            time.sleep(5)
+        try:
+            while True:
+                for slave in self._slaves:
+                    if not slave.is_alive():
+                        self.logger.error('Bot slave died.')
+                        raise SubThreadException(slave)
+                time.sleep(5)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop the slaves, then wait for the submitted task runs (including their retries) and stop the statistics
+        worker processes.
+        """
+        self.logger.info('Stopping the bot')
+        for slave in self._slaves:
+            slave.stop()
+        for slave in self._slaves:
+            if slave.is_alive() and slave is not current_thread():
+                slave.join(self.STOP_TIMEOUT)
+        self.shutdown_workers()
+
+    @staticmethod
+    def shutdown_workers():
+        """Wait for the submitted task runs and stop the statistics worker processes"""
+        TaskExecutor().shutdown()
+        StatisticsProcessPool().shutdown()
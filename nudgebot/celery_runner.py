@@ -1,6 +1,5 @@
 from celery import Celery
 from celery.schedules import crontab
-from celery.bin.purge import purge
 
 from nudgebot.settings import CurrentProject
 from nudgebot.base import Singleton, Thread
@@ -11,9 +10,23 @@ CELERY = Celery()
 
 @CELERY.task
 def run_periodic_task(task_class_name):
-    """Running a periodic task"""
-    task = next(task for task in CurrentProject().TASKS if task.__name__ == task_class_name)
-    task().handle()
+    """Running a periodic task, see `PeriodicTasksRegistry.dispatch`"""
+    from nudgebot.tasks.periodic import PeriodicTasksRegistry
+    PeriodicTasksRegistry().dispatch(task_class_name)
+
+
+@CELERY.task
+def handle_event(endpoint_key, message):
+    """
+    Handling an event that has been dispatched by a bot slave in distributed mode.
+
+    @param endpoint_key: `str` The key of the endpoint of the bot slave.
+    @param message: `dict` The event message, see `Event.to_message`.
+    """
+    from nudgebot.thirdparty.base import Event
+    from nudgebot.statistics.recollection import RecollectionScheduler
+    CurrentProject().bot.get_slave(endpoint_key).handle_event(Event.from_message(message))
+    RecollectionScheduler().flush()
 
 
 class CeleryRunner(Thread, metaclass=Singleton):
@@ -24,21 +37,49 @@ class CeleryRunner(Thread, metaclass=Singleton):
     """
 
     def setup_periodic_tasks(self, sender, **kwargs):
-        """Setup the periodic tasks"""
-        from nudgebot.tasks.base import PeriodicTask
-        for task_class in CurrentProject().TASKS:
-            if issubclass(task_class, PeriodicTask):
-                print(f'Adding periodic task to celery: {task_class}')
-                assert isinstance(task_class.CRONTAB, crontab), \
-                    ('CRONTAB static attribute should be deifned in periodic '
-                     f'task and must be an instance of {crontab}')
-                sender.add_periodic_task(
-                    task_class.CRONTAB,
-                    run_periodic_task.s(task_class.__name__)
-                )
+        """Setup the periodic tasks, and send the runs of the tasks that should catch up missed ticks"""
+        from nudgebot.tasks.periodic import PeriodicTasksRegistry
+        registry = PeriodicTasksRegistry()
+        for task_class in registry:
+            print(f'Adding periodic task to celery: {task_class}')
+            assert isinstance(task_class.CRONTAB, crontab), \
+                ('CRONTAB static attribute should be deifned in periodic '
+                 f'task and must be an instance of {crontab}')
+            sender.add_periodic_task(
+                task_class.CRONTAB,
+                run_periodic_task.s(task_class.__name__),
+                name=task_class.__name__
+            )
+        for task_class in registry.missed():
+            print(f'Catching up periodic task: {task_class}')
+            run_periodic_task.delay(task_class.__name__)
 
     def run(self):
-        """Running the celery app"""
-        purge(CELERY)
+        """
+        Running the celery app.
+        The queue is not purged, stale periodic tasks messages are skipped by their schedule state.
+        """
         CELERY.on_after_configure.connect(self.setup_periodic_tasks)
         CELERY.worker_main(['--loglevel=info', '--beat'])
+
+    @staticmethod
+    def scope_queues():
+        """Return the names of the queues of the events in distributed mode, see `BotSlave.event_queue`"""
+        queues = CurrentProject().config.get('config', 'distributed', 'queues', default=1)
+        return ['nudgebot.scopes.{}'.format(i) for i in range(queues)]
+
+    @staticmethod
+    def run_worker(queues):
+        """
+        Running a worker process that handles the events of the queues (distributed mode).
+
+        The events of the same scope are routed to the same queue, in order to keep their order each queue should be
+        consumed by a single worker, hence the worker handles one event at a time.
+            @param queues: (`list` of `str`) The queues to consume.
+        """
+        from nudgebot.bot import Bot
+        CELERY.conf.worker_prefetch_multiplier = 1
+        try:
+            CELERY.worker_main(['worker', '--loglevel=info', '--concurrency=1', '--queues={}'.format(','.join(queues))])
+        finally:
+            Bot.shutdown_workers()
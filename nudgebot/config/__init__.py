@@ -25,9 +25,11 @@ class Config(object):
         self.dirpath = dirpath
         self._data = AttributeDict()
         self._first_reload_done = False
+        self.revision = 0  # Bumped on each reload, the caches of the config data are rebuilt once it's changed
 
     def reload(self):
         self._first_reload_done = True
+        self.revision += 1
         for p in self.configfiles():
             conf_name = os.path.splitext(p)[0]
             fp = os.path.join(self.dirpath, p)
@@ -36,6 +38,18 @@ class Config(object):
             with open(fp, 'r') as confile:
                 self._data[conf_name] = AttributeDict.attributize_dict(yaml.load(confile))
 
+    def get(self, *path, default=None):
+        """
+        Return the value in the path, or the default if it's not defined.
+            e.g. config.get('config', 'tasks', 'executor', 'workers', default=4)
+        """
+        node = self._data
+        for key in path:
+            if not isinstance(node, dict) or key not in node:
+                return default
+            node = node[key]
+        return node
+
     def __getitem__(self, key):
         if not super(Config, self).__getattribute__('_first_reload_done'):
             super(Config, self).__getattribute__('reload')()
@@ -1,12 +1,93 @@
 from hashlib import md5
+from threading import RLock
 
 from cached_property import cached_property
 
+from nudgebot.base import Singleton
 from nudgebot.settings import CurrentProject
 from nudgebot.exceptions import CouldNotFindUserException
 from nudgebot.utils import flatten_dict
 
 
+class UserDirectory(object, metaclass=Singleton):
+    """
+    The directory of the users in the users configuration (users.yaml).
+
+    The users are built once, and indexed by the `INDEXED_FIELDS`. The directory is rebuilt whenever the
+    configuration is reloaded (see `Config.revision`).
+    Example:
+        UserDirectory().get_user(github_login='octocat')  --> <User key=octocat>
+    """
+    INDEXED_FIELDS = ('key', 'github_login', 'irc_nick', 'email')
+
+    def __init__(self):
+        self._lock = RLock()
+        self._config_revision = None
+        self._users = []
+        self._indexes = {}  # field --> value --> `list` of `User`
+        self.revision = 0  # Bumped on each rebuild
+
+    def _ensure_current(self):
+        config = CurrentProject().config
+        revision = (id(config), config.revision)
+        if revision != self._config_revision:
+            with self._lock:
+                if revision != self._config_revision:
+                    self.rebuild(config.get('users', 'users', default=None) or [])
+                    self._config_revision = revision
+
+    def rebuild(self, users_data: list):
+        """
+        Rebuild the users and the indexes.
+
+        @param users_data: (`list` of `AttributeDict`) The users configuration.
+        """
+        users = [User(User.key_of(data), data) for data in users_data]
+        indexes = {field: {} for field in self.INDEXED_FIELDS}
+        for user in users:
+            for field in self.INDEXED_FIELDS:
+                value = user.key if field == 'key' else user.config_data.get(field)
+                if value is not None:
+                    indexes[field].setdefault(value, []).append(user)
+        self._users, self._indexes = users, indexes
+        self.revision += 1
+
+    def get_revision(self):
+        """Return the revision of the directory, it's changed whenever the directory is rebuilt"""
+        self._ensure_current()
+        return self.revision
+
+    def all(self):
+        """
+        @rtype: `list` of `User`
+        """
+        self._ensure_current()
+        return list(self._users)
+
+    def keys(self):
+        """
+        @rtype: `list` of `str`
+        """
+        return [user.key for user in self.all()]
+
+    def get_user(self, **query):
+        """
+        Get the first user that matches the query, the query is looked up in the index of an indexed field
+        and only the users with the same value are matched against the rest of the query.
+
+        @param query: The query, keys and values.
+        @rtype: `User` or `None` if no user found.
+        """
+        self._ensure_current()
+        users, indexes = self._users, self._indexes
+        field = next((field for field in self.INDEXED_FIELDS if field in query), None)
+        if field is not None:
+            users = indexes[field].get(query[field], [])
+        for user in users:
+            if all((user.key if k == 'key' else user.config_data.get(k)) == v for k, v in query.items()):
+                return user
+
+
 class User(object):
     """
     Represents a user in the organization.
@@ -14,12 +95,20 @@ class User(object):
     The class contains all the user info and helper functions for users management.
     """
 
-    CONFIG_DATA = CurrentProject().config.users
-
-    def __init__(self, key: str):
+    def __init__(self, key: str, config_data=None):
+        """
+        @param key: `str` The key of the user.
+        @keyword config_data: `AttributeDict` The configuration data of the user, default is the data in the users
+                              configuration.
+        """
         assert isinstance(key, str)
         self._key = key
-        self.config_data  # Just to raise exception of no such key found
+        if config_data is None:
+            user = UserDirectory().get_user(key=key)
+            if user is None:
+                raise CouldNotFindUserException(key, UserDirectory().keys())
+            config_data = user.config_data
+        self._config_data = config_data
 
     def __repr__(self):
         f'<{self.__class__.__name__} key={self._key}>'
@@ -27,9 +116,14 @@ class User(object):
     def __hash__(self):
         return md5(','.join([f'{k}:{v}' for k, v in flatten_dict(self.config_data).items()]))
 
+    @staticmethod
+    def key_of(data):
+        """The key of the user data, the github login of a user without a key"""
+        return data.get('key') or data.get('github_login')
+
     @classmethod
     def _user_keys(cls):
-        return [u.key for u in cls.CONFIG_DATA]
+        return UserDirectory().keys()
 
     @classmethod
     def all(cls):
@@ -38,31 +132,34 @@ class User(object):
 
         @rtype: `list` of `User`.
         """
-        return [cls(key) for key in cls._user_keys()]
+        return UserDirectory().all()
 
     @classmethod
     def get_user(cls, **query):
         """
-        Get a user by specific query
+        Get a user by specific query, see `UserDirectory.get_user`.
 
         @param query: The query, keys and values.
         @rtype: `None` if user found, otherwise `User`.
         """
         assert isinstance(query, dict)
-        for user in cls.all():
-            if all(user.config_data.get(k) == v for k, v in query.items()):
-                return user
+        return UserDirectory().get_user(**query)
 
-    @cached_property
+    @property
     def config_data(self):
         """
         Return the configuration data of the user.
 
         @rtype: `AttributeDict`
         """
-        if self._key not in self._user_keys():
-            raise CouldNotFindUserException(self._key, self._user_keys())
-        return next(data for data in self.CONFIG_DATA if data.key == self._key)
+        return self._config_data
+
+    @property
+    def key(self):
+        """
+        @rtype: `str`
+        """
+        return self._key
 
     @cached_property
     def github(self):
@@ -72,7 +169,8 @@ class User(object):
         @rtype: `nudgebot.thirdparty.github.user.User`
         """
         from nudgebot.thirdparty.github.user import User
-        return User.instantiate(self.config_data.github_login)
+        from nudgebot.thirdparty.mentions import MentionResolver
+        return User(MentionResolver().get_github_user(self.config_data.github_login))
 
     @property
     def irc_nick(self):
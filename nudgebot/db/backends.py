@@ -0,0 +1,810 @@
+"""
+Storage backends.
+
+All the data collections are accessed through `get_collection`, which routes to the storage backend that's
+configured for the project:
+    * mongo: MongoDB through the `db_client` of the project (the default).
+    * memory: An in-process engine that implements the subset of the pymongo collection API that Nudgebot uses,
+              for tests, benchmarks and small single node deployments that don't need a MongoDB server.
+
+Configuration (config.yaml):
+    database:
+      backend: `str` 'mongo' or 'memory'.
+      mongo_client:
+        write_concerns: `dict` The write concern by database name, e.g. {statistics: {w: 1}, tasks: {w: majority}}.
+        read_preferences: `dict` The read preference by usage, e.g. {dashboard: secondaryPreferred}.
+"""
+import copy
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import RLock
+from types import SimpleNamespace
+
+from bson import ObjectId
+from pymongo import InsertOne, ReadPreference, ReturnDocument, UpdateMany, WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from nudgebot.base import Singleton
+from nudgebot.settings import CurrentProject
+
+
+class Backend(object):
+    """The base class of the storage backends"""
+
+    def get_collection(self, database_name: str, collection_name: str, read_preference=None):
+        """
+        Return the collection, a pymongo `Collection` or an object with the same API.
+
+        @param database_name: `str` The name of the database.
+        @param collection_name: `str` The name of the collection.
+        @keyword read_preference: `str` The name of the read preference of the reads, e.g. 'secondaryPreferred',
+                                  see `get_read_preference`. Default is the read preference of the client.
+        """
+        raise NotImplementedError()
+
+    def collection_names(self, database_name: str):
+        """Return the names of the collections in the database."""
+        raise NotImplementedError()
+
+    def health_check(self):
+        """Check that the storage is available, raise `DatabaseHealthCheckException` otherwise."""
+
+
+class MongoBackend(Backend, metaclass=Singleton):
+    """
+    MongoDB through the database client of the current project.
+
+    The write concern of the collections is configured per database, i.e. per collection class (e.g. relaxed for
+    the statistics which are recollected anyway, strict for the tasks state and records).
+    """
+    READ_PREFERENCES = {
+        'primary': ReadPreference.PRIMARY,
+        'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+        'secondary': ReadPreference.SECONDARY,
+        'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+        'nearest': ReadPreference.NEAREST
+    }
+
+    def __init__(self):
+        write_concerns = CurrentProject().config.get('config', 'database', 'mongo_client', 'write_concerns',
+                                                     default=None) or {}
+        self._write_concerns = {database_name: WriteConcern(**dict(options))
+                                for database_name, options in write_concerns.items()}
+
+    def get_collection(self, database_name: str, collection_name: str, read_preference=None):
+        database = getattr(CurrentProject().db_client, database_name)
+        write_concern = self._write_concerns.get(database_name)
+        if write_concern is None and read_preference is None:
+            return getattr(database, collection_name)
+        assert read_preference is None or read_preference in self.READ_PREFERENCES, \
+            f'Unknown read preference "{read_preference}", should be one of {list(self.READ_PREFERENCES)}'
+        return database.get_collection(collection_name, write_concern=write_concern,
+                                       read_preference=self.READ_PREFERENCES.get(read_preference))
+
+    def collection_names(self, database_name: str):
+        return getattr(CurrentProject().db_client, database_name).collection_names()
+
+    def health_check(self):
+        CurrentProject().db_client.health_check()
+
+
+# The memory engine
+
+
+_MISSING = object()
+
+
+def _path_values(doc, path: str):
+    """Return the values in the dotted path of the document, expanding arrays like MongoDB does"""
+    values = [doc]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    next_values.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    if int(part) < len(value):
+                        next_values.append(value[int(part)])
+                else:
+                    next_values.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = next_values
+    return values
+
+
+def _get_path(doc, path: str, default=_MISSING):
+    """Return the value in the dotted path of the document (without expanding arrays)"""
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return default
+    return value
+
+
+def _set_path(doc, path: str, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _unset_path(doc, path: str):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+def _freeze(value):
+    """Return a hashable representation of the value"""
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _expiry_time(doc, field: str, expire_after_seconds: int):
+    """Return the expiry time of the document by a TTL index on the field (by its earliest date) or None"""
+    dates = [value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+             for found in _path_values(doc, field) for value in (found if isinstance(found, list) else [found])
+             if isinstance(value, datetime)]
+    return min(dates) + timedelta(seconds=expire_after_seconds) if dates else None
+
+
+def _sort_key(value):
+    """Return a key that orders values of different types like MongoDB does (roughly)"""
+    if value is _MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (5, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (4, value)
+    return (3, str(value))
+
+
+def _compare(candidates, operator, operand):
+    for candidate in candidates:
+        try:
+            if operator(candidate, operand):
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+def _candidates(values):
+    """The values and the items of the array values"""
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            yield from value
+
+
+def _equals(values, operand):
+    if operand is None and not values:
+        return True
+    return any(candidate == operand for candidate in _candidates(values))
+
+
+def _match_operators(values, condition: dict):
+    for operator, operand in condition.items():
+        if operator == '$eq':
+            matched = _equals(values, operand)
+        elif operator == '$ne':
+            matched = not _equals(values, operand)
+        elif operator == '$gt':
+            matched = _compare(_candidates(values), lambda a, b: a > b, operand)
+        elif operator == '$gte':
+            matched = _compare(_candidates(values), lambda a, b: a >= b, operand)
+        elif operator == '$lt':
+            matched = _compare(_candidates(values), lambda a, b: a < b, operand)
+        elif operator == '$lte':
+            matched = _compare(_candidates(values), lambda a, b: a <= b, operand)
+        elif operator == '$in':
+            matched = any(_equals(values, item) for item in operand)
+        elif operator == '$nin':
+            matched = not any(_equals(values, item) for item in operand)
+        elif operator == '$exists':
+            matched = bool(values) == bool(operand)
+        elif operator == '$size':
+            matched = any(isinstance(value, list) and len(value) == operand for value in values)
+        elif operator == '$elemMatch':
+            matched = any(_match_element(item, operand)
+                          for value in values if isinstance(value, list) for item in value)
+        else:
+            raise OperationFailure(f'Unsupported query operator in the memory backend: {operator}')
+        if not matched:
+            return False
+    return True
+
+
+def _is_operators(condition):
+    return isinstance(condition, dict) and bool(condition) and all(key.startswith('$') for key in condition)
+
+
+def _match_element(element, condition):
+    """Match an array element, by a query (for documents) or by operators or equality (for values)"""
+    if _is_operators(condition):
+        return _match_operators([element], condition)
+    if isinstance(condition, dict) and isinstance(element, dict):
+        return _match(element, condition)
+    return element == condition
+
+
+def _match(doc: dict, query: dict):
+    """Return whether the document matches the query"""
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            matched = all(_match(doc, sub_query) for sub_query in condition)
+        elif key == '$or':
+            matched = any(_match(doc, sub_query) for sub_query in condition)
+        elif key == '$nor':
+            matched = not any(_match(doc, sub_query) for sub_query in condition)
+        elif _is_operators(condition):
+            matched = _match_operators(_path_values(doc, key), condition)
+        else:
+            matched = _equals(_path_values(doc, key), condition)
+        if not matched:
+            return False
+    return True
+
+
+def _project(doc: dict, projection):
+    if projection is None:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, True)
+    included = [key for key, value in projection.items() if value and key != '_id']
+    if included:
+        result = OrderedDict()
+        if projection.get('_id', True) and '_id' in doc:
+            result['_id'] = doc['_id']
+        for key in included:
+            value = _get_path(doc, key)
+            if value is not _MISSING:
+                _set_path(result, key, copy.deepcopy(value))
+        return dict(result)
+    result = copy.deepcopy(doc)
+    for key, value in projection.items():
+        if not value:
+            _unset_path(result, key)
+    return result
+
+
+def _evaluate(doc: dict, expression):
+    """Evaluate an aggregation expression (field paths, objects and literals)"""
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _get_path(doc, expression[1:], None)
+    if isinstance(expression, dict):
+        if len(expression) == 1 and '$size' in expression:
+            value = _evaluate(doc, expression['$size'])
+            if not isinstance(value, list):
+                raise OperationFailure('The argument to $size must be an array')
+            return len(value)
+        return {key: _evaluate(doc, value) for key, value in expression.items()}
+    return expression
+
+
+class MemoryCursor(object):
+    """A cursor over the result of `MemoryCollection.find`"""
+
+    def __init__(self, documents: list, projection=None, skip=0, limit=0):
+        self._documents = documents
+        self._projection = projection
+        self._skip = skip
+        self._limit = limit
+
+    def sort(self, key_or_list, direction=1):
+        keys = [(key_or_list, direction)] if isinstance(key_or_list, str) else list(key_or_list)
+        for key, key_direction in reversed(keys):
+            self._documents.sort(key=lambda doc: _sort_key(_get_path(doc, key)), reverse=key_direction < 0)
+        return self
+
+    def skip(self, skip: int):
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        return self
+
+    def __iter__(self):
+        documents = self._documents[self._skip:]
+        if self._limit:
+            documents = documents[:self._limit]
+        return (_project(doc, self._projection) for doc in documents)
+
+
+class MemoryCollection(object):
+    """
+    An in-memory collection with (a subset of) the pymongo `Collection` API.
+
+    The TTL indexes (expireAfterSeconds) are enforced lazily, the expired documents are removed by the first read or
+    write once `TTL_MONITOR_INTERVAL` has passed since the last removal (MongoDB removes them every 60 seconds).
+    """
+    TTL_MONITOR_INTERVAL = 1
+
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self._lock = RLock()
+        self._expired_at = 0  # The time of the last removal of the expired documents
+        self._reset()
+
+    def _reset(self):
+        self._documents = OrderedDict()  # _id --> document
+        self._indexes = {'_id_': {'key': [('_id', 1)], 'v': 2}}
+        self._unique = {}  # index name --> {key --> _id}
+
+    def __repr__(self):
+        return '<{} {}.{}>'.format(self.__class__.__name__, self.database.name, self.name)
+
+    @property
+    def full_name(self):
+        return f'{self.database.name}.{self.name}'
+
+    # Indexes
+
+    def create_index(self, keys, unique=False, name=None, **kwargs):
+        keys = [(keys, 1)] if isinstance(keys, str) else [tuple(key) for key in keys]
+        name = name or '_'.join('{}_{}'.format(field, direction) for field, direction in keys)
+        with self._lock:
+            info = {'key': keys, 'v': 2}
+            if unique:
+                info['unique'] = True
+            if kwargs.get('expireAfterSeconds') is not None:
+                info['expireAfterSeconds'] = kwargs['expireAfterSeconds']
+            previous = self._indexes.get(name)
+            self._indexes[name] = info
+            if unique:
+                self._unique[name] = {}
+                try:
+                    for doc in self._documents.values():
+                        self._index_document(doc)
+                except DuplicateKeyError:  # Not created, like in MongoDB
+                    del self._unique[name]
+                    if previous is None:
+                        del self._indexes[name]
+                    else:
+                        self._indexes[name] = previous
+                    raise
+        return name
+
+    def drop_index(self, index_or_name):
+        name = index_or_name if isinstance(index_or_name, str) else \
+            '_'.join('{}_{}'.format(field, direction) for field, direction in index_or_name)
+        with self._lock:
+            if name not in self._indexes or name == '_id_':
+                raise OperationFailure(f'index not found with name [{name}]')
+            del self._indexes[name]
+            self._unique.pop(name, None)
+
+    def update_expiration(self, keys: list, expire_after_seconds: int):
+        """Update the expiration of the TTL index of the keys (see collMod)"""
+        with self._lock:
+            for info in self._indexes.values():
+                if info['key'] == [tuple(key) for key in keys] and 'expireAfterSeconds' in info:
+                    info['expireAfterSeconds'] = expire_after_seconds
+                    return
+        raise OperationFailure(f'cannot find index {keys} for ns {self.full_name}')
+
+    def index_information(self):
+        with self._lock:
+            return copy.deepcopy(self._indexes)
+
+    def _unique_key(self, name: str, doc: dict):
+        return tuple(_freeze(_get_path(doc, field, None)) for field, _ in self._indexes[name]['key'])
+
+    def _check_unique(self, doc: dict):
+        for name, entries in self._unique.items():
+            owner = entries.get(self._unique_key(name, doc))
+            if owner is not None and owner != doc['_id']:
+                raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.full_name} index: {name}')
+
+    def _index_document(self, doc: dict):
+        self._check_unique(doc)
+        for name, entries in self._unique.items():
+            entries[self._unique_key(name, doc)] = doc['_id']
+
+    def _unindex_document(self, doc: dict):
+        for name, entries in self._unique.items():
+            entries.pop(self._unique_key(name, doc), None)
+
+    def _expire(self):
+        """Remove the documents that have expired by the TTL indexes"""
+        if time.time() - self._expired_at < self.TTL_MONITOR_INTERVAL:
+            return
+        self._expired_at = time.time()
+        ttl_indexes = [(info['key'][0][0], info['expireAfterSeconds']) for info in self._indexes.values()
+                       if info.get('expireAfterSeconds') is not None]
+        if not ttl_indexes:
+            return
+        now = datetime.utcnow()
+        for doc in list(self._documents.values()):
+            for field, expire_after_seconds in ttl_indexes:
+                expiry_time = _expiry_time(doc, field, expire_after_seconds)
+                if expiry_time is not None and expiry_time <= now:
+                    self._unindex_document(doc)
+                    del self._documents[doc['_id']]
+                    break
+
+    # Reads
+
+    def _matching(self, query):
+        self._expire()
+        return [doc for doc in self._documents.values() if _match(doc, query)]
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, batch_size=0, **kwargs):  # noqa
+        with self._lock:
+            cursor = MemoryCursor(self._matching(filter), projection, skip, limit)
+        if sort:
+            cursor.sort(sort)
+        return cursor
+
+    def find_one(self, filter=None, projection=None, *args, **kwargs):  # noqa
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        with self._lock:
+            self._expire()
+            for doc in self._documents.values():
+                if _match(doc, filter):
+                    return _project(doc, projection)
+        return None
+
+    def count(self, filter=None, **kwargs):  # noqa
+        with self._lock:
+            return len(self._matching(filter))
+
+    count_documents = count
+
+    # Writes
+
+    def insert_one(self, document: dict):
+        with self._lock:
+            doc = copy.deepcopy(document)
+            doc.setdefault('_id', ObjectId())
+            if doc['_id'] in self._documents:
+                raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.full_name} index: _id_')
+            self._index_document(doc)
+            self._documents[doc['_id']] = doc
+            document.setdefault('_id', doc['_id'])
+            return SimpleNamespace(inserted_id=doc['_id'], acknowledged=True)
+
+    def insert_many(self, documents, ordered=True):
+        inserted_ids = []
+        for document in documents:
+            try:
+                inserted_ids.append(self.insert_one(document).inserted_id)
+            except DuplicateKeyError:
+                if ordered:
+                    raise
+        return SimpleNamespace(inserted_ids=inserted_ids, acknowledged=True)
+
+    def _apply_update(self, doc: dict, update: dict, is_insert=False):
+        if not any(key.startswith('$') for key in update):  # A replacement
+            _id = doc['_id']
+            doc.clear()
+            doc.update(copy.deepcopy(update))
+            doc['_id'] = _id
+            return
+        for operator, fields in update.items():
+            if operator == '$setOnInsert' and not is_insert:
+                continue
+            for path, value in fields.items():
+                value = copy.deepcopy(value)
+                current = _get_path(doc, path)
+                if operator in ('$set', '$setOnInsert'):
+                    _set_path(doc, path, value)
+                elif operator == '$unset':
+                    _unset_path(doc, path)
+                elif operator == '$inc':
+                    _set_path(doc, path, (0 if current is _MISSING else current) + value)
+                elif operator in ('$push', '$addToSet'):
+                    array = [] if current is _MISSING else current
+                    if not isinstance(array, list):
+                        raise OperationFailure(f"The field '{path}' must be an array")
+                    each = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                    for item in each:
+                        if operator == '$push' or item not in array:
+                            array.append(item)
+                    if operator == '$push' and isinstance(value, dict) and '$slice' in value:
+                        array[:] = array[value['$slice']:] if value['$slice'] < 0 else array[:value['$slice']]
+                    _set_path(doc, path, array)
+                elif operator == '$pop':
+                    if isinstance(current, list) and current:
+                        current.pop(0 if value == -1 else -1)
+                elif operator == '$pull':
+                    if isinstance(current, list):
+                        current[:] = [item for item in current if not _match_element(item, value)]
+                else:
+                    raise OperationFailure(f'Unsupported update operator in the memory backend: {operator}')
+
+    def _upsert_document(self, query: dict, update: dict):
+        doc = {}
+        for key, condition in (query or {}).items():
+            if not key.startswith('$') and not _is_operators(condition):
+                _set_path(doc, key, copy.deepcopy(condition))
+        self._apply_update(doc, update, is_insert=True)
+        self.insert_one(doc)
+        return doc
+
+    def _update(self, query: dict, update: dict, upsert=False, multi=False):
+        with self._lock:
+            matched = self._matching(query)
+            if not multi:
+                matched = matched[:1]
+            modified = 0
+            for doc in matched:
+                before = copy.deepcopy(doc)
+                self._unindex_document(doc)
+                indexed = False
+                try:
+                    self._apply_update(doc, update)
+                    self._index_document(doc)
+                    indexed = True
+                finally:
+                    if not indexed:  # Either the update or the unique index failed, restoring the document
+                        doc.clear()
+                        doc.update(before)
+                        self._index_document(doc)
+                modified += int(doc != before)
+            upserted_id = None
+            if not matched and upsert:
+                upserted_id = self._upsert_document(query, update)['_id']
+            return SimpleNamespace(matched_count=len(matched), modified_count=modified, upserted_id=upserted_id,
+                                   acknowledged=True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):  # noqa
+        return self._update(filter, update, upsert)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):  # noqa
+        return self._update(filter, update, upsert, multi=True)
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        return self._update(spec, document, bool(upsert), multi)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):  # noqa
+        return self._update(filter, replacement, upsert)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """
+        Supports `UpdateOne`, `UpdateMany`, `ReplaceOne` and `InsertOne` requests, the requests are always written
+        in order and the first error stops the write, raised as a `BulkWriteError` with its index like pymongo does.
+        """
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self.insert_one(request._doc)
+                else:
+                    self._update(request._filter, request._doc, bool(request._upsert), isinstance(request, UpdateMany))
+            except (DuplicateKeyError, OperationFailure) as err:
+                raise BulkWriteError({'writeErrors': [{'index': index, 'code': err.code, 'errmsg': str(err)}]})
+        return SimpleNamespace(acknowledged=True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,  # noqa
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self._lock:
+            cursor = self.find(filter, sort=sort, limit=1)
+            before = next(iter(cursor), None)
+            if before is None and not upsert:
+                return None
+            result = self._update({'_id': before['_id']} if before else filter, update, upsert)
+            if return_document == ReturnDocument.BEFORE:
+                return _project(before, projection) if before else None
+            _id = before['_id'] if before else result.upserted_id
+            return _project(self._documents[_id], projection)
+
+    def _delete(self, query: dict, multi: bool):
+        with self._lock:
+            matched = self._matching(query)
+            if not multi:
+                matched = matched[:1]
+            for doc in matched:
+                self._unindex_document(doc)
+                del self._documents[doc['_id']]
+            return SimpleNamespace(deleted_count=len(matched), acknowledged=True)
+
+    def delete_one(self, filter):  # noqa
+        return self._delete(filter, multi=False)
+
+    def delete_many(self, filter):  # noqa
+        return self._delete(filter, multi=True)
+
+    def drop(self):
+        """Drop the documents and the indexes, the collection object remains usable as in pymongo"""
+        with self._lock:
+            self._reset()
+
+    # Aggregation
+
+    def aggregate(self, pipeline: list, **kwargs):
+        with self._lock:
+            self._expire()
+            documents = [copy.deepcopy(doc) for doc in self._documents.values()]
+        for stage in pipeline:
+            (operator, spec), = stage.items()
+            if operator == '$match':
+                documents = [doc for doc in documents if _match(doc, spec)]
+            elif operator == '$group':
+                documents = self._group(documents, spec)
+            elif operator == '$project':
+                documents = [self._project_stage(doc, spec) for doc in documents]
+            elif operator == '$sort':
+                documents = list(MemoryCursor(documents).sort(list(spec.items())))
+            elif operator == '$skip':
+                documents = documents[spec:]
+            elif operator == '$limit':
+                documents = documents[:spec]
+            else:
+                raise OperationFailure(f'Unsupported aggregation stage in the memory backend: {operator}')
+        return iter(documents)
+
+    @staticmethod
+    def _project_stage(doc: dict, spec: dict):
+        result = {'_id': doc.get('_id')} if spec.get('_id', True) else {}
+        for key, expression in spec.items():
+            if key == '_id':
+                continue
+            if expression is True or expression == 1:
+                value = _get_path(doc, key)
+                if value is not _MISSING:
+                    _set_path(result, key, value)
+            else:
+                _set_path(result, key, _evaluate(doc, expression))
+        return result
+
+    @staticmethod
+    def _group(documents: list, spec: dict):
+        groups = OrderedDict()
+        for doc in documents:
+            _id = _evaluate(doc, spec['_id'])
+            group = groups.setdefault(_freeze(_id), {'_id': _id})
+            for name, accumulator in spec.items():
+                if name == '_id':
+                    continue
+                (operator, expression), = accumulator.items()
+                value = _evaluate(doc, expression)
+                if operator == '$sum':
+                    group[name] = group.get(name, 0) + (
+                        value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0)
+                elif operator == '$push':
+                    group.setdefault(name, [])
+                    if value is not None:
+                        group[name].append(value)
+                elif operator == '$first':
+                    group.setdefault(name, value)
+                elif operator == '$last':
+                    group[name] = value
+                elif operator in ('$min', '$max'):
+                    if value is not None:
+                        current = group.get(name)
+                        if current is None or (value < current if operator == '$min' else value > current):
+                            group[name] = value
+                    group.setdefault(name, None)
+                elif operator == '$avg':
+                    values = group.setdefault(f'__{name}', [])
+                    if isinstance(value, (int, float)):
+                        values.append(value)
+                    group[name] = sum(values) / len(values) if values else None
+                else:
+                    raise OperationFailure(f'Unsupported accumulator in the memory backend: {operator}')
+        return [{key: value for key, value in group.items() if not key.startswith('__')} for group in groups.values()]
+
+
+class MemoryDatabase(object):
+    """An in-memory database, the collections are created on first access"""
+
+    def __init__(self, client, name: str):
+        self.client = client
+        self.name = name
+        self._collections = {}
+        self._lock = RLock()
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+
+    def collection_names(self, include_system_collections=True):
+        with self._lock:
+            return [name for name, collection in self._collections.items() if collection._documents]
+
+    list_collection_names = collection_names
+
+    def drop_collection(self, name: str):
+        with self._lock:
+            collection = self._collections.get(name)
+        if collection is not None:
+            collection.drop()
+
+    def command(self, command, *args, **kwargs):
+        """
+        Only the update of the expiration of a TTL index (collMod) is applied, any other command is accepted and
+        ignored, there is nothing to tune in memory.
+        """
+        if command == 'collMod' and 'index' in kwargs:
+            self[args[0]].update_expiration(list(kwargs['index']['keyPattern'].items()),
+                                            kwargs['index']['expireAfterSeconds'])
+        return {'ok': 1.0}
+
+
+class MemoryBackend(Backend, metaclass=Singleton):
+    """
+    The in-process storage engine. The data lives as long as the process does, use `nudgebot.db.backup` to keep it.
+    It also serves as a client for `DatabaseBackup`, e.g. DatabaseBackup(MemoryBackend()).dump(path)
+    """
+
+    def __init__(self):
+        self._databases = {}
+        self._lock = RLock()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(self, name)
+            return self._databases[name]
+
+    def get_collection(self, database_name: str, collection_name: str, read_preference=None):
+        return self[database_name][collection_name]
+
+    def collection_names(self, database_name: str):
+        return self[database_name].collection_names()
+
+    def database_names(self):
+        with self._lock:
+            return [name for name, database in self._databases.items() if database.collection_names()]
+
+    def drop_database(self, name: str):
+        with self._lock:
+            self._databases.pop(name, None)
+
+
+BACKENDS = {'mongo': MongoBackend, 'memory': MemoryBackend}
+
+
+def get_backend():
+    """Return the storage backend of the current project"""
+    name = CurrentProject().config.get('config', 'database', 'backend', default='mongo')
+    assert name in BACKENDS, f'Unknown database backend "{name}", should be one of {list(BACKENDS)}'
+    return BACKENDS[name]()
+
+
+def get_read_preference(usage: str):
+    """
+    Return the configured read preference of the usage (`database.mongo_client.read_preferences`), e.g.
+        get_collection(database_name, collection_name, read_preference=get_read_preference('dashboard'))
+
+    @param usage: `str` The usage, e.g. 'dashboard'.
+    @rtype: `str` or None (the read preference of the client).
+    """
+    return CurrentProject().config.get('config', 'database', 'mongo_client', 'read_preferences', usage, default=None)
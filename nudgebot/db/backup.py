@@ -0,0 +1,191 @@
+"""
+Streaming dump and restore of the project databases.
+
+The dump is a directory with a sub directory per database and a gzip compressed file per collection, in which the
+documents are either newline delimited extended JSON (<collection>.json.gz) or concatenated BSON (<collection>.bson.gz),
+and the indexes of the collection are dumped beside it (<collection>.indexes.json) and recreated before the restore.
+Both the dump and the restore stream the documents, so the memory is constant no matter how large the collections are.
+Restoring into a collection that isn't empty (i.e. without `drop`) skips the documents that already exist (duplicate
+keys) and reports how many were skipped.
+Example:
+    DatabaseBackup(CurrentProject().db_client).dump('/backups/2018-04-01')
+    DatabaseBackup(CurrentProject().db_client).restore('/backups/2018-04-01', drop=True)
+"""
+import os
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+import bson
+from bson import json_util
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from nudgebot.log import Loggable
+
+
+class DatabaseBackup(Loggable):
+    """Dumps and restores the databases of a database client"""
+    FORMATS = ('json', 'bson')
+    SYSTEM_DATABASES = ('admin', 'local', 'config')
+    DUPLICATE_KEY_ERROR = 11000
+    INDEX_INFO_IGNORED = ('key', 'v', 'ns')  # The index information that isn't an option of `create_index`
+    JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)  # Naive UTC datetimes, like the BSON documents are read
+
+    def __init__(self, client, batch_size=1000):
+        """
+        @param client: `DatabaseClient` The database client.
+        @keyword batch_size: `int` The number of documents per cursor batch and per insert.
+        """
+        Loggable.__init__(self)
+        self._client = client
+        self._batch_size = batch_size
+
+    def database_names(self):
+        """Return the names of the databases to backup"""
+        return [name for name in self._client.database_names() if name not in self.SYSTEM_DATABASES]
+
+    @staticmethod
+    def _collection_path(path: str, database_name: str, collection_name: str, fmt: str):
+        return os.path.join(path, database_name, f'{collection_name}.{fmt}.gz')
+
+    @staticmethod
+    def _indexes_path(database_path: str, collection_name: str):
+        return os.path.join(database_path, f'{collection_name}.indexes.json')
+
+    def dump_collection(self, path: str, database_name: str, collection_name: str, fmt='json'):
+        """
+        Dump the collection into a compressed file.
+
+        @param path: `str` The path of the dump directory.
+        @param database_name: `str` The name of the database.
+        @param collection_name: `str` The name of the collection.
+        @keyword fmt: `str` 'json' or 'bson'.
+        @return: `int` The number of dumped documents.
+        """
+        assert fmt in self.FORMATS, f'Unknown format {fmt}, should be one of {self.FORMATS}'
+        filepath = self._collection_path(path, database_name, collection_name, fmt)
+        collection = self._client[database_name][collection_name]
+        with open(self._indexes_path(os.path.join(path, database_name), collection_name), 'w') as f:
+            f.write(json_util.dumps(collection.index_information()))
+        cursor = collection.find({}, batch_size=self._batch_size)
+        count = 0
+        with gzip.open(filepath, 'wb') as f:
+            for document in cursor:
+                if fmt == 'json':
+                    f.write(json_util.dumps(document).encode() + b'\n')
+                else:
+                    f.write(bson.BSON.encode(document))
+                count += 1
+        self.logger.info(f'Dumped {count} documents of {database_name}.{collection_name} into {filepath}')
+        return count
+
+    def dump(self, path: str, databases=None, fmt='json'):
+        """
+        Dump the databases into the directory.
+
+        @param path: `str` The path of the dump directory, created if it doesn't exist.
+        @keyword databases: (`list` of `str`) The databases to dump, default is all of them.
+        @keyword fmt: `str` 'json' or 'bson'.
+        @return: `dict` The number of dumped documents by '<database>.<collection>'.
+        """
+        counts = {}
+        for database_name in databases or self.database_names():
+            os.makedirs(os.path.join(path, database_name), exist_ok=True)
+            for collection_name in self._client[database_name].collection_names(include_system_collections=False):
+                counts[f'{database_name}.{collection_name}'] = self.dump_collection(
+                    path, database_name, collection_name, fmt)
+        return counts
+
+    def _read(self, filepath: str):
+        """Yield the documents of the dumped collection file"""
+        with gzip.open(filepath, 'rb') as f:
+            if filepath.endswith('.bson.gz'):
+                yield from bson.decode_file_iter(f)
+            else:
+                for line in f:
+                    if line.strip():
+                        yield json_util.loads(line.decode(), json_options=self.JSON_OPTIONS)
+
+    def _restore_indexes(self, collection, indexes_path: str):
+        """Create the dumped indexes of the collection, an index that conflicts with an existing one is reported"""
+        if not os.path.exists(indexes_path):
+            return
+        with open(indexes_path) as f:
+            indexes = json_util.loads(f.read())
+        for name, info in indexes.items():
+            if name == '_id_':
+                continue
+            options = {key: value for key, value in info.items() if key not in self.INDEX_INFO_IGNORED}
+            try:
+                collection.create_index([tuple(key) for key in info['key']], name=name, **options)
+            except OperationFailure as err:
+                self.logger.warning(f'Could not restore the index {name} of {collection.full_name}: {err}')
+
+    def _insert(self, collection, batch: list):
+        """
+        Insert the batch, the documents that already exist (duplicate keys) are skipped.
+
+        @return: (`int`, `int`) The number of inserted documents and the number of skipped duplicates.
+        """
+        try:
+            result = collection.insert_many(batch, ordered=False)
+        except BulkWriteError as err:
+            errors = err.details.get('writeErrors', [])
+            if any(error.get('code') != self.DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            return err.details.get('nInserted', 0), len(errors)
+        inserted = len(result.inserted_ids)
+        return inserted, len(batch) - inserted
+
+    def restore_collection(self, filepath: str, database_name: str, collection_name: str, drop=False):
+        """
+        Restore the collection from a dumped collection file, with batched inserts.
+
+        @param filepath: `str` The path of the dumped collection file.
+        @param database_name: `str` The name of the database.
+        @param collection_name: `str` The name of the collection.
+        @keyword drop: `bool` Whether to drop the collection before the restore, otherwise the documents that
+                       already exist are skipped.
+        @return: `int` The number of restored documents.
+        """
+        collection = self._client[database_name][collection_name]
+        if drop:
+            collection.drop()
+        self._restore_indexes(collection, self._indexes_path(os.path.dirname(filepath), collection_name))
+        count = skipped = 0
+        batch = []
+        for document in self._read(filepath):
+            batch.append(document)
+            if len(batch) == self._batch_size:
+                inserted, duplicates = self._insert(collection, batch)
+                count, skipped = count + inserted, skipped + duplicates
+                batch = []
+        if batch:
+            inserted, duplicates = self._insert(collection, batch)
+            count, skipped = count + inserted, skipped + duplicates
+        if skipped:
+            self.logger.warning(f'Skipped {skipped} documents of {database_name}.{collection_name} that already exist')
+        self.logger.info(f'Restored {count} documents of {database_name}.{collection_name} from {filepath}')
+        return count
+
+    def restore(self, path: str, databases=None, drop=False, workers=4):
+        """
+        Restore the databases from the dump directory, the collections are restored in parallel.
+
+        @param path: `str` The path of the dump directory.
+        @keyword databases: (`list` of `str`) The databases to restore, default is all the dumped ones.
+        @keyword drop: `bool` Whether to drop the collections before the restore.
+        @keyword workers: `int` The number of collections to restore in parallel.
+        @return: `dict` The number of restored documents by '<database>.<collection>'.
+        """
+        jobs = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for database_name in databases or sorted(os.listdir(path)):
+                database_path = os.path.join(path, database_name)
+                for filename in sorted(os.listdir(database_path)):
+                    collection_name, fmt = filename.rsplit('.', 2)[:2]
+                    if fmt not in self.FORMATS:
+                        continue
+                    jobs[f'{database_name}.{collection_name}'] = executor.submit(
+                        self.restore_collection, os.path.join(database_path, filename),
+                        database_name, collection_name, drop)
+        return {name: job.result() for name, job in jobs.items()}
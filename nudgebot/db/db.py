@@ -1,16 +1,45 @@
 import pprint
+from datetime import datetime, timedelta
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import DuplicateKeyError
 
 from bson import _ENCODERS as bson_encoders
+from nudgebot.db.backends import get_backend
+from nudgebot.db.encoding import bson_encode
+from nudgebot.db.write_behind import WriteBehindBuffer
 from nudgebot.settings import CurrentProject
 
 
 class DatabaseClient(MongoClient):  # noqa
-    """A Database client for MongoDB"""
+    """
+    A Database client for MongoDB.
+
+    The client options are read from `database.mongo_client` in the config (config.yaml), the keyword arguments
+    override them:
+        * host, port: The server address.
+        * max_pool_size, min_pool_size: The bounds of the connection pool (per server).
+        * max_idle_time_ms: Close the pooled connections that are idle that long.
+        * wait_queue_timeout_ms: How long to wait for a pooled connection once the pool is exhausted.
+        * connect_timeout_ms, socket_timeout_ms, server_selection_timeout_ms: The timeouts.
+        * replica_set: The name of the replica set.
+        * compressors: (`list` of `str`) The wire compressors in order of preference, e.g. [zlib].
+    The write concerns and the read preferences are applied per collection, see `nudgebot.db.backends.MongoBackend`.
+    """
     bson_types = tuple(bson_encoders.keys())
     HOST = CurrentProject().config.config.database.mongo_client.host
     PORT = CurrentProject().config.config.database.mongo_client.port
+    OPTIONS = {  # config key --> pymongo option
+        'max_pool_size': 'maxPoolSize',
+        'min_pool_size': 'minPoolSize',
+        'max_idle_time_ms': 'maxIdleTimeMS',
+        'wait_queue_timeout_ms': 'waitQueueTimeoutMS',
+        'connect_timeout_ms': 'connectTimeoutMS',
+        'socket_timeout_ms': 'socketTimeoutMS',
+        'server_selection_timeout_ms': 'serverSelectionTimeoutMS',
+        'replica_set': 'replicaset',
+        'compressors': 'compressors'
+    }
 
     def __init__(
             self,
@@ -20,31 +49,51 @@ class DatabaseClient(MongoClient):  # noqa
             tz_aware=None,
             connect=None,
             **kwargs):
-        MongoClient.__init__(self, host=host, port=port, document_class=document_class,
-                             tz_aware=tz_aware, connect=connect, **kwargs)
+        options = self.get_options()
+        options.update(kwargs)
+        MongoClient.__init__(self, host=host or self.HOST, port=port or self.PORT, document_class=document_class,
+                             tz_aware=tz_aware, connect=connect, **options)
+        self._configured_address = (host or self.HOST, port or self.PORT)
+
+    @classmethod
+    def get_options(cls):
+        """Return the pymongo client options from the config"""
+        config = CurrentProject().config
+        options = {}
+        for key, option in cls.OPTIONS.items():
+            value = config.get('config', 'database', 'mongo_client', key, default=None)
+            if value is not None:
+                options[option] = ','.join(value) if key == 'compressors' and isinstance(value, list) else value
+        return options
+
+    def health_check(self):
+        """
+        Check that the server is reachable and that it accepts writes (i.e. there is a primary), called on startup
+        so the bot fails fast instead of failing on the first event. It waits up to `server_selection_timeout_ms`.
+
+        @raise DatabaseHealthCheckException: If the server is not reachable or doesn't accept writes.
+        @rtype: `dict` The 'ismaster' response.
+        """
+        from nudgebot.exceptions import DatabaseHealthCheckException
+        try:
+            self.admin.command('ping')
+            is_master = self.admin.command('ismaster')
+        except Exception as error:
+            raise DatabaseHealthCheckException(self._configured_address, error)
+        if not is_master.get('ismaster'):
+            raise DatabaseHealthCheckException(self._configured_address, 'there is no primary, writes are not accepted')
+        return is_master
 
     @classmethod
     def bson_encode(cls, node):
         """Verifying that all the objects in the dict node are bson encodable.
-        Those that are not converted to an `str`.
+        Those that are not converted by the registered encoders or to an `str`, see `nudgebot.db.encoding`.
             @param node: Either a node of the json tree or a value.
         """
-        if isinstance(node, dict):
-            result = {}
-            for key, value in node.items():
-                result[key] = cls.bson_encode(value)
-        elif isinstance(node, (list, tuple)):
-            result = []
-            for item in node:
-                result.append(cls.bson_encode(item))
-        elif isinstance(node, cls.bson_types):
-            result = node
-        else:
-            result = str(node)
-        return result
+        return bson_encode(node)
 
     def dump(self, databasename, collection_name=None, query=None, filepath=None, dismiss_id=True):
-        """Dumping the database content.
+        """Dumping the database content (loaded into memory, for backups see `nudgebot.db.backup`).
             @param databasename: `str` The name of the database to dump.
             @keyword collection_name: `str` filter by collection name to dump a specific collection.
             @keyword query: `dict` filter by a query in the collection.
@@ -83,15 +132,28 @@ class DatabaseClient(MongoClient):  # noqa
                 self.drop_database(dbname)
 
 
+def get_collection(database_name: str, collection_name: str, read_preference=None):
+    """Return the collection in the database of the current project, from the configured storage backend
+    (see `nudgebot.db.backends`).
+        @param database_name: `str` The name of the database.
+        @param collection_name: `str` The name of the collection.
+        @keyword read_preference: `str` The read preference of the reads, e.g. 'secondaryPreferred'.
+    """
+    return get_backend().get_collection(database_name, collection_name, read_preference)
+
+
 class DataCollection(object):
     """
     Define the inherit class as data collection and provides access into it
     Should be defined in subclass:
         * DATABSE_NAME: `str` The name of the database.
         * COLLECTION_NAME: `str` The name of the COLLECTION_NAME in that database.
+    Optional to define in subclass:
+        * INDEXES: (`list` of `list` of (`str`, `int`)) The keys of the indexes of the collection.
     """
     DATABASE_NAME = None
     COLLECTION_NAME = None
+    INDEXES = []
 
     def upsert(self, query: dict, work: dict):
         """Update a document with the matched query, if no such document, insert.
@@ -104,8 +166,15 @@ class DataCollection(object):
         """Returns the database collection"""
         assert cls.DATABASE_NAME is not None
         assert cls.COLLECTION_NAME is not None
-        db = getattr(CurrentProject().db_client, cls.DATABASE_NAME)
-        return getattr(db, cls.COLLECTION_NAME)
+        return get_collection(cls.DATABASE_NAME, cls.COLLECTION_NAME)
+
+    @classmethod
+    def get_indexes(cls):
+        """Return the indexes of the collection, see `nudgebot.db.indexes.Index`.
+        By default they are built from `INDEXES`, overwrite in order to derive them from something else.
+        """
+        from nudgebot.db.indexes import Index
+        return [Index(cls.DATABASE_NAME, cls.COLLECTION_NAME, keys) for keys in cls.INDEXES]
 
     @property
     def db_collection(self):
@@ -115,19 +184,32 @@ class DataCollection(object):
 class CachedStack(DataCollection):
     """
     A cached LIFO stack that cache itself in the database.
+
+    Each item is a document {'name': <stack name>, 'item': <item>, 'pushed': <datetime>} which is unique by the stack
+    name and the item, so a push is an indexed upsert and the membership check is an indexed lookup, no matter how
+    long the stack is. The stack is trimmed to its length every `TRIM_EVERY` fraction of the length pushes, hence
+    up to that number of the oldest items may still be found by the membership check until they're trimmed.
     """
     DATABASE_NAME = 'metadata'
-    COLLECTION_NAME = 'cached_stacks'
+    COLLECTION_NAME = 'cached_stack_items'
+    LEGACY_COLLECTION_NAME = 'cached_stacks'  # The stacks as a single document with an array, see `migrate_legacy_stacks`
+    TRIM_EVERY = 0.1
+    ORDER = [('pushed', ASCENDING), ('_id', ASCENDING)]
 
-    def __init__(self, name: str, length: int = 1000):
+    def __init__(self, name: str, length: int = 1000, write_behind=False):
         """
         @param name: `str` The name of the cached stack.
         @keyword  length: `int` the length of the cached stack. if length = -1: length is unlimited.
+        @keyword write_behind: `bool` Whether to buffer the pushes (see `nudgebot.db.write_behind`), the pending
+                               items are still visible to the membership check.
         """
         self._i = 0
         self._name = name
         self._length = length
-        self._length_exeeded = False
+        self._write_behind = write_behind
+        self._pending = set()
+        self._trim_every = max(1, int(length * self.TRIM_EVERY))
+        self._pushes = 0  # Since the last trim
 
     def __repr__(self):
         return '<{} {}>'.format(self.__class__.__name__, self.stack)
@@ -139,43 +221,100 @@ class CachedStack(DataCollection):
         return self.stack[index]
 
     def __contains__(self, item):
-        return item in self.stack
+        if item in self._pending:
+            return True
+        return self.db_collection.find_one({'name': self._name, 'item': item}, {'_id': True}) is not None
 
     def __len__(self):
-        return len(self.stack)
+        self._sync()
+        length = self.db_collection.count({'name': self._name})
+        return length if self._length == -1 else min(length, self._length)
+
+    @classmethod
+    def get_indexes(cls):
+        """The items are unique per stack, and ordered by the push time"""
+        from nudgebot.db.indexes import Index
+        return [Index(cls.DATABASE_NAME, cls.COLLECTION_NAME, [('name', ASCENDING), ('item', ASCENDING)], unique=True),
+                Index(cls.DATABASE_NAME, cls.COLLECTION_NAME, [('name', ASCENDING)] + cls.ORDER)]
+
+    @classmethod
+    def migrate_legacy_stacks(cls):
+        """
+        Move the items of the stacks that are stored as a single document with an array into item documents.
+
+        @return: `int` The number of migrated stacks.
+        """
+        legacy_collection = get_collection(cls.DATABASE_NAME, cls.LEGACY_COLLECTION_NAME)
+        collection = cls.get_db_collection()
+        migrated = 0
+        for doc in legacy_collection.find({}):
+            stack = doc.get('stack', [])
+            pushed = datetime.utcnow() - timedelta(milliseconds=len(stack))
+            for i, item in enumerate(stack):  # The push times keep the order, in milliseconds (BSON)
+                collection.update_one({'name': doc['name'], 'item': item},
+                                      {'$setOnInsert': {'pushed': pushed + timedelta(milliseconds=i)}}, upsert=True)
+            legacy_collection.delete_one({'_id': doc['_id']})
+            migrated += 1
+        return migrated
+
+    def _sync(self):
+        if self._write_behind:
+            WriteBehindBuffer().sync(self.db_collection, {'name': self._name})
 
     @property
     def stack(self):
         """Returns the stack."""
-        doc = self.db_collection.find_one({'name': self._name}, {'_id': False})
-        if doc:
-            return doc['stack']
-        else:
-            self.db_collection.insert_one({'name': self._name, 'stack': []})
-        return []
+        self._sync()
+        cursor = self.db_collection.find({'name': self._name}, {'_id': False, 'item': True})
+        cursor = cursor.sort([(key, -direction) for key, direction in self.ORDER])
+        if self._length != -1:
+            cursor = cursor.limit(self._length)
+        return [doc['item'] for doc in cursor][::-1]
 
     @property
     def length_exeeded(self):
-        """
-        Checking whether the length exceeded. once it exceeded, it continue to be exceeded.
-        That in order to reduce DB calls."""
-        if not self._length_exeeded:
-            self._length_exeeded = (False if self._length == -1 else self._length <= len(self.stack))
-        return self._length_exeeded
+        """Checking whether the length exceeded."""
+        return self._length != -1 and self._length <= len(self)
 
     def pop(self):
         """Pop the first item"""
-        return self.db_collection.update_one({'name': self._name}, {'$pop': {'stack': -1}})
+        self._sync()
+        for doc in self.db_collection.find({'name': self._name}, {'_id': True}).sort(self.ORDER).limit(1):
+            return self.db_collection.delete_one({'_id': doc['_id']})
+
+    def trim(self):
+        """Remove the oldest items that exceed the length"""
+        if self._length == -1:
+            return
+        self._sync()
+        cursor = self.db_collection.find({'name': self._name}, {'_id': True})
+        cursor = cursor.sort([(key, -direction) for key, direction in self.ORDER]).skip(self._length)
+        ids = [doc['_id'] for doc in cursor]
+        if ids:
+            self.db_collection.delete_many({'_id': {'$in': ids}})
 
     def push(self, item):
         """
-        Push a new item to the stack, pop the first.
+        Push a new item to the stack (unless it's already in the stack), the oldest items are trimmed once the length
+        is exceeded (see `TRIM_EVERY`).
             @param item: The item to push."""
-        if self.length_exeeded:
-            self.pop()
-        self.db_collection.update_one({'name': self._name}, {'$addToSet': {'stack': item}})
+        query, update = {'name': self._name, 'item': item}, {'$setOnInsert': {'pushed': datetime.utcnow()}}
+        if self._write_behind:
+            self._pending.add(item)
+            WriteBehindBuffer().update_one(self.db_collection, query, update, upsert=True,
+                                           on_flush=lambda: self._pending.discard(item),
+                                           on_failure=lambda: self._pending.discard(item))
+        else:
+            try:
+                self.db_collection.update_one(query, update, upsert=True)
+            except DuplicateKeyError:  # Pushed concurrently
+                pass
+        self._pushes += 1
+        if self._pushes >= self._trim_every:
+            self._pushes = 0
+            self.trim()
 
     def clear(self):
         """Clearing the stack"""
-        while self.stack:
-            self.pop()
+        self._sync()
+        self.db_collection.delete_many({'name': self._name})
@@ -0,0 +1,100 @@
+"""
+BSON encoding of arbitrary payloads (e.g. statistics values) before they are written into the database.
+
+The values are dispatched by their exact type through a table, so the common case of an already BSON-safe payload
+is a dict lookup per node, and containers are copied only if something in them has actually changed.
+Types that BSON doesn't support are converted by the registered encoders (see `register_encoder`), or to `str`.
+"""
+from datetime import date, datetime, time
+
+from bson import _ENCODERS as bson_encoders
+
+
+_encoders = {}  # type --> encoder, the registered encoders
+_dispatch = {}  # type --> handler, resolved lazily per exact type
+
+
+def register_encoder(type_: type, encoder):
+    """
+    Register an encoder for a type (and its subclasses).
+
+    @param type_: `type` The type to encode.
+    @param encoder: `callable` Receives the value and returns its BSON encodable form (which is encoded as well).
+    """
+    _encoders[type_] = encoder
+    _dispatch.clear()
+
+
+def _identity(node):
+    return node
+
+
+def _encode_dict(node):
+    copy = None
+    for key, value in node.items():
+        encoded = _dispatch.get(type(value)) or _resolve(type(value))
+        if encoded is _identity:
+            continue
+        encoded = encoded(value)
+        if encoded is not value:
+            if copy is None:
+                copy = dict(node)
+            copy[key] = encoded
+    return node if copy is None else copy
+
+
+def _encode_list(node):
+    copy = None
+    for i, value in enumerate(node):
+        encoded = _dispatch.get(type(value)) or _resolve(type(value))
+        if encoded is _identity:
+            continue
+        encoded = encoded(value)
+        if encoded is not value:
+            if copy is None:
+                copy = list(node)
+            copy[i] = encoded
+    return node if copy is None else copy
+
+
+def _custom(encoder):
+
+    def encode(node):
+        return bson_encode(encoder(node))
+
+    return encode
+
+
+def _resolve(type_: type):
+    """Resolve the handler of the type by its MRO and cache it in the dispatch table"""
+    handler = str
+    for base in type_.__mro__:
+        if base in _encoders:
+            handler = _custom(_encoders[base])
+        elif base is dict:
+            handler = _encode_dict
+        elif base in (list, tuple):
+            handler = _encode_list
+        elif base in bson_encoders and base is not object:
+            handler = _identity
+        else:
+            continue
+        break
+    _dispatch[type_] = handler
+    return handler
+
+
+def bson_encode(node):
+    """
+    Return the BSON encodable form of the node.
+    The node itself is returned if it's already encodable, otherwise only the changed containers are copied.
+
+    @param node: Either a node of the json tree or a value.
+    """
+    handler = _dispatch.get(type(node)) or _resolve(type(node))
+    return handler(node)
+
+
+register_encoder(date, lambda value: datetime.combine(value, time()))
+register_encoder(set, list)
+register_encoder(frozenset, list)
@@ -0,0 +1,201 @@
+"""
+Indexes management.
+
+Each `DataCollection` describes the indexes it's queried by (see `DataCollection.get_indexes`), the `IndexManager`
+collects them, creates them idempotently on startup and reports the missing and the unused ones.
+"""
+from bson.son import SON
+from pymongo.errors import OperationFailure
+
+from nudgebot.db.db import DataCollection, get_collection
+from nudgebot.log import Loggable
+
+
+class Index(object):
+    """Represents an index of a collection"""
+
+    def __init__(self, database_name: str, collection_name: str, keys: list, unique=False, expire_after_seconds=None):
+        """
+        @param database_name: `str` The name of the database.
+        @param collection_name: `str` The name of the collection.
+        @param keys: (`list` of (`str`, `int`)) The index keys and their directions, e.g. [('name', ASCENDING)].
+        @keyword unique: `bool` Whether this is a unique index.
+        @keyword expire_after_seconds: `int` Makes this a TTL index, the documents are removed after this number
+                                       of seconds since the date in the (single) indexed field.
+        """
+        assert isinstance(keys, (list, tuple)) and keys, 'keys must be a non empty list'
+        assert expire_after_seconds is None or len(keys) == 1, 'TTL index must be a single field index'
+        self.database_name = database_name
+        self.collection_name = collection_name
+        self.keys = [tuple(key) for key in keys]
+        self.unique = unique
+        self.expire_after_seconds = expire_after_seconds
+
+    def __repr__(self):
+        return '<{} {}.{} {}>'.format(self.__class__.__name__, self.database_name, self.collection_name, self.name)
+
+    def __eq__(self, other):
+        if not isinstance(other, Index):
+            return False
+        return self._identity == other._identity
+
+    @property
+    def _identity(self):
+        return self.namespace, self.keys, self.unique, self.expire_after_seconds
+
+    def __hash__(self):
+        return hash((self.namespace, tuple(self.keys), self.unique, self.expire_after_seconds))
+
+    @property
+    def name(self):
+        """Return the name of the index, same as the default name that MongoDB gives."""
+        return '_'.join('{}_{}'.format(field, direction) for field, direction in self.keys)
+
+    @property
+    def namespace(self):
+        return '{}.{}'.format(self.database_name, self.collection_name)
+
+    @property
+    def collection(self):
+        return get_collection(self.database_name, self.collection_name)
+
+    @property
+    def options(self):
+        """Return the options for `create_index`"""
+        options = {'name': self.name, 'unique': self.unique, 'background': True}
+        if self.expire_after_seconds is not None:
+            options['expireAfterSeconds'] = self.expire_after_seconds
+        return options
+
+    def exists(self, index_information: dict):
+        """Return whether the index exists, with the same options, according to the collection's `index_information()`"""
+        info = index_information.get(self.name)
+        if not info:
+            return False
+        keys = [tuple(key) for key in info['key']]
+        if keys != self.keys or bool(info.get('unique')) != self.unique:
+            return False
+        return info.get('expireAfterSeconds') == self.expire_after_seconds
+
+    def only_expiration_differs(self, index_information: dict):
+        """Return whether the index exists and differs only by its expiration, which can be updated in place"""
+        info = index_information.get(self.name)
+        if not info or info.get('expireAfterSeconds') is None or self.expire_after_seconds is None:
+            return False
+        return Index(self.database_name, self.collection_name, info['key'], bool(info.get('unique')),
+                     self.expire_after_seconds) == self
+
+    def update_expiration(self):
+        """Update the expiration of an existing TTL index"""
+        self.collection.database.command('collMod', self.collection_name, index={
+            'keyPattern': SON(self.keys), 'expireAfterSeconds': self.expire_after_seconds})
+
+
+class IndexManager(Loggable):
+    """
+    Manages the indexes of the data collections.
+
+    Example:
+        manager = IndexManager(CurrentProject().STATISTICS + CurrentProject().TASKS)
+        manager.ensure_indexes()
+        manager.report()  --> {'missing': [...], 'unused': [...]}
+    """
+    def __init__(self, collection_classes: list):
+        """
+        @param collection_classes: (`list` of `DataCollection` subclasses) The data collections to manage, the
+                                   metadata collections are always managed.
+        """
+        from nudgebot.db.db import CachedStack
+        from nudgebot.statistics.base import StatisticsRevisions
+        from nudgebot.tasks.periodic import PeriodicTaskState
+        Loggable.__init__(self)
+        self._collection_classes = [CachedStack, StatisticsRevisions, PeriodicTaskState]
+        self._collection_classes.extend(cls for cls in collection_classes if issubclass(cls, DataCollection))
+
+    @property
+    def indexes(self):
+        """Return all the indexes of the managed data collections (without duplicates)"""
+        indexes = []
+        for collection_cls in self._collection_classes:
+            for index in collection_cls.get_indexes():
+                if index not in indexes:
+                    indexes.append(index)
+        return indexes
+
+    def ensure_indexes(self):
+        """
+        Creating all the indexes, existing indexes are left as is so this is safe to call on every startup.
+        An existing index whose options have changed is updated: the expiration of a TTL index is updated in place,
+        otherwise (e.g. it became unique) the index is dropped and created again.
+        """
+        index_informations = {}
+        for index in self.indexes:
+            self.logger.debug(f'Ensuring index: {index}')
+            if index.namespace not in index_informations:
+                index_informations[index.namespace] = index.collection.index_information()
+            index_information = index_informations[index.namespace]
+            if index.exists(index_information):
+                continue
+            try:
+                if index.only_expiration_differs(index_information):
+                    self.logger.info(f'Updating the expiration of index {index}')
+                    index.update_expiration()
+                elif index.name in index_information:
+                    self.logger.info(f'Recreating index {index}, its options have changed')
+                    self._recreate_index(index, index_information[index.name])
+                else:
+                    index.collection.create_index(index.keys, **index.options)
+            except OperationFailure as err:
+                self.logger.warning(f'Could not create index {index}: {err}')
+            del index_informations[index.namespace]  # Read again for the next indexes of the collection
+
+    def _recreate_index(self, index: Index, info: dict):
+        """Drop the index and create it with its new options, the old index is restored if the creation fails"""
+        index.collection.drop_index(index.name)
+        try:
+            index.collection.create_index(index.keys, **index.options)
+        except OperationFailure:  # e.g. a unique index over duplicates
+            options = {key: value for key, value in info.items() if key not in ('key', 'v', 'ns')}
+            index.collection.create_index([tuple(key) for key in info['key']], name=index.name, **options)
+            raise
+
+    def missing_indexes(self):
+        """
+        Return the indexes which are not exist in the database.
+
+        @rtype: `list` of `Index`
+        """
+        index_informations = {}
+        missing = []
+        for index in self.indexes:
+            if index.namespace not in index_informations:
+                index_informations[index.namespace] = index.collection.index_information()
+            if not index.exists(index_informations[index.namespace]):
+                missing.append(index)
+        return missing
+
+    def unused_indexes(self):
+        """
+        Return the names of the indexes in the managed collections that have not been used since the server started.
+
+        @rtype: `list` of `str` (formatted as '<database>.<collection>.<index name>')
+        """
+        unused = []
+        for namespace in sorted(set(index.namespace for index in self.indexes)):
+            database_name, collection_name = namespace.split('.', 1)
+            try:
+                stats = list(get_collection(database_name, collection_name).aggregate([{'$indexStats': {}}]))
+            except OperationFailure as err:  # Not supported by the server
+                self.logger.warning(f'Could not get index stats of {namespace}: {err}')
+                continue
+            for stat in stats:
+                if stat['name'] != '_id_' and not stat['accesses']['ops']:
+                    unused.append('{}.{}'.format(namespace, stat['name']))
+        return unused
+
+    def report(self):
+        """Return a report of the missing and unused indexes"""
+        return {
+            'missing': [repr(index) for index in self.missing_indexes()],
+            'unused': self.unused_indexes()
+        }
@@ -0,0 +1,263 @@
+"""
+Write-behind buffering.
+
+Writes that nobody waits for (the delivered events stack, the tasks state and records) are buffered and written in
+batches with `bulk_write`, so the events handling doesn't wait for a database round trip per write.
+The writes of each collection are written in order, and are flushed once the batch is full, once the oldest
+pending write reaches the max staleness, before a conflicting read (see `sync`) and on exit.
+The writes that fail are put back in front of the buffer and retried with exponential backoff, since the writes are
+ordered the writes after a failed write are not attempted and are put back as well. The writes are never dropped because
+the database is unavailable (e.g. during a failover or an outage), they are kept until it's back. Only a write that the
+database itself rejects (e.g. a duplicate key) is dropped and logged as an error once it has failed `max_retries` times,
+since retrying it can't succeed and it would block the writes behind it.
+The buffer is bounded, once `max_pending` writes are pending (e.g. the database is down) the writers wait for the buffer
+to drain (backpressure), rather than growing the memory without a limit.
+
+Configuration (config.yaml):
+    database:
+      write_behind:
+        enabled: `bool` Whether to buffer the writes, otherwise they are written immediately.
+        max_staleness: `float` Max number of seconds that a write may wait in the buffer.
+        max_batch: `int` Max number of pending writes of a collection, the collection is flushed once it's reached.
+        max_retries: `int` Max number of times that a write may be rejected by the database before it's dropped.
+        max_pending: `int` Max number of pending writes, `update_one` blocks once it's reached.
+        retry_backoff: `float` The number of seconds to wait before the first retry of failed writes, doubled on each
+                       consecutive failure.
+        max_backoff: `float` Max number of seconds between the retries.
+"""
+import atexit
+import time
+from collections import OrderedDict
+from threading import Condition, RLock
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from nudgebot.base import Singleton, Thread
+from nudgebot.log import Loggable
+from nudgebot.settings import CurrentProject
+
+
+class PendingWrite(object):
+    """A buffered write"""
+
+    def __init__(self, filter_: dict, update: dict, upsert: bool, on_flush=None, on_failure=None):
+        self.filter = filter_
+        self.update = update
+        self.upsert = upsert
+        self.on_flush = on_flush
+        self.on_failure = on_failure
+        self.failures = 0
+        self.equality_items = self.get_equality_items(filter_)
+
+    @staticmethod
+    def get_equality_items(filter_: dict):
+        """Return the equality conditions of the filter as a set of items"""
+        return set((key, str(value)) for key, value in filter_.items()
+                   if not key.startswith('$') and not isinstance(value, dict))
+
+    def conflicts(self, equality_items: set):
+        """Return whether a read with these equality conditions may read the document of this write"""
+        return self.equality_items <= equality_items or equality_items <= self.equality_items
+
+
+class WriteBehindFlusher(Thread):
+    """The thread that flushes the stale writes"""
+
+    def __init__(self, buffer):
+        Thread.__init__(self)
+        self._buffer = buffer
+
+    def run(self):
+        self._buffer.flush_loop()
+
+
+class WriteBehindBuffer(Loggable, metaclass=Singleton):
+    """
+    Buffers writes and flushes them in batches.
+
+    Example:
+        WriteBehindBuffer().update_one(collection, {'key': key}, {'$set': {'condition': True}}, upsert=True)
+        WriteBehindBuffer().sync(collection, {'key': key})  # Before reading the document
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        config = CurrentProject().config
+        self.enabled = config.get('config', 'database', 'write_behind', 'enabled', default=True)
+        self._max_staleness = config.get('config', 'database', 'write_behind', 'max_staleness', default=1)
+        self._max_batch = config.get('config', 'database', 'write_behind', 'max_batch', default=500)
+        self._max_retries = config.get('config', 'database', 'write_behind', 'max_retries', default=3)
+        self._max_pending = config.get('config', 'database', 'write_behind', 'max_pending', default=100000)
+        self._retry_backoff = config.get('config', 'database', 'write_behind', 'retry_backoff', default=0.5)
+        self._max_backoff = config.get('config', 'database', 'write_behind', 'max_backoff', default=30)
+        self._pending = OrderedDict()  # namespace --> (collection, `list` of `PendingWrite`)
+        self._size = 0  # The number of writes that haven't been written (or dropped) yet, including the in-flight ones
+        self._oldest = None  # The time of the oldest pending write
+        self._retry_at = {}  # namespace --> the time of the next retry of its failed writes
+        self._failed_flushes = {}  # namespace --> the number of consecutive failed flushes of the collection
+        self._lock = RLock()
+        self._flush_lock = RLock()
+        self._wakeup = Condition(self._lock)
+        self._drained = Condition(self._lock)
+        self._flusher = None
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _namespace(collection):
+        return collection.full_name
+
+    def update_one(self, collection, filter_: dict, update: dict, upsert=False, on_flush=None, on_failure=None):
+        """
+        Buffer an update of a single document.
+
+        @param collection: `Collection` The collection.
+        @param filter_: `dict` The filter of the document.
+        @param update: `dict` The update.
+        @keyword upsert: `bool` Whether to insert the document if it doesn't exist.
+        @keyword on_flush: `callable` Called (without arguments) once the write has been written.
+        @keyword on_failure: `callable` Called (without arguments) once the write has been dropped after it has been
+                             rejected `max_retries` times.
+        """
+        if not self.enabled:  # Written immediately, the errors are raised to the caller
+            collection.update_one(filter_, update, upsert=upsert)
+            if on_flush:
+                on_flush()
+            return
+        write = PendingWrite(filter_, update, upsert, on_flush, on_failure)
+        with self._lock:
+            if self._size >= self._max_pending:
+                self.logger.warning(f'The write-behind buffer is full ({self._size} writes), waiting for it to drain')
+                while self._size >= self._max_pending:
+                    self._drained.wait()
+            self._size += 1
+            namespace = self._namespace(collection)
+            writes = self._pending.setdefault(namespace, (collection, []))[1]
+            writes.append(write)
+            if self._oldest is None:
+                self._oldest = time.time()
+                self._wakeup.notify()
+            full = len(writes) >= self._max_batch
+            if not self._flusher:
+                self._flusher = WriteBehindFlusher(self)
+                self._flusher.start()
+        if full:
+            self.flush(namespace, skip_backoff=True)
+
+    def sync(self, collection, filter_=None):
+        """
+        Flush the pending writes of the collection that may affect a read, call it before reading the collection
+        in order to read the pending writes as well.
+
+        @param collection: `Collection` The collection.
+        @keyword filter_: `dict` The filter of the read, default is a read of the whole collection.
+        """
+        namespace = self._namespace(collection)
+        with self._lock:
+            if namespace not in self._pending:
+                return
+            if filter_ is not None:
+                equality_items = PendingWrite.get_equality_items(filter_)
+                if not any(write.conflicts(equality_items) for write in self._pending[namespace][1]):
+                    return
+        self.flush(namespace)
+
+    def flush(self, namespace=None, skip_backoff=False):
+        """
+        Write the pending writes.
+
+        @keyword namespace: `str` Flush only the writes of this collection ('<database>.<collection>').
+        @keyword skip_backoff: `bool` Skip the collections whose failed writes wait for their retry.
+        """
+        with self._flush_lock:
+            with self._lock:
+                now = time.time()
+                namespaces = [namespace] if namespace else list(self._pending)
+                if skip_backoff:
+                    namespaces = [ns for ns in namespaces if self._retry_at.get(ns, 0) <= now]
+                batches = [self._pending.pop(ns) for ns in namespaces if ns in self._pending]
+                if not self._pending:
+                    self._oldest = None
+            for collection, writes in batches:
+                self._write(collection, writes)
+
+    def _write(self, collection, writes: list):
+        """Write the batch in order, the writes that haven't been written are put back in the buffer"""
+        try:
+            collection.bulk_write([UpdateOne(write.filter, write.update, upsert=write.upsert) for write in writes],
+                                  ordered=True)
+            written, failed, error = writes, [], None
+        except BulkWriteError as err:
+            # The writes before the failed write have been written and the writes after it haven't been attempted
+            write_error = err.details['writeErrors'][0]
+            written, failed, error = writes[:write_error['index']], writes[write_error['index']:], write_error['errmsg']
+            failed[0].failures += 1
+        except Exception as err:  # e.g. the database is unavailable, the writes are retried until it's back
+            written, failed, error = [], writes, err
+        for write in written:
+            if write.on_flush:
+                write.on_flush()
+        self._done(collection, written, bool(failed))
+        if failed:
+            self._retry(collection, failed, error)
+
+    def _done(self, collection, writes: list, failed: bool):
+        """Account for the writes that have been written or dropped, and reset the backoff of the collection"""
+        with self._lock:
+            if not failed:
+                self._retry_at.pop(self._namespace(collection), None)
+                self._failed_flushes.pop(self._namespace(collection), None)
+            if writes:
+                self._size -= len(writes)
+                self._drained.notify_all()
+
+    def _retry(self, collection, writes: list, error):
+        """
+        Put the failed writes back in front of the buffer, they are retried after a backoff which is doubled on
+        each consecutive failure. The writes that have been rejected by the database too many times are dropped.
+        """
+        namespace = self._namespace(collection)
+        dropped = [write for write in writes if write.failures >= self._max_retries]
+        writes = [write for write in writes if write.failures < self._max_retries]
+        with self._lock:
+            failed_flushes = self._failed_flushes[namespace] = self._failed_flushes.get(namespace, 0) + 1
+        backoff = min(self._retry_backoff * 2 ** (failed_flushes - 1), self._max_backoff)
+        self.logger.warning(f'Failed to write {len(writes) + len(dropped)} buffered writes into {namespace}, '
+                            f'{len(writes)} of them will be retried in {backoff:.1f}s: {error}')
+        if dropped:
+            self.logger.error(f'Dropped {len(dropped)} buffered writes into {namespace} that have been rejected '
+                              f'{self._max_retries} times: {error}')
+        for write in dropped:
+            if write.on_failure:
+                write.on_failure()
+        self._done(collection, dropped, True)
+        if not writes:
+            return
+        with self._lock:
+            pending = self._pending.pop(namespace, (collection, []))[1]
+            self._pending[namespace] = (collection, writes + pending)
+            self._retry_at[namespace] = time.time() + backoff
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._wakeup.notify()
+
+    def _next_flush_delay(self):
+        """
+        Return the number of seconds until the next flush, i.e. until the oldest pending write reaches the max staleness
+        and the backoff of its collection is over, or None if nothing is pending.
+        """
+        if not self._pending:
+            return None
+        now = time.time()
+        stale_at = self._oldest + self._max_staleness
+        return min(max(stale_at, self._retry_at.get(namespace, 0)) for namespace in self._pending) - now
+
+    def flush_loop(self):
+        """Flushing the writes once the oldest pending write reaches the max staleness, see `_next_flush_delay`"""
+        while True:
+            with self._lock:
+                delay = self._next_flush_delay()
+                while delay is None or delay > 0:
+                    self._wakeup.wait(delay)
+                    delay = self._next_flush_delay()
+            self.flush(skip_backoff=True)
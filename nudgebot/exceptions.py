@@ -71,3 +71,18 @@ class SubThreadException(BaseException):
 
     def __str__(self):
         return f'Thread "{self._thread.name}" has count an exception.'
+
+
+class DatabaseHealthCheckException(BaseException):
+    """An exception that raises when the database is not reachable or not writable on startup."""
+
+    def __init__(self, address, reason):
+        """
+        @param address: (`str`, `int`) The host and port of the database.
+        @param reason: The error or the reason of the failure.
+        """
+        self._address = address
+        self._reason = reason
+
+    def __str__(self):
+        return f'Database health check failed ({self._address}): {self._reason}'
@@ -1,10 +1,12 @@
 import argparse
+from pprint import pprint
 
 from nudgebot.server import app
 
 
 argparser = argparse.ArgumentParser()
-argparser.add_argument('opt', choices=['run', 'run_server'], help='Operation')
+argparser.add_argument('opt', choices=['run', 'run_server', 'run_worker', 'index_report'], help='Operation')
+argparser.add_argument('--queues', nargs='*', help='run_worker: The events queues to consume, default is all of them')
 
 
 def exec_command(namespace):
@@ -14,6 +16,12 @@ def exec_command(namespace):
         bot.mainloop()
     elif namespace.opt == 'run_server':
         app.run('0.0.0.0', 8080)
+    elif namespace.opt == 'run_worker':
+        celery_runner.run_worker(namespace.queues or celery_runner.scope_queues())
+    elif namespace.opt == 'index_report':
+        from nudgebot.db.indexes import IndexManager
+        from nudgebot.settings import CurrentProject
+        pprint(IndexManager(CurrentProject().STATISTICS + CurrentProject().TASKS).report())
     else:
         raise Exception('Unknown Option.')
 
@@ -1,25 +1,45 @@
 import os
 
 from jinja2 import Template
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 
+from nudgebot.db.backends import get_read_preference
 from nudgebot.settings import CurrentProject
+from nudgebot.statistics.snapshot import StatisticsSnapshotService
 
 
 app = Flask(__name__)
 
 
-def get_statistics():
+def get_statistics(keys=None, skip=0, limit=0):
+    """Return the pretty statistics data of the project.
+
+    @keyword keys: (`list` of `str`) Return only the statistics with these keys, default is all.
+    @keyword skip: `int` Number of rows to skip in each statistics.
+    @keyword limit: `int` Max number of rows of each statistics, 0 means no limit.
+    """
     out = {}
+    snapshot = StatisticsSnapshotService().get(get_read_preference('dashboard'))
     for stats in CurrentProject().STATISTICS:
-        data = stats.reload()
+        if keys and stats.key not in keys:
+            continue
+        data = snapshot.statistics_page(stats, skip, limit)
         out[stats.key.title().replace('_', ' ')] = {
             'data': [s.pretty_dict() for s in data],
-            'headers': list(data[0].pretty_dict().keys())
+            'headers': (list(data[0].pretty_dict().keys()) if data else list(stats.EndpointScope.primary_keys))
         }
     return out
 
 
+def get_statistics_args():
+    """Return the `get_statistics` keyword arguments from the request arguments."""
+    return {
+        'keys': request.args.getlist('key'),
+        'skip': request.args.get('skip', 0, type=int),
+        'limit': request.args.get('limit', 0, type=int)
+    }
+
+
 @app.route('/scripts/<filename>')
 def get_script(filename):
     with open(os.path.join(os.path.dirname(__file__), f'assets/js/{filename}')) as f:
@@ -28,12 +48,12 @@ def get_script(filename):
 
 @app.route('/statistics', methods=['GET'])
 def statistics():
-    return jsonify(get_statistics())
+    return jsonify(get_statistics(**get_statistics_args()))
 
 
 @app.route('/dashboard', methods=['GET'])
 def dashboard():
     with open(f'{os.path.dirname(__file__)}/index.html', 'r') as f:
         template = Template(f.read())
-        data = get_statistics()
+        data = get_statistics(**get_statistics_args())
         return template.render(data=data)
@@ -18,5 +18,10 @@ class CurrentProject(metaclass=Singleton):
         """
         self._project_package = current_project_package
 
+    @property
+    def package(self):
+        """Return the project package"""
+        return self._project_package
+
     def __getattr__(self, name):
         return getattr(self._project_package, name)
@@ -0,0 +1,302 @@
+"""
+Aggregations over the statistics collections.
+
+An aggregation groups the documents of a statistics collection by some fields and computes aggregators per group.
+It runs either as a MongoDB aggregation pipeline, or vectorized with numpy over the columns of a statistics snapshot
+(see `nudgebot.statistics.snapshot`), both return the same compact result: a row per group.
+Example:
+    aggregate('github_pull_request', group_by=['repository'], snapshot=self.all_statistics,
+              prs=Count(), comments=Sum('total_comments'), age=AgeBuckets('last_update', [DAY, WEEK]))
+    --> [{'repository': 'wrapanapi', 'prs': 14, 'comments': 52, 'age': [3, 6, 5]}, ...]
+"""
+import math
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, without it the aggregations run in MongoDB
+    numpy = None
+
+from nudgebot.db.db import get_collection
+from nudgebot.utils import Age
+
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+
+def percentile(values: list, q: float):
+    """
+    Return the q-th percentile of the values, with linear interpolation (same as `numpy.percentile`).
+
+    @param values: (`list` of numbers) The values, None values are ignored.
+    @param q: `float` The percentile, between 0 and 100.
+    """
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class Aggregator(object):
+    """
+    The base class of the aggregators.
+    Should be defined in subclass:
+        * accumulator(): The `$group` accumulator of the pipeline.
+        * columnar(): The vectorized computation.
+    Optional to define in subclass:
+        * finalize(): Converting the accumulated value into the result.
+    """
+
+    def __init__(self, field=None):
+        self.field = field
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.field or '')
+
+    def accumulator(self):
+        """Return the `$group` accumulator expression"""
+        raise NotImplementedError()
+
+    def finalize(self, value):
+        """Return the result from the accumulated value"""
+        return value
+
+    def columnar(self, values, groups, groups_count: int):
+        """
+        Return the results of all the groups.
+
+        @param values: `numpy.ndarray` The values of the field (None if the aggregator has no field).
+        @param groups: `numpy.ndarray` The group index of each value.
+        @param groups_count: `int` The number of groups.
+        @rtype: `list`
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _numeric(values):
+        """Return the values as floats, non numeric values are NaN"""
+        if values.dtype != object:
+            return values.astype(float)
+        return numpy.array([value if isinstance(value, (int, float)) else math.nan for value in values], dtype=float)
+
+
+class Count(Aggregator):
+    """The number of documents in the group"""
+
+    def accumulator(self):
+        return {'$sum': 1}
+
+    def columnar(self, values, groups, groups_count):
+        return numpy.bincount(groups, minlength=groups_count).tolist()
+
+
+class Sum(Aggregator):
+    """The sum of a numeric field, non numeric values are ignored"""
+
+    def accumulator(self):
+        return {'$sum': f'${self.field}'}
+
+    def columnar(self, values, groups, groups_count):
+        sums = numpy.bincount(groups, weights=numpy.nan_to_num(self._numeric(values)), minlength=groups_count)
+        return [int(value) if value.is_integer() else value for value in sums.tolist()]
+
+
+class Percentile(Aggregator):
+    """The q-th percentile of a numeric field, e.g. Percentile('total_comments', 90)"""
+
+    def __init__(self, field, q: float):
+        Aggregator.__init__(self, field)
+        self.q = q
+
+    def accumulator(self):
+        return {'$push': f'${self.field}'}
+
+    def finalize(self, value):
+        return percentile([v for v in value if isinstance(v, (int, float))], self.q)
+
+    def columnar(self, values, groups, groups_count):
+        values = self._numeric(values)
+        order = numpy.argsort(groups, kind='stable')
+        bounds = numpy.cumsum(numpy.bincount(groups, minlength=groups_count))[:-1]
+        results = []
+        for group_values in numpy.split(values[order], bounds):
+            group_values = group_values[~numpy.isnan(group_values)]
+            results.append(float(numpy.percentile(group_values, self.q)) if group_values.size else None)
+        return results
+
+
+class AgeBuckets(Aggregator):
+    """
+    The number of documents per age bucket of a date field (a `datetime` or a date string, UTC if naive).
+    e.g. AgeBuckets('last_update', [DAY, WEEK]) --> [<younger than a day>, <a day to a week>, <older than a week>]
+    Documents with no date are not counted.
+    """
+
+    def __init__(self, field, bounds: list):
+        """
+        @param field: `str` The date field.
+        @param bounds: (`list` of `int`) The ascending upper bounds of the buckets in seconds.
+        """
+        Aggregator.__init__(self, field)
+        self.bounds = list(bounds)
+
+    def accumulator(self):
+        return {'$push': f'${self.field}'}
+
+    def finalize(self, value):
+        counts = [0] * (len(self.bounds) + 1)
+        for date in value:
+            if date:
+                counts[self._bucket(Age(date).total_seconds)] += 1
+        return counts
+
+    def _bucket(self, age):
+        for i, bound in enumerate(self.bounds):
+            if age < bound:
+                return i
+        return len(self.bounds)
+
+    def _ages(self, values):
+        """Return the ages in seconds, NaN where there is no date"""
+        present = numpy.array([bool(value) for value in values], dtype=bool)
+        ages = numpy.full(len(values), math.nan)
+        try:
+            dates = values[present].astype('datetime64[s]')
+        except (ValueError, TypeError):  # Not ISO formatted, parsing one by one
+            ages[present] = [Age(value).total_seconds for value in values[present]]
+        else:
+            now = numpy.datetime64(datetime.utcnow().replace(microsecond=0), 's')
+            ages[present] = (now - dates).astype(float)
+        return ages
+
+    def columnar(self, values, groups, groups_count):
+        ages = self._ages(values)
+        present = ~numpy.isnan(ages)
+        buckets = numpy.searchsorted(self.bounds, ages[present], side='right')
+        width = len(self.bounds) + 1
+        counts = numpy.bincount(groups[present] * width + buckets, minlength=groups_count * width)
+        return counts.reshape(groups_count, width).tolist()
+
+
+class Aggregation(object):
+    """An aggregation over a statistics collection, see the module documentation"""
+
+    def __init__(self, collection_name: str, group_by=(), query=None, **aggregators):
+        """
+        @param collection_name: `str` The name of the collection in the statistics database.
+        @keyword group_by: (`list` of `str`) The fields to group by, by default all the documents are a single group.
+        @keyword query: `dict` The query filter.
+        @param aggregators: (`str` --> `Aggregator`) The aggregators by their names in the result.
+        """
+        assert all(isinstance(aggregator, Aggregator) for aggregator in aggregators.values())
+        self.collection_name = collection_name
+        self.group_by = list(group_by)
+        self.query = query or {}
+        self.aggregators = aggregators
+
+    def __repr__(self):
+        return '<{} {} group_by={} {}>'.format(
+            self.__class__.__name__, self.collection_name, self.group_by, self.aggregators)
+
+    def _sorted(self, rows):
+        return sorted(rows, key=lambda row: [str(row[field]) for field in self.group_by])
+
+    @property
+    def pipeline(self):
+        """Return the MongoDB aggregation pipeline"""
+        group = {'_id': {field: f'${field}' for field in self.group_by}}
+        group.update({name: aggregator.accumulator() for name, aggregator in self.aggregators.items()})
+        return [{'$match': self.query}, {'$group': group}]
+
+    def run_pipeline(self):
+        """
+        Run the aggregation in the database.
+
+        @rtype: `list` of `dict`
+        """
+        rows = []
+        for result in get_collection('statistics', self.collection_name).aggregate(self.pipeline):
+            row = {field: result['_id'].get(field) for field in self.group_by}
+            row.update({name: aggregator.finalize(result[name]) for name, aggregator in self.aggregators.items()})
+            rows.append(row)
+        return self._sorted(rows)
+
+    def can_run_columnar(self):
+        """Return whether the aggregation can run over a snapshot, i.e. numpy is installed and the query has
+        only equality conditions"""
+        return numpy is not None and not any(
+            isinstance(value, dict) or key.startswith('$') for key, value in self.query.items())
+
+    @classmethod
+    def _hashable(cls, value):
+        """Return a hashable key of the group by value, lists (and documents) are grouped by their content as in the
+        database"""
+        if isinstance(value, (list, tuple)):
+            return list, tuple(cls._hashable(item) for item in value)
+        if isinstance(value, dict):
+            return dict, tuple((key, cls._hashable(item)) for key, item in value.items())
+        return value
+
+    def run_columnar(self, table):
+        """
+        Run the aggregation vectorized over the columns of a snapshot table.
+
+        @param table: `StatisticsTable` The table of the collection.
+        @rtype: `list` of `dict`
+        """
+        assert self.can_run_columnar(), f'{self} cannot run over a snapshot'
+        mask = numpy.ones(len(table), dtype=bool)
+        for field, value in self.query.items():
+            mask &= numpy.array([item == value for item in table.column(field)], dtype=bool)
+        codes = numpy.zeros(int(mask.sum()), dtype=numpy.int64)
+        keys = []
+        for field in self.group_by:
+            index, field_keys, field_codes = {}, [], []
+            for value in table.column(field)[mask].tolist():
+                hashable = self._hashable(value)
+                if hashable not in index:
+                    index[hashable] = len(field_keys)
+                    field_keys.append(value)
+                field_codes.append(index[hashable])
+            codes = codes * max(len(field_keys), 1) + numpy.array(field_codes, dtype=numpy.int64)
+            keys.append(field_keys)
+        unique_codes, groups = numpy.unique(codes, return_inverse=True)
+        groups = groups.reshape(-1)
+        results = {name: aggregator.columnar(table.column(aggregator.field)[mask] if aggregator.field else None,
+                                             groups, len(unique_codes))
+                   for name, aggregator in self.aggregators.items()}
+        rows = []
+        for i, code in enumerate(unique_codes.tolist()):
+            values = []
+            for field_keys in reversed(keys):
+                code, key_index = divmod(code, len(field_keys))
+                values.insert(0, field_keys[key_index])
+            row = dict(zip(self.group_by, values))
+            row.update({name: result[i] for name, result in results.items()})
+            rows.append(row)
+        return self._sorted(rows)
+
+    def run(self, snapshot=None):
+        """
+        Run the aggregation, over the snapshot if it's provided and possible, otherwise in the database.
+
+        @keyword snapshot: `StatisticsSnapshot` The statistics snapshot.
+        @rtype: `list` of `dict`
+        """
+        if snapshot is not None and self.can_run_columnar():
+            return self.run_columnar(snapshot[self.collection_name])
+        return self.run_pipeline()
+
+
+def aggregate(collection_name: str, group_by=(), query=None, snapshot=None, **aggregators):
+    """
+    Aggregate a statistics collection, see `Aggregation`.
+
+    @keyword snapshot: `StatisticsSnapshot` Run vectorized over this snapshot when possible.
+    @rtype: `list` of `dict`
+    """
+    return Aggregation(collection_name, group_by, query, **aggregators).run(snapshot)
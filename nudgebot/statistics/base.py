@@ -1,12 +1,22 @@
+import json
+import time
 from collections import OrderedDict
+from threading import Lock
 from cached_property import cached_property
 from types import MethodType
 
-from nudgebot.base import SubclassesGetterMixin
+from pymongo import ASCENDING
+
+from nudgebot.base import SubclassesGetterMixin, Singleton, AttributeDict
 from nudgebot.base.toggle_cached_properties import toggled_cached_property
 from nudgebot.base.toggle_cached_properties import ToggledCachedProperties
 from nudgebot.thirdparty.base import EndpointScope, Event
-from nudgebot.db.db import DataCollection
+from nudgebot.db.backends import get_backend
+from nudgebot.db.db import DataCollection, get_collection
+from nudgebot.db.encoding import bson_encode
+from nudgebot.db.indexes import Index
+from nudgebot.statistics.history import StatisticsHistory
+from nudgebot.statistics.process_pool import StatisticsProcessPool
 from nudgebot.log import Loggable
 
 
@@ -18,22 +28,15 @@ class statistic(Loggable, toggled_cached_property):
         self.prettify = None
         Loggable.__init__(self)
 
-    def __get__(self, obj, cls):
-        self.obj = obj
-        if self.obj and not hasattr(self.obj, '_toggled_cached_properties'):
-            self.obj._toggled_cached_properties = {}
-        return self
-
     def pretty(self, func):
-
-        parent = self
-
-        def pretty(value=None):
-            return func(value or parent())
-
-        self.prettify = pretty
+        """Set the prettify function, it's called with the value of the statistic of the bound object"""
+        self.prettify = func
         return self
 
+    def pretty_value(self, value=None):
+        """Return the prettified value (the value of the statistic by default)"""
+        return self.prettify(value or self())
+
     def __call__(self):
         self.logger.debug(f'Getting statistic: {self}')
         return toggled_cached_property.__call__(self)
@@ -60,10 +63,243 @@ class constant_statistic(statistic):
         """
         def getter(*args):  # noqa
             return value
-        self.obj = obj
         getter.__name__ = key
         getter = MethodType(getter, obj)
         statistic.__init__(self, getter)
+        self.obj = obj
+
+
+class cpu_bound_statistic(statistic):
+    """
+    A statistic that does heavy CPU work, the work is done in the statistics process pool so it doesn't hold the GIL
+    of the bot process (see `nudgebot.statistics.process_pool`).
+    The getter runs in the bot process and returns the inputs (i.e. the I/O part) and the compute function runs in a
+    worker process with these inputs, both the inputs and the result must be picklable.
+    The compute function is resolved in the worker by the statistics class and the statistic name, so the
+    statistics class should be defined in the module level.
+    Example:
+        class MyPrStatistics(PullRequestStatistics):
+
+            @cpu_bound_statistic
+            def words_count(self):
+                return [c.body for c in self.scope.get_issue_comments()]   # Runs in the bot process
+
+            @words_count.compute
+            def words_count(bodies):
+                return sum(len(body.split()) for body in bodies)            # Runs in a worker process
+    """
+
+    def __init__(self, getter):
+        statistic.__init__(self, getter)
+        self.compute_function = None
+        self.path = None
+
+    def __set_name__(self, owner, name):
+        self.path = (owner.__module__, owner.__qualname__, name)
+
+    def compute(self, func):
+        """Set the compute function, it receives the inputs returned by the getter."""
+        self.compute_function = func
+        return self
+
+    def submit(self):
+        """Submit the computation to the process pool, the result is waited for on the first call."""
+        assert self.compute_function, f'{self} has no compute function'
+        name = self.getter.__name__
+        if name in self.obj._toggled_cached_properties:
+            return
+        results = self.obj.__dict__.setdefault('_cpu_bound_results', {})
+        if name not in results:
+            results[name] = StatisticsProcessPool().submit(self.path, self.getter(self.obj))
+
+    def __call__(self):
+        name = self.getter.__name__
+        if name not in self.obj._toggled_cached_properties:
+            self.submit()
+            self.obj._toggled_cached_properties[name] = self.obj._cpu_bound_results.pop(name)()
+        return statistic.__call__(self)
+
+    def uncache(self):
+        self.obj.__dict__.get('_cpu_bound_results', {}).pop(self.getter.__name__, None)
+        statistic.uncache(self)
+
+
+class StatisticsRevisions(DataCollection):
+    """
+    Holds a revision counter for each collection in the statistics database.
+
+    The revision is bumped whenever statistics are written into the collection, that way any process which holds
+    an in-process copy of the collection (e.g. the dashboard server) can tell whether its copy is still valid
+    with a single cheap query instead of reloading the whole collection.
+    """
+    DATABASE_NAME = 'metadata'
+    COLLECTION_NAME = 'statistics_revisions'
+    INDEXES = [[('name', ASCENDING)]]
+
+    @classmethod
+    def get(cls, collection_name: str) -> int:
+        """Return the current revision of the collection."""
+        doc = cls.get_db_collection().find_one({'name': collection_name}, {'_id': False, 'revision': True})
+        return doc['revision'] if doc else 0
+
+    @classmethod
+    def all(cls) -> dict:
+        """Return the current revisions of all the collections."""
+        return {doc['name']: doc['revision'] for doc in cls.get_db_collection().find({}, {'_id': False})}
+
+    @classmethod
+    def bump(cls, collection_name: str):
+        """Bump the revision of the collection."""
+        cls.get_db_collection().update_one({'name': collection_name}, {'$inc': {'revision': 1}}, upsert=True)
+
+
+class StatisticsCache(object, metaclass=Singleton):
+    """
+    A read-through in-process cache for data loaded from the statistics database.
+
+    Each entry is keyed by the collection and the query arguments and stamped with the revision of the
+    collection (see `StatisticsRevisions`). Once the collection has changed, or the entry is older than
+    `MAX_AGE` seconds, the entry is reloaded on the next read.
+    """
+    MAX_ENTRIES = 128
+    MAX_AGE = 60  # seconds
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _entry_key(collection_name: str, query_args: dict):
+        return collection_name, json.dumps(query_args, sort_keys=True, default=str)
+
+    def lookup(self, collection_name: str, query_args: dict):
+        """
+        Lookup for a valid entry.
+
+        @param collection_name: `str` The name of the collection in the statistics database.
+        @param query_args: `dict` The query arguments that identify the entry.
+        @return: (`bool`, value, `int`) Whether the entry found, its value and the current revision
+                 of the collection (which should be passed to `store` in case it's not found).
+        """
+        key = self._entry_key(collection_name, query_args)
+        revision = StatisticsRevisions.get(collection_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == revision and time.time() - entry[1] < self.MAX_AGE:
+                self._entries.move_to_end(key)
+                return True, entry[2], revision
+        return False, None, revision
+
+    def store(self, collection_name: str, query_args: dict, revision: int, value):
+        """Store the value of the entry that was loaded in the revision"""
+        with self._lock:
+            self._entries[self._entry_key(collection_name, query_args)] = (revision, time.time(), value)
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    def get(self, collection_name: str, query_args: dict, loader):
+        """
+        Return the cached value for the collection and query arguments, load it if it's missing or stale.
+
+        @param collection_name: `str` The name of the collection in the statistics database.
+        @param query_args: `dict` The query arguments that identify the entry.
+        @param loader: `callable` Called without arguments to load the value.
+        """
+        found, value, revision = self.lookup(collection_name, query_args)
+        if not found:
+            value = loader()
+            self.store(collection_name, query_args, revision, value)
+        return value
+
+    def invalidate(self, collection_name: str):
+        """Invalidate all the entries of the collection, in this process and in any other process."""
+        StatisticsRevisions.bump(collection_name)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == collection_name]:
+                del self._entries[key]
+
+
+class StatisticsDocuments(object):
+    """
+    A lazy view of the documents of a collection in the statistics database.
+
+    Nothing is loaded until the view is iterated, then the documents are streamed from a cursor as `AttributeDict`s
+    and kept in the `StatisticsCache` which is shared by all the tasks in the process.
+    The documents may be shared, so they should be treated as read-only.
+    Example:
+        for pr_stats in self.all_statistics.github_pull_request.find({'state': 'open'}, ['repository', 'title']):
+            ...
+    """
+
+    def __init__(self, collection_name: str, query=None, projection=None):
+        """
+        @param collection_name: `str` The name of the collection in the statistics database.
+        @keyword query: `dict` The query filter.
+        @keyword projection: (`list` of `str`) The fields to load, default is all of them.
+        """
+        self._collection_name = collection_name
+        self._query = query or {}
+        self._projection = projection
+
+    def __repr__(self):
+        return '<{} {} query={}>'.format(self.__class__.__name__, self._collection_name, self._query)
+
+    @property
+    def _query_args(self):
+        return {'documents': True, 'query': self._query, 'projection': self._projection}
+
+    @property
+    def db_collection(self):
+        return get_collection(Statistics.DATABASE_NAME, self._collection_name)
+
+    def find(self, query=None, projection=None):
+        """
+        Return a view of the documents that match the query.
+
+        @keyword query: `dict` The query filter, combined with the query of this view.
+        @keyword projection: (`list` of `str`) The fields to load.
+        @rtype: `StatisticsDocuments`
+        """
+        combined_query = dict(self._query)
+        combined_query.update(query or {})
+        return self.__class__(self._collection_name, combined_query, projection or self._projection)
+
+    def __iter__(self):
+        found, documents, revision = StatisticsCache().lookup(self._collection_name, self._query_args)
+        if found:
+            yield from documents
+            return
+        documents = []
+        projection = (dict.fromkeys(self._projection, True) if self._projection is not None else None)
+        for data in self.db_collection.find(self._query, projection):
+            documents.append(AttributeDict.attributize_dict(data))
+            yield documents[-1]
+        StatisticsCache().store(self._collection_name, self._query_args, revision, documents)
+
+    def __len__(self):
+        return self.db_collection.count(self._query)
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+
+class StatisticsDatabase(object):
+    """
+    A lazy accessor to the statistics database, each collection is accessible as an attribute (or an item)
+    and is loaded only when it's used, see `StatisticsDocuments`.
+    """
+
+    def __getattr__(self, collection_name):
+        if collection_name.startswith('_'):
+            raise AttributeError(collection_name)
+        return StatisticsDocuments(collection_name)
+
+    def __getitem__(self, collection_name):
+        return StatisticsDocuments(collection_name)
+
+    def keys(self):
+        """Return the names of the collections in the statistics database"""
+        return get_backend().collection_names(Statistics.DATABASE_NAME)
 
 
 class Statistics(Loggable, DataCollection, ToggledCachedProperties, SubclassesGetterMixin):
@@ -79,10 +315,14 @@ class Statistics(Loggable, DataCollection, ToggledCachedProperties, SubclassesGe
         * EndpointScope: `EndpointScope` The Endpoint scope of this Statistics.
         * COLLECTION_NAME: `str` The name of the collection in the statistics database.
         * key: a Unique key identifier for the statistics.
+    Optional to define in subclass:
+        * HISTORY: `bool` or (`list` of `str`) Whether to keep the history of all the statistics (or of the listed
+                   ones), see `nudgebot.statistics.history`.
     """
     EndpointScope = None
     COLLECTION_NAME = None
     key = None
+    HISTORY = False
     DATABASE_NAME = 'statistics'
 
     def __init__(self, **query):
@@ -98,18 +338,81 @@ class Statistics(Loggable, DataCollection, ToggledCachedProperties, SubclassesGe
     def __repr__(self):
         return '<{} query={}>'.format(self.__class__.__name__, self._query)
 
+    @classmethod
+    def get_indexes(cls):
+        """The statistics are queried by the primary keys of the endpoint scope"""
+        indexes = StatisticsHistory(cls).get_indexes() if cls.HISTORY else []
+        if cls.EndpointScope.is_singleton_scope():
+            return indexes
+        keys = [(key, ASCENDING) for key in cls.EndpointScope.primary_keys]
+        return [Index(cls.DATABASE_NAME, cls.COLLECTION_NAME, keys)] + indexes
+
     def _add_query_to_stats(self):
         """Adding the query attributes as statistic's"""
         for k, v in self._query.items():
             setattr(self, k, constant_statistic(self, k, v))
 
     @classmethod
-    def reload(cls):
-        instances = []
-        for data in cls.get_db_collection().find({}, {'_id': False}):
-            instances.append(cls(**{k: v for k, v in data.items() if k in cls.EndpointScope.primary_keys}))
-            instances[-1].set_cache(**data)
-        return instances
+    def from_document(cls, data: dict):
+        """Instantiate the statistics from its document in the statistics database, the statistics are cached."""
+        instance = cls(**{k: v for k, v in data.items() if k in cls.EndpointScope.primary_keys})
+        instance.set_cache(**data)
+        return instance
+
+    @classmethod
+    def _projection(cls, projection=None):
+        """Return the database projection, the primary keys are always included in order to be able to instantiate."""
+        if projection is None:
+            return {'_id': False}
+        fields = dict.fromkeys(cls.EndpointScope.primary_keys, True)
+        fields.update(dict.fromkeys(projection, True))
+        fields['_id'] = False
+        return fields
+
+    @classmethod
+    def find(cls, query=None, projection=None, sort=None, skip=0, limit=0, batch_size=0):
+        """
+        Stream the statistics that match the query from the statistics database.
+
+        The documents are fetched via a cursor, so only one batch is held in memory at a time.
+            @keyword query: `dict` The query filter.
+            @keyword projection: (`list` of `str`) The statistics to load, default is all of them.
+            @keyword sort: (`list` of (`str`, `int`)) The sort specification, e.g. [('last_update', -1)].
+            @keyword skip: `int` Number of documents to skip.
+            @keyword limit: `int` Max number of documents to return, 0 means no limit.
+            @keyword batch_size: `int` The cursor batch size, 0 means the server default.
+        @rtype: generator of `Statistics`
+        """
+        cursor = cls.get_db_collection().find(query or {}, cls._projection(projection), skip=skip, limit=limit)
+        if sort:
+            cursor = cursor.sort(sort)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        for data in cursor:
+            yield cls.from_document(data)
+
+    @classmethod
+    def count(cls, query=None):
+        """Return the number of statistics documents that match the query."""
+        return cls.get_db_collection().count(query or {})
+
+    @classmethod
+    def reload(cls, query=None, projection=None, sort=None, skip=0, limit=0, use_cache=True):
+        """
+        Return the statistics that match the query as a list (see `find`).
+
+        The result is cached in process until the collection is changed (see `StatisticsCache`).
+            @keyword use_cache: `bool` Whether to use the cache.
+        @rtype: `list` of `Statistics`
+        """
+        query_args = {'query': query, 'projection': projection, 'sort': sort, 'skip': skip, 'limit': limit}
+
+        def loader():
+            return list(cls.find(**query_args))
+
+        if not use_cache:
+            return loader()
+        return StatisticsCache().get(cls.COLLECTION_NAME, dict(query_args, statistics=cls.__qualname__), loader)
 
     @cached_property
     def query(self):
@@ -136,12 +439,48 @@ class Statistics(Loggable, DataCollection, ToggledCachedProperties, SubclassesGe
         self.logger.info(f'Collecting statistics: {self}')
         data = self.db_data or {}
         data_exists = bool(data)
-        for key, prop in self.dict(cached_only=cached_only and data_exists).items():
+        if not (cached_only and data_exists):
+            self.submit_cpu_bound_statistics()
+        changes = {}
+        # Comparing the encoded values, as they are stored, otherwise e.g. a date would always differ from the stored
+        # datetime
+        for key, prop in bson_encode(self.dict(cached_only=cached_only and data_exists)).items():
+            if key not in data or data[key] != prop:
+                changes[key] = prop
             data[key] = prop
         if data_exists:
             self.db_collection.update_one(self._query, {'$set': data})
-            return
-        self.db_collection.insert_one(data)
+        else:
+            self.db_collection.insert_one(data)
+        if self.HISTORY:
+            StatisticsHistory(self.__class__).record(self._query, changes)
+        if changes or not data_exists:  # Bumping the revision drops the cached reloads and snapshots
+            StatisticsCache().invalidate(self.COLLECTION_NAME)
+
+    def history(self, fields=None, start=None, end=None, resolution=None):
+        """
+        Return the history of the statistics (`HISTORY` should be enabled), see `StatisticsHistory.query`.
+            e.g. stats.history(['total_comments'], start=datetime(2018, 1, 1), resolution=timedelta(days=7))
+        """
+        assert self.HISTORY, f'The history of {self.__class__.__name__} is not tracked'
+        return StatisticsHistory(self.__class__).query(self._query, fields, start, end, resolution)
+
+    @classmethod
+    def cpu_bound_statistics_names(cls):
+        """Return the names of the CPU-bound statistics of this statistics class"""
+        names = set()
+        for klass in cls.__mro__:
+            names.update(name for name, attr in vars(klass).items() if isinstance(attr, cpu_bound_statistic))
+        return sorted(names)
+
+    def submit_cpu_bound_statistics(self):
+        """Submit all the CPU-bound statistics to the process pool at once so they are computed in parallel"""
+        for name in self.cpu_bound_statistics_names():
+            getattr(self, name).submit()
+
+    def uncache_all(self):
+        self.__dict__.pop('_cpu_bound_results', None)
+        ToggledCachedProperties.uncache_all(self)
 
     def set_endpoint_scope(self, scope: EndpointScope):
         """Settings the endpoint scope instance directly, this is in case that we already have it and want to prevent
@@ -164,7 +503,7 @@ class Statistics(Loggable, DataCollection, ToggledCachedProperties, SubclassesGe
         for key in self.EndpointScope.primary_keys:
             pretty_dict[key] = None
         for k, v in self.dict(cached_only=cached_only).items():
-            pretty_dict[k] = (getattr(self, k).prettify(v) if getattr(self, k).prettify else v)
+            pretty_dict[k] = (getattr(self, k).pretty_value(v) if getattr(self, k).prettify else v)
         return pretty_dict
 
 
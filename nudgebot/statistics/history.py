@@ -0,0 +1,129 @@
+"""
+Statistics history.
+
+The statistics database holds only the current values, a statistics class with `HISTORY` enabled also appends the
+values that have changed in each collection into the history database. The history is bucketed by day, so there is
+one document per scope per day:
+    {<primary keys...>, 'day': <datetime>, 'changes': [[<datetime>, <statistic>, <value>], ...], 'count': <int>}
+A collection that changed nothing doesn't write anything, hence the storage grows with the number of changes.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+
+from nudgebot.db.db import get_collection
+from nudgebot.db.encoding import bson_encode
+from nudgebot.db.indexes import Index
+
+
+class StatisticsHistory(object):
+    """
+    The history of a statistics class.
+
+    Example:
+        history = StatisticsHistory(MyPrStatistics)
+        history.record({'organization': 'o', 'repository': 'r', 'issue_number': 1}, {'total_comments': 3})
+        history.query({'organization': 'o', 'repository': 'r', 'issue_number': 1}, ['total_comments'],
+                      start=datetime(2018, 1, 1), resolution=timedelta(days=1))
+        --> {'total_comments': [(datetime(2018, 4, 2), 3), ...]}
+    """
+    DATABASE_NAME = 'statistics_history'
+
+    def __init__(self, statistics_class):
+        """
+        @param statistics_class: `Statistics` subclass.
+        """
+        self.statistics_class = statistics_class
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.statistics_class.__name__)
+
+    @property
+    def db_collection(self):
+        return get_collection(self.DATABASE_NAME, self.statistics_class.COLLECTION_NAME)
+
+    def get_indexes(self):
+        """The history is queried by the primary keys and the day"""
+        keys = [(key, ASCENDING) for key in self.statistics_class.EndpointScope.primary_keys] + [('day', ASCENDING)]
+        return [Index(self.DATABASE_NAME, self.statistics_class.COLLECTION_NAME, keys)]
+
+    @staticmethod
+    def day_of(time: datetime):
+        """Return the bucket (the start of the day) of the time"""
+        return datetime(time.year, time.month, time.day)
+
+    def tracked(self, field: str):
+        """Return whether the history of the statistic is tracked, according to `HISTORY` of the statistics class"""
+        history = self.statistics_class.HISTORY
+        if field in self.statistics_class.EndpointScope.primary_keys:
+            return False
+        return history is True or (isinstance(history, (list, tuple, set)) and field in history)
+
+    def record(self, query: dict, changes: dict, time=None):
+        """
+        Append the changed statistics into the history.
+
+        @param query: `dict` The primary keys of the scope.
+        @param changes: `dict` The statistics that have changed and their new values.
+        @keyword time: `datetime` The time of the change, default is now (UTC).
+        """
+        changes = [(field, value) for field, value in changes.items() if self.tracked(field)]
+        if not changes:
+            return
+        time = time or datetime.utcnow()
+        self.db_collection.update_one(
+            dict(query, day=self.day_of(time)),
+            {'$push': {'changes': {'$each': bson_encode([[time, field, value] for field, value in changes])}},
+             '$inc': {'count': len(changes)}},
+            upsert=True
+        )
+
+    def changes(self, query: dict, fields=None, start=None, end=None):
+        """
+        Return the changes of the scope in the time range, in chronological order.
+
+        @param query: `dict` The primary keys of the scope.
+        @keyword fields: (`list` of `str`) The statistics, default is all the tracked ones.
+        @keyword start: `datetime` The start of the range (inclusive).
+        @keyword end: `datetime` The end of the range (exclusive).
+        @rtype: `list` of (`datetime`, `str`, value)
+        """
+        days = {}
+        if start:
+            days['$gte'] = self.day_of(start)
+        if end:
+            days['$lte'] = self.day_of(end)
+        db_query = dict(query, day=days) if days else dict(query)
+        changes = []
+        for doc in self.db_collection.find(db_query, {'_id': False, 'changes': True}).sort('day', ASCENDING):
+            for time, field, value in doc['changes']:
+                in_range = (start is None or time >= start) and (end is None or time < end)
+                if in_range and (fields is None or field in fields):
+                    changes.append((time, field, value))
+        changes.sort(key=lambda change: change[0])
+        return changes
+
+    def query(self, query: dict, fields=None, start=None, end=None, resolution=None):
+        """
+        Return the series of the statistics in the time range.
+
+        @param query: `dict` The primary keys of the scope.
+        @keyword fields: (`list` of `str`) The statistics, default is all the tracked ones.
+        @keyword start: `datetime` The start of the range (inclusive).
+        @keyword end: `datetime` The end of the range (exclusive).
+        @keyword resolution: `timedelta` Downsample the series, keep the last value in each interval of this length
+                             (the point time is the start of the interval).
+        @rtype: `OrderedDict` of `str` --> `list` of (`datetime`, value)
+        """
+        series = OrderedDict()
+        for time, field, value in self.changes(query, fields, start, end):
+            if resolution:
+                epoch = datetime(1970, 1, 1)
+                time = epoch + timedelta(seconds=(time - epoch) // resolution * resolution.total_seconds())
+            points = series.setdefault(field, [])
+            if points and points[-1][0] == time:
+                points[-1] = (time, value)
+            else:
+                points.append((time, value))
+        return series
@@ -0,0 +1,75 @@
+"""
+A process pool for CPU-bound statistics, see `nudgebot.statistics.base.cpu_bound_statistic`.
+
+The statistics are computed in worker processes so they don't share the GIL with the bot threads.
+The workers are started by a fork server (or spawned where it's not available) rather than forked from the bot
+process, since the bot process has threads by then (e.g. the database client monitors and the celery runner) and
+a forked child could inherit a lock that one of them holds. Each worker imports the project package first, so the
+statistics modules are imported into a set up project. As with any non-forking pool, the main script of the project
+should be guarded by `if __name__ == '__main__'` since the workers import it.
+The computation function is resolved in the worker by the path of the statistics class and the statistic name,
+and the inputs and the result are passed as pickled bytes.
+"""
+import os
+import pickle
+import multiprocessing
+from threading import Lock
+
+from nudgebot.base import Singleton
+from nudgebot.log import Loggable
+from nudgebot.settings import CurrentProject
+from nudgebot.utils.process_worker import compute_statistic, initialize_worker
+
+
+class StatisticsProcessPool(Loggable, metaclass=Singleton):
+    """
+    The process pool of the CPU-bound statistics.
+
+    Configuration (config.yaml):
+        statistics:
+          process_pool_workers: `int` The number of worker processes, default is the number of CPUs,
+                                0 means compute in the calling thread.
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self._workers = CurrentProject().config.get(
+            'config', 'statistics', 'process_pool_workers', default=os.cpu_count())
+        self._pool = None
+        self._lock = Lock()
+
+    @staticmethod
+    def _start_method():
+        return 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+    def start(self):
+        """Starting the pool, it's safe to start it from any thread."""
+        with self._lock:
+            if self._pool is None and self._workers:
+                self.logger.info(f'Starting statistics process pool with {self._workers} workers')
+                package = CurrentProject().package
+                self._pool = multiprocessing.get_context(self._start_method()).Pool(
+                    self._workers, initializer=initialize_worker, initargs=(getattr(package, '__name__', None), ))
+
+    def submit(self, statistic_path: tuple, inputs):
+        """
+        Submit the computation of a statistic.
+
+        @param statistic_path: (`str`, `str`, `str`) The module, the class qualified name and the statistic name.
+        @param inputs: The inputs of the computation function, must be picklable.
+        @return: `callable` that waits for the result and returns it.
+        """
+        payload = pickle.dumps(inputs, pickle.HIGHEST_PROTOCOL)
+        self.start()
+        if not self._pool:
+            result = compute_statistic(*statistic_path, payload)
+            return lambda: pickle.loads(result)
+        async_result = self._pool.apply_async(compute_statistic, (*statistic_path, payload))
+        return lambda: pickle.loads(async_result.get())
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
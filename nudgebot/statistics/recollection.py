@@ -0,0 +1,95 @@
+"""
+Statistics re-collection scheduler.
+
+After a task runs, the statistics of its scope should be collected again since the task could affect them.
+Several tasks may run on the same scope in a short time (e.g. multiple tasks that fire on the same pull request),
+so instead of collecting the statistics after each run, they are marked as dirty and collected once per scope
+at the end of the events batch or after a debounce window.
+The statistics are collected by the thread of the bot slave of their endpoint (which registers its wakeup event),
+the debounce timer only wakes the slave up, so the statistics are never collected concurrently with the events
+handling of the slave.
+"""
+from collections import OrderedDict
+from threading import Lock, Timer
+
+from nudgebot.base import Singleton
+from nudgebot.log import Loggable
+from nudgebot.settings import CurrentProject
+
+
+class RecollectionScheduler(Loggable, metaclass=Singleton):
+    """
+    Merges the statistics re-collection requests.
+
+    Configuration (config.yaml):
+        statistics:
+          recollect_debounce: `float` The number of seconds to wait from the first request before collecting.
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self._debounce = CurrentProject().config.get('config', 'statistics', 'recollect_debounce', default=2)
+        self._dirty = OrderedDict()  # endpoint key --> (statistics class, query) --> statistics
+        self._wakeups = {}  # endpoint key --> `threading.Event` of the slave that collects its statistics
+        self._lock = Lock()
+        self._timers = {}  # endpoint key --> `Timer`
+
+    @staticmethod
+    def _statistics_key(statistics):
+        return statistics.__class__, tuple(sorted((k, str(v)) for k, v in statistics.query.items()))
+
+    def register_wakeup(self, endpoint_key: str, event):
+        """
+        Register the wakeup event of the bot slave of the endpoint, the event is set once the debounce window of its
+        dirty statistics is over, and the slave is expected to call `flush` with its endpoint key.
+
+        @param endpoint_key: `str` The key of the endpoint.
+        @param event: `threading.Event` The wakeup event.
+        """
+        self._wakeups[endpoint_key] = event
+
+    def mark_dirty(self, statistics_list: list):
+        """
+        Mark the statistics as dirty, they will be collected once in the next flush.
+
+        @param statistics_list: (`list` of `Statistics`) The statistics to collect.
+        """
+        with self._lock:
+            for statistics in statistics_list:
+                endpoint_key = statistics.Endpoint.key
+                self._dirty.setdefault(endpoint_key, OrderedDict()).setdefault(
+                    self._statistics_key(statistics), statistics)
+                if endpoint_key not in self._timers:
+                    self._timers[endpoint_key] = Timer(self._debounce, self._on_debounce_over, (endpoint_key, ))
+                    self._timers[endpoint_key].daemon = True
+                    self._timers[endpoint_key].start()
+
+    def _on_debounce_over(self, endpoint_key: str):
+        wakeup = self._wakeups.get(endpoint_key)
+        if wakeup is not None:
+            wakeup.set()
+        else:  # No slave collects these statistics (e.g. a celery worker), collecting them here
+            self.flush(endpoint_key)
+
+    def flush(self, endpoint_key=None):
+        """
+        Collect the dirty statistics.
+
+        @keyword endpoint_key: `str` Collect only the statistics of this endpoint, default is all of them.
+        """
+        with self._lock:
+            keys = [endpoint_key] if endpoint_key else list(self._dirty)
+            dirty = []
+            for key in keys:
+                dirty.extend(self._dirty.pop(key, {}).values())
+                timer = self._timers.pop(key, None)
+                if timer:
+                    timer.cancel()
+        if dirty:
+            self.logger.info(f'Recollecting {len(dirty)} statistics')
+        for statistics in dirty:
+            try:
+                statistics.uncache_all()
+                statistics.collect()
+            except Exception:
+                self.logger.exception(f'Failed to recollect statistics: {statistics}')
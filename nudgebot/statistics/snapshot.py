@@ -0,0 +1,218 @@
+"""
+Statistics snapshots.
+
+A snapshot is a read-only in-memory view of the statistics database which is shared by all the readers in the
+process (the periodic tasks and the dashboard). The snapshot is versioned by the revisions of the statistics
+collections (see `StatisticsRevisions`), so as long as the statistics haven't changed all the readers get the same
+snapshot and each collection is loaded from the database only once, no matter how many reports are generated.
+A snapshot may be read with a read preference, e.g. the dashboard reads from the secondaries (see
+`nudgebot.db.backends.get_read_preference`) so its reads don't compete with the bot's writes on the primary.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, the columns are plain tuples without it
+    numpy = None
+
+from nudgebot.base import Singleton, AttributeDict
+from nudgebot.db.backends import get_backend
+from nudgebot.db.db import get_collection
+from nudgebot.log import Loggable
+from nudgebot.statistics.base import Statistics, StatisticsDocuments, StatisticsRevisions
+
+
+class StatisticsTable(object):
+    """
+    A read-only table of the documents of a statistics collection.
+
+    The rows are `AttributeDict`s which are shared by all the readers, so they must not be modified.
+    The columns are materialized on demand, as read-only numpy arrays if numpy is installed.
+    Example:
+        table = snapshot.github_pull_request
+        for pr_stats in table.find({'state': 'open'}):
+            ...
+        table.column('total_comments')  --> array([3, 0, 12, ...])
+    """
+
+    def __init__(self, collection_name: str, rows: tuple):
+        """
+        @param collection_name: `str` The name of the collection in the statistics database.
+        @param rows: (`tuple` of `AttributeDict`) The documents.
+        """
+        self.collection_name = collection_name
+        self._rows = rows
+        self._columns = {}
+        self._statistics = {}
+        self._lock = Lock()
+
+    def __repr__(self):
+        return '<{} {} rows={}>'.format(self.__class__.__name__, self.collection_name, len(self._rows))
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        return self._rows[index]
+
+    def find(self, query=None, projection=None):
+        """
+        Return the rows that match the query.
+        Only equality queries are evaluated in memory, queries with operators are sent to the database.
+
+        @keyword query: `dict` The query filter.
+        @keyword projection: (`list` of `str`) The fields to load, the in-memory rows already include all the fields.
+        @rtype: iterable of `AttributeDict`
+        """
+        if not query:
+            return self._rows
+        if any(isinstance(value, dict) or key.startswith('$') for key, value in query.items()):
+            return StatisticsDocuments(self.collection_name, query, projection)
+        return tuple(row for row in self._rows if all(row.get(key) == value for key, value in query.items()))
+
+    def column(self, field: str):
+        """
+        Return the values of the field in all the rows (None where it's missing).
+
+        @param field: `str` The field name.
+        @rtype: `numpy.ndarray` (read-only) if numpy is installed, otherwise `tuple`
+        """
+        with self._lock:
+            if field not in self._columns:
+                values = [row.get(field) for row in self._rows]
+                if numpy is not None:
+                    column = self._numpy_column(values)
+                    column.flags.writeable = False
+                else:
+                    column = tuple(values)
+                self._columns[field] = column
+            return self._columns[field]
+
+    @staticmethod
+    def _numpy_column(values):
+        """Return a typed array for numbers or strings, otherwise (e.g. None or lists in the values) an object array"""
+        numbers = all(isinstance(value, (int, float)) for value in values)
+        if values and (numbers or all(isinstance(value, str) for value in values)):
+            return numpy.array(values)
+        column = numpy.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            column[i] = value
+        return column
+
+    def statistics(self, statistics_class):
+        """
+        Return the rows as instances of the statistics class (see `Statistics.from_document`).
+
+        @param statistics_class: `Statistics` subclass.
+        @rtype: `tuple` of `Statistics`
+        """
+        with self._lock:
+            if statistics_class not in self._statistics:
+                self._statistics[statistics_class] = tuple(statistics_class.from_document(row) for row in self._rows)
+            return self._statistics[statistics_class]
+
+
+class StatisticsSnapshot(object):
+    """
+    A versioned read-only view of the statistics database, the collections are accessible as attributes (or items)
+    and are loaded once on first access.
+    """
+    MAX_CACHED_PAGES = 128  # Max number of pages that are kept by `statistics_page`
+
+    def __init__(self, revisions: dict, read_preference=None):
+        """
+        @param revisions: `dict` The revisions of the statistics collections that the snapshot is based on.
+        @keyword read_preference: `str` The read preference of the collections loading, default is the client's.
+        """
+        self.revisions = revisions
+        self.read_preference = read_preference
+        self.created_at = time.time()
+        self._tables = {}
+        self._pages = OrderedDict()  # (statistics class, skip, limit) --> `tuple` of `Statistics`
+        self._lock = Lock()
+
+    def __repr__(self):
+        return '<{} revisions={}>'.format(self.__class__.__name__, self.revisions)
+
+    def __getattr__(self, collection_name):
+        if collection_name.startswith('_'):
+            raise AttributeError(collection_name)
+        return self[collection_name]
+
+    def __getitem__(self, collection_name):
+        with self._lock:
+            if collection_name not in self._tables:
+                collection = get_collection(Statistics.DATABASE_NAME, collection_name, self.read_preference)
+                self._tables[collection_name] = StatisticsTable(collection_name, tuple(
+                    AttributeDict.attributize_dict(data) for data in collection.find({}, {'_id': False})))
+            return self._tables[collection_name]
+
+    def statistics_page(self, statistics_class, skip=0, limit=0):
+        """
+        Return a page of the statistics of the class (see `StatisticsTable.statistics`), in the collection order.
+        Unless the collection is loaded already, only the page is loaded from the database and instantiated, and it's
+        kept until the snapshot is replaced.
+
+        @param statistics_class: `Statistics` subclass.
+        @keyword skip: `int` Number of statistics to skip.
+        @keyword limit: `int` Max number of statistics, 0 means no limit.
+        @rtype: `tuple` of `Statistics`
+        """
+        collection_name = statistics_class.COLLECTION_NAME
+        with self._lock:
+            table = self._tables.get(collection_name)
+        if table is not None or not (skip or limit):
+            return self[collection_name].statistics(statistics_class)[skip:(skip + limit if limit else None)]
+        page_key = (statistics_class, skip, limit)
+        with self._lock:
+            if page_key in self._pages:
+                self._pages.move_to_end(page_key)
+                return self._pages[page_key]
+        collection = get_collection(Statistics.DATABASE_NAME, collection_name, self.read_preference)
+        page = tuple(statistics_class.from_document(data)
+                     for data in collection.find({}, {'_id': False}, skip=skip, limit=limit))
+        with self._lock:
+            self._pages[page_key] = page
+            if len(self._pages) > self.MAX_CACHED_PAGES:
+                self._pages.popitem(last=False)
+        return page
+
+    def keys(self):
+        """Return the names of the collections in the statistics database"""
+        return get_backend().collection_names(Statistics.DATABASE_NAME)
+
+
+class StatisticsSnapshotService(Loggable, metaclass=Singleton):
+    """
+    Provides the current statistics snapshot, a new snapshot is taken only once the statistics have changed or
+    the current one is older than `MAX_AGE` seconds.
+    """
+    MAX_AGE = 60  # seconds
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self._snapshots = {}  # read preference --> `StatisticsSnapshot`
+        self._lock = Lock()
+
+    def get(self, read_preference=None):
+        """
+        Return the current snapshot.
+
+        @keyword read_preference: `str` The read preference of the snapshot, a snapshot is kept per read preference.
+                                  note that a snapshot which is read from a secondary could lag behind the revisions.
+        @rtype: `StatisticsSnapshot`
+        """
+        revisions = StatisticsRevisions.all()
+        with self._lock:
+            snapshot = self._snapshots.get(read_preference)
+            expired = snapshot is not None and time.time() - snapshot.created_at >= self.MAX_AGE
+            if snapshot is None or snapshot.revisions != revisions or expired:
+                self.logger.debug(f'Taking statistics snapshot, revisions: {revisions}, '
+                                  f'read preference: {read_preference}')
+                snapshot = self._snapshots[read_preference] = StatisticsSnapshot(revisions, read_preference)
+            return snapshot
@@ -1,14 +1,21 @@
 from datetime import datetime
 import hashlib
+import json
+import logging
 
 from cached_property import cached_property
+from pymongo import ASCENDING
 
-from nudgebot.base import SubclassesGetterMixin, AttributeDict
+from nudgebot.base import SubclassesGetterMixin
 from nudgebot.log import Loggable
-from nudgebot.db.db import DataCollection
+from nudgebot.db.db import DataCollection, get_collection
+from nudgebot.db.indexes import Index
+from nudgebot.db.write_behind import WriteBehindBuffer
 from nudgebot.utils import underscored
-from nudgebot.statistics.base import StatisticsCollection
-from nudgebot.settings import CurrentProject
+from nudgebot.statistics.base import StatisticsCollection, StatisticsDatabase
+from nudgebot.statistics.recollection import RecollectionScheduler
+from nudgebot.statistics.snapshot import StatisticsSnapshotService
+from nudgebot.tasks.executor import TaskExecutor
 from nudgebot.thirdparty.base import EndpointScope
 
 
@@ -23,16 +30,24 @@ class TaskBase(Loggable, DataCollection, SubclassesGetterMixin):
 
     @cached_property
     def all_statistics(self):
-        """Return all the statistics database as AttributeDict"""
-        statistics_database = CurrentProject().db_client.statistics
-        collections = [getattr(statistics_database, name) for name in statistics_database.collection_names()]
-        return AttributeDict.attributize_dict({collection.name: list(collection.find()) for collection in collections})
+        """
+        Return a lazy accessor to the statistics database, each collection is loaded only once it's used.
+            e.g. self.all_statistics.<collection_name>.find(<query>, <projection>)
+
+        @rtype: `StatisticsDatabase`
+        """
+        return StatisticsDatabase()
 
     @classmethod
     def get_db_collection(cls):
         cls.COLLECTION_NAME = underscored(cls.NAME)
         return super(TaskBase, cls).get_db_collection()
 
+    @classmethod
+    def get_indexes(cls):
+        cls.COLLECTION_NAME = underscored(cls.NAME)
+        return super(TaskBase, cls).get_indexes()
+
     def run(self):
         raise NotImplementedError()
 
@@ -58,10 +73,17 @@ class ConditionalTask(TaskBase):
         * RUN_ONCE: (optional) `bool` Whether to run the task once when the condition is True.
         * ONLY_ON_CONDITION_CHANGED: (optional) `bool` run only if the condition has changed (become from False to True),
                                      default is True.
+        * RECORDS_RETENTION: (optional) `int` The number of seconds to keep the run records, default is None (forever).
+                             once a record is removed, the specific task[0] is no longer considered as done in the past.
+        * MAX_RETRIES: (optional) `int` The number of times to retry a failed run, default is 0.
+        * RETRY_BACKOFF: (optional) `float` The delay in seconds before the first retry, doubled on each retry.
     """
     EndpointScope = None  # noqa
     RUN_ONCE = True
     ONLY_ON_CONDITION_CHANGED = True
+    RECORDS_RETENTION = None
+    MAX_RETRIES = 0
+    RETRY_BACKOFF = 1
 
     def __init__(self, scope: EndpointScope, statistics, event=None):
         assert isinstance(scope, EndpointScope)
@@ -73,6 +95,29 @@ class ConditionalTask(TaskBase):
     def __repr__(self):
         return '<{} info={}'.format(self.NAME, self.query)
 
+    @classmethod
+    def get_records_collection(cls):
+        """Return the collection of the task run records, one document per task key and hash."""
+        return get_collection(cls.DATABASE_NAME, cls.records_collection_name())
+
+    @classmethod
+    def records_collection_name(cls):
+        return '{}_records'.format(underscored(cls.NAME))
+
+    @classmethod
+    def get_indexes(cls):
+        """The task documents are looked up by `key` (see `query`), the records by `task_key` and `hash`"""
+        cls.COLLECTION_NAME = underscored(cls.NAME)
+        indexes = [
+            Index(cls.DATABASE_NAME, cls.COLLECTION_NAME, [('key', ASCENDING)], unique=True),
+            Index(cls.DATABASE_NAME, cls.records_collection_name(), [('task_key', ASCENDING), ('hash', ASCENDING)],
+                  unique=True)
+        ]
+        if cls.RECORDS_RETENTION:
+            indexes.append(Index(cls.DATABASE_NAME, cls.records_collection_name(), [('datetime', ASCENDING)],
+                                 expire_after_seconds=cls.RECORDS_RETENTION))
+        return indexes
+
     @property
     def condition(self):
         raise NotImplementedError()
@@ -80,31 +125,45 @@ class ConditionalTask(TaskBase):
     def run(self):
         raise NotImplementedError()
 
-    @cached_property
-    def _statistics_queries(self):
-        """Return the statistics queries"""
-        queries = {}
-        for stats in self._statistics:
-            queries[stats.COLLECTION_NAME] = stats.query
-        return queries
-
-    def _build_db_data(self):
-        """Build the db data of the task instance"""
-        self.logger.debug('Bulding task db document.')
-        db_data = {}
-        db_data.update(self.query)
-        db_data['condition'] = False
-        db_data['records'] = []
-        self.db_collection.insert_one(db_data)
-        return db_data
+    def _load_state(self):
+        """
+        Load the state of the task (i.e. the condition) from the task database.
+
+        @rtype: `dict`
+        """
+        WriteBehindBuffer().sync(self.db_collection, self.query)
+        state = self.db_collection.find_one(self.query, {'_id': False, 'condition': True}) or {}
+        state.setdefault('condition', False)
+        return state
 
     def _add_record(self, datetime_, hash_):
-        """Adding the record of the task to the task database"""
+        """Adding the record of the task to the records collection, the run is pending until its result is reported"""
         assert isinstance(datetime_, datetime)
         assert isinstance(hash_, str)
-        record = {'datetime': datetime_, 'hash': hash_, 'artifacts': self.artifacts}
+        record = {'datetime': datetime_, 'artifacts': self.artifacts, 'status': 'pending'}
         self.logger.debug(f'Adding record: {record}')
-        self.db_collection.update_one(self.query, {'$addToSet': {'records': record}})
+        WriteBehindBuffer().update_one(self.get_records_collection(), {'task_key': self.key, 'hash': hash_},
+                                       {'$set': record, '$inc': {'runs': 1}}, upsert=True)
+
+    def report_result(self, status, attempts, error=None):
+        """
+        Report the result of the run into the task record.
+
+        @param status: `str` Either 'done' or 'failed'.
+        @param attempts: `int` The number of attempts.
+        @keyword error: `str` The error of the last attempt.
+        """
+        assert status in ('done', 'failed')
+        WriteBehindBuffer().update_one(self.get_records_collection(), {'task_key': self.key, 'hash': self.hash},
+                                       {'$set': {'status': status, 'attempts': attempts, 'error': error}})
+
+    def after_run(self):
+        """
+        Called after a successful run, we schedule the statistics to be collected again since the run could affect them.
+        see `RecollectionScheduler`.
+        """
+        self.logger.info('Scheduling statistics recollection after task run.')
+        RecollectionScheduler().mark_dirty(self._statistics)
 
     @cached_property
     def endpoint(self):
@@ -156,19 +215,101 @@ class ConditionalTask(TaskBase):
              'please check that you have overwrite correctly the `get_artifacts` method')
         return artifacts
 
+    @cached_property
+    def scope_query(self):
+        """Return the primary keys of the endpoint scope of the task instance"""
+        return dict(self._scope.query)
+
+    @cached_property
+    def scope_key(self):
+        """Return a stable hash of the scope primary keys"""
+        return hashlib.md5(json.dumps(sorted(self.scope_query.items()), default=str).encode()).hexdigest()
+
+    @classmethod
+    def get_key(cls, scope_query: dict):
+        """
+        Return the key of the task document of the scope, a stable hash of the task name and the scope primary keys.
+
+        @param scope_query: `dict` The primary keys of the endpoint scope.
+        @rtype: `str`
+        """
+        key_data = json.dumps([cls.NAME, sorted(scope_query.items())], default=str)
+        return hashlib.md5(key_data.encode()).hexdigest()
+
+    @cached_property
+    def key(self):
+        """
+        Return the key of the task document, see `get_key`.
+
+        The task document is looked up by this key only, so the lookup doesn't depend on the order of the
+        fields of an embedded document and it can use a unique index.
+        """
+        return self.get_key(self.scope_query)
+
+    @classmethod
+    def legacy_scope_query(cls, statistics_queries: dict):
+        """
+        Return the primary keys of the endpoint scope of a legacy task document from its statistics queries, i.e.
+        the queries of the statistics of the scope and its parents, or None if they don't include all of them.
+
+        @param statistics_queries: `dict` The statistics queries by collection name.
+        @rtype: `dict` or None
+        """
+        merged = {}
+        for query in statistics_queries.values():
+            merged.update(query)
+        if not all(key in merged for key in cls.EndpointScope.primary_keys):
+            return None
+        return {key: merged[key] for key in cls.EndpointScope.primary_keys}
+
+    @classmethod
+    def migrate_legacy_documents(cls):
+        """
+        Migrate the task documents of the previous formats, so the tasks that have already run don't run again:
+            * {name, statistics_queries, condition, records: [{datetime, hash, artifacts}, ...]}
+            * {key, condition, records: {<hash>: {datetime, artifacts}}}
+        The records are moved into the records collection as done runs. It's idempotent and should run before the
+        indexes are ensured, the legacy documents have no `key` so they would break its unique index.
+
+        @return: `int` The number of migrated documents.
+        """
+        collection, records_collection = cls.get_db_collection(), cls.get_records_collection()
+        migrated = 0
+        for doc in collection.find({'$or': [{'key': {'$exists': False}}, {'records': {'$exists': True}}]}):
+            if 'key' in doc:
+                key, scope_query = doc['key'], None
+                records = [dict(record, hash=hash_) for hash_, record in (doc.get('records') or {}).items()]
+            else:
+                scope_query = cls.legacy_scope_query(doc.get('statistics_queries') or {})
+                if scope_query is None:
+                    logging.getLogger(cls.__name__).warning(f'Could not migrate the legacy task document {doc["_id"]}, '
+                                                            f'its scope is unknown')
+                    continue
+                key, records = cls.get_key(scope_query), doc.get('records') or []
+            for record in records:
+                records_collection.update_one({'task_key': key, 'hash': record['hash']}, {'$setOnInsert': {
+                    'datetime': record['datetime'], 'artifacts': record.get('artifacts', []), 'status': 'done',
+                    'runs': 1}}, upsert=True)
+            if scope_query is None:
+                collection.update_one({'_id': doc['_id']}, {'$unset': {'records': ''}})
+            else:
+                collection.update_one({'key': key}, {'$setOnInsert': {
+                    'condition': doc.get('condition', False), 'name': cls.NAME, 'scope': scope_query}}, upsert=True)
+                collection.delete_one({'_id': doc['_id']})
+            migrated += 1
+        return migrated
+
     @cached_property
     def query(self):
         """Return the query of the task in the database"""
-        return {
-            'name': self.NAME,
-            'statistics_queries': self._statistics_queries
-        }
+        return {'key': self.key}
 
     @property
     def db_data(self):
-        db_data = self.db_collection.find_one(self.query, {'_id': False})
-        if not db_data:
-            db_data = self._build_db_data()
+        """Return the task document"""
+        WriteBehindBuffer().sync(self.db_collection, self.query)
+        db_data = self.db_collection.find_one(self.query, {'_id': False}) or {}
+        db_data.setdefault('condition', False)
         return db_data
 
     @property
@@ -179,13 +320,16 @@ class ConditionalTask(TaskBase):
 
     @property
     def is_done_in_the_past(self):
-        """Return whether this task has been done in the past by hash"""
-        return any(self.hash == rec['hash'] for rec in self.records)
+        """Return whether this task has been done (or is about to be done) in the past by hash"""
+        query = {'task_key': self.key, 'hash': self.hash, 'status': {'$ne': 'failed'}}
+        WriteBehindBuffer().sync(self.get_records_collection(), query)
+        return self.get_records_collection().find_one(query, {'_id': True}) is not None
 
     @property
     def records(self):
         """Return the task records in the databse"""
-        return self.db_data['records']
+        WriteBehindBuffer().sync(self.get_records_collection(), {'task_key': self.key})
+        return list(self.get_records_collection().find({'task_key': self.key}, {'_id': False, 'task_key': False}))
 
     def handle(self):
         """
@@ -193,28 +337,29 @@ class ConditionalTask(TaskBase):
 
         Evaluating the condition, if the condition is True it's running the task as long as `RUN_ONCE` is False,
         if `ONLY_ON_CONDITION_CHANGED` is True it'll run only if the condition changed from False to True.
-        After task has run, we store its record in the databse and we uncache the statistics and collect them again,
-        that because the task could affect them.
-
-        @todo: Wrap the task through exception and prompt the bot administrator about the failure.
+        The run itself is submitted to the `TaskExecutor`, we store its record in the database as pending and the executor
+        reports the result into it. after a successful run we schedule the statistics to be collected again,
+        that because the task could affect them (see `after_run`).
+        The task state is read once and written once (atomically) per handle, the done check is a single
+        indexed query on the records collection. The writes are buffered and written in batches, see
+        `nudgebot.db.write_behind`.
+
+        @todo: Prompt the bot administrator about failures.
         """
-        db_data = self.db_data
         self.logger.info(f'Checking task condition: {self}')
         condition = self.condition
         self.logger.info(f'Condition is {condition}')
-        condition_changed = (False if not self.ONLY_ON_CONDITION_CHANGED else db_data['condition'] != condition)
+        state = self._load_state()
+        condition_changed = (False if not self.ONLY_ON_CONDITION_CHANGED else state['condition'] != condition)
+        update = {
+            '$set': {'condition': condition},
+            '$setOnInsert': {'name': self.NAME, 'scope': self.scope_query}
+        }
         if condition and (not self.RUN_ONCE or (condition_changed and not self.is_done_in_the_past)):  # False --> True
-            self.logger.info(f'Running task: {self}')
-            self.run()
+            self.logger.info(f'Submitting task: {self}')
             self._add_record(datetime.utcnow(), self.hash)
-            self.logger.debug('Run done.')
-            # recollecting all the statistics
-            self.logger.info('Recollecting statistics after task run.')
-            for stats in self._statistics:
-                stats.uncache_all()
-                stats.collect()
-        db_data['condition'] = condition
-        self.db_collection.update_one(self.query, {'$set': db_data})
+            TaskExecutor().submit(self)
+        WriteBehindBuffer().update_one(self.db_collection, self.query, update, upsert=True)
 
 
 class PeriodicTask(TaskBase):
@@ -222,16 +367,37 @@ class PeriodicTask(TaskBase):
     A periodic task.
 
     A periodic task is running as a crontab task.
-    Each time the crontab is triggering the task, ALL the statistics are being collected from the statistics database
-    and passed as AttributeDict into the `run` function. each statistics is plural and that means that for
-    each statistics key we get all the instances, i.e.
-        statistics.<statistics_key>[<index>].<statistic>
+    Each time the crontab is triggering the task, the statistics database is accessible via `all_statistics`.
+    each statistics collection is plural and that means that for each collection we get all the documents, i.e.
+        self.all_statistics.<collection_name>[<index>].<statistic>
+        self.all_statistics.<collection_name>.find(<query>)
+    `all_statistics` is a read-only snapshot which is shared by all the periodic tasks (and the dashboard) until the
+    statistics change, see `nudgebot.statistics.snapshot`.
 
     Should be defined in subclass:
         * Name: `str` The name of the task.
         * CRONTAB: `celery.schedule.crontab` The crontab of the periodic task.
+    Optional to define in subclass:
+        * MAX_CONCURRENCY: `int` Max number of overlapping runs, i.e. a tick is skipped if that number of runs are
+                           still running. 0 means unlimited. Default is 1 (no overlap).
+        * CATCH_UP: `bool` Whether to run once on startup in case that ticks were missed while the bot was down.
+        * LEASE_TIMEOUT: `int` Seconds after which a run is considered dead (e.g. its worker has crashed) and it
+                         doesn't count for `MAX_CONCURRENCY` anymore.
+    The runs are dispatched by `nudgebot.tasks.periodic.PeriodicTasksRegistry`.
     """
     CRONTAB = None
+    MAX_CONCURRENCY = 1
+    CATCH_UP = False
+    LEASE_TIMEOUT = 60 * 60
+
+    @cached_property
+    def all_statistics(self):
+        """
+        Return the current statistics snapshot.
+
+        @rtype: `StatisticsSnapshot`
+        """
+        return StatisticsSnapshotService().get()
 
     def run(self):
         raise NotImplementedError()
@@ -0,0 +1,145 @@
+"""
+The tasks executor.
+
+The conditions of the tasks are evaluated inline by the bot slaves, but the actions (i.e. `run()`) are sent to the
+executor, so a slow action doesn't block the events that are queued behind it.
+"""
+import time
+from collections import deque
+from queue import Queue
+from threading import Lock, BoundedSemaphore
+
+from nudgebot.base import Singleton, Thread
+from nudgebot.log import Loggable
+from nudgebot.settings import CurrentProject
+
+
+class TaskExecutorWorker(Thread):
+    """A worker thread of the tasks executor"""
+
+    def __init__(self, executor, index):
+        Thread.__init__(self)
+        self.name = f'{self.__class__.__name__}-{index}'
+        self._executor = executor
+
+    def run(self):
+        self._executor.work()
+
+
+class TaskExecutor(Loggable, metaclass=Singleton):
+    """
+    Runs the tasks actions in a bounded pool of worker threads.
+
+    * The runs of the same scope are serialized, i.e. a task run starts only once the previous runs of tasks with
+      the same scope have finished, in the order of submission.
+    * A failed run is retried `MAX_RETRIES` times (as defined in the task) with exponential backoff starting from
+      `RETRY_BACKOFF` seconds.
+    * The result of the run (status, number of attempts and error) is reported back into the task record.
+
+    Configuration (config.yaml):
+        tasks:
+          executor:
+            workers: `int` The number of worker threads, 0 means run the tasks inline.
+            max_pending: `int` Max number of submitted runs that have not finished yet, `submit` blocks once it's reached.
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        config = CurrentProject().config
+        self._workers_count = config.get('config', 'tasks', 'executor', 'workers', default=4)
+        self._pending = BoundedSemaphore(config.get('config', 'tasks', 'executor', 'max_pending', default=1000))
+        self._queue = Queue()
+        self._lanes = {}  # scope key --> deque of the tasks that wait for the running one
+        self._lanes_lock = Lock()
+        self._workers = []
+
+    @property
+    def is_async(self):
+        return self._workers_count > 0
+
+    def start(self):
+        """Starting the workers, called automatically on the first submission."""
+        for i in range(self._workers_count):
+            worker = TaskExecutorWorker(self, i)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, task):
+        """
+        Submit a task run.
+
+        @param task: `ConditionalTask` The task to run.
+        """
+        if not self.is_async:
+            self.execute(task)
+            return
+        with self._lanes_lock:
+            if not self._workers:
+                self.start()
+        self._pending.acquire()
+        with self._lanes_lock:
+            if task.scope_key in self._lanes:
+                self.logger.debug(f'Scope is busy, {task} waits for its turn.')
+                self._lanes[task.scope_key].append(task)
+                return
+            self._lanes[task.scope_key] = deque()
+        self._queue.put(task)
+
+    def work(self):
+        """The workers loop, running the task and then the tasks that wait in its lane."""
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            while task:
+                try:
+                    self.execute(task)
+                except Exception:  # e.g. reporting the result or `after_run` failed, the worker must survive it
+                    self.logger.exception(f'Task execution failed: {task}')
+                finally:
+                    self._pending.release()
+                    task = self._next_in_lane(task)
+
+    def _next_in_lane(self, task):
+        """Return the next task that waits in the lane of the task, the lane is removed once it's empty"""
+        with self._lanes_lock:
+            lane = self._lanes[task.scope_key]
+            if lane:
+                return lane.popleft()
+            del self._lanes[task.scope_key]
+
+    def execute(self, task):
+        """
+        Run the task with retries and report the result.
+
+        @param task: `ConditionalTask` The task to run.
+        @return: `bool` Whether the run succeeded.
+        """
+        attempts = task.MAX_RETRIES + 1
+        for attempt in range(1, attempts + 1):
+            try:
+                self.logger.info(f'Running task: {task} (attempt {attempt}/{attempts})')
+                task.run()
+            except Exception as err:
+                self.logger.exception(f'Task run failed: {task}')
+                if attempt == attempts:
+                    task.report_result('failed', attempt, error=repr(err))
+                    return False
+                time.sleep(task.RETRY_BACKOFF * 2 ** (attempt - 1))
+            else:
+                task.report_result('done', attempt)
+                task.after_run()
+                return True
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once the submitted runs are done.
+
+        @keyword wait: `bool` Whether to wait for the workers to finish.
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+        self._workers = []
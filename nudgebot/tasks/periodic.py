@@ -0,0 +1,139 @@
+"""
+The periodic tasks dispatching.
+
+Celery beat sends a message for each crontab tick, the messages are dispatched here by the task name through a
+registry that's built once. The schedule state of each task (last run and the running leases) is kept in the
+metadata database, so:
+    * Stale messages (e.g. left in the queue while the bot was down) are skipped instead of purging the queue.
+    * Duplicate messages of the same tick are skipped, only the first one that arrives runs.
+    * The number of overlapping runs of a task is limited by `PeriodicTask.MAX_CONCURRENCY`.
+"""
+import uuid
+from datetime import timedelta, timezone
+
+from pymongo import ASCENDING, ReturnDocument
+
+from nudgebot.base import Singleton
+from nudgebot.db.db import DataCollection
+from nudgebot.db.indexes import Index
+from nudgebot.log import Loggable
+from nudgebot.settings import CurrentProject
+from nudgebot.tasks.base import PeriodicTask
+
+
+class PeriodicTaskState(DataCollection):
+    """
+    The schedule state of the periodic tasks, a document per task:
+        {'name': <task name>, 'last_run': <datetime>, 'leases': [{'id': <str>, 'expires': <datetime>}, ...]}
+    """
+    DATABASE_NAME = 'metadata'
+    COLLECTION_NAME = 'periodic_tasks'
+
+    @classmethod
+    def get_indexes(cls):
+        return [Index(cls.DATABASE_NAME, cls.COLLECTION_NAME, [('name', ASCENDING)], unique=True)]
+
+    @classmethod
+    def get(cls, name: str) -> dict:
+        """Return the state of the task, creating it if it doesn't exist"""
+        return cls.get_db_collection().find_one_and_update(
+            {'name': name}, {'$setOnInsert': {'last_run': None, 'leases': []}},
+            projection={'_id': False}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+
+    @staticmethod
+    def now(task_class):
+        """
+        Return the current time by the clock of the crontab of the task (so a crontab with `nowfun` controls both),
+        as a naive UTC datetime like the datetimes that are read from the database.
+        """
+        now = task_class.CRONTAB.maybe_make_aware(task_class.CRONTAB.now())
+        return now.astimezone(timezone.utc).replace(tzinfo=None)
+
+    @classmethod
+    def acquire(cls, task_class, last_run):
+        """
+        Acquire a running lease for the task.
+        The lease is acquired only if the last run hasn't changed since the state has been read (otherwise another
+        message of this tick already took it) and the number of running leases is below `MAX_CONCURRENCY`.
+
+        @param task_class: `PeriodicTask` subclass.
+        @param last_run: `datetime` The last run as read from the state.
+        @return: `str` The lease id, or None if not acquired.
+        """
+        now = cls.now(task_class)
+        collection = cls.get_db_collection()
+        collection.update_one({'name': task_class.__name__}, {'$pull': {'leases': {'expires': {'$lt': now}}}})
+        lease_id = uuid.uuid4().hex
+        query = {'name': task_class.__name__, 'last_run': last_run}
+        if task_class.MAX_CONCURRENCY:
+            query[f'leases.{task_class.MAX_CONCURRENCY - 1}'] = {'$exists': False}
+        lease = {'id': lease_id, 'expires': now + timedelta(seconds=task_class.LEASE_TIMEOUT)}
+        if collection.update_one(query, {'$set': {'last_run': now}, '$push': {'leases': lease}}).modified_count:
+            return lease_id
+
+    @classmethod
+    def release(cls, name: str, lease_id: str):
+        """Release a running lease of the task"""
+        cls.get_db_collection().update_one({'name': name}, {'$pull': {'leases': {'id': lease_id}}})
+
+
+class PeriodicTasksRegistry(Loggable, metaclass=Singleton):
+    """
+    The registry of the periodic tasks of the project, maps the task class name to the task class.
+
+    Example:
+        PeriodicTasksRegistry().dispatch('DailyReport')
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self._tasks = {task_class.__name__: task_class for task_class in CurrentProject().TASKS
+                       if issubclass(task_class, PeriodicTask)}
+
+    def __iter__(self):
+        return iter(self._tasks.values())
+
+    def __getitem__(self, name):
+        return self._tasks[name]
+
+    @staticmethod
+    def is_due(task_class, last_run):
+        """Return whether a crontab tick has passed since the last run"""
+        return last_run is None or task_class.CRONTAB.is_due(last_run)[0]
+
+    def missed(self):
+        """
+        Return the tasks that should catch up, i.e. `CATCH_UP` is set and a tick was missed since the last run.
+
+        @rtype: `list` of `PeriodicTask` subclasses.
+        """
+        missed = []
+        for task_class in self:
+            if task_class.CATCH_UP:
+                last_run = PeriodicTaskState.get(task_class.__name__)['last_run']
+                if last_run is not None and self.is_due(task_class, last_run):
+                    missed.append(task_class)
+        return missed
+
+    def dispatch(self, name: str):
+        """
+        Run the periodic task once per crontab tick and within its concurrency limit.
+
+        @param name: `str` The name of the task class.
+        @return: `bool` Whether the task has run.
+        """
+        task_class = self[name]
+        last_run = PeriodicTaskState.get(name)['last_run']
+        if not self.is_due(task_class, last_run):
+            self.logger.info(f'Skipping periodic task {name}: already run at {last_run}')
+            return False
+        lease_id = PeriodicTaskState.acquire(task_class, last_run)
+        if not lease_id:
+            self.logger.info(f'Skipping periodic task {name}: already running or taken by another worker')
+            return False
+        try:
+            task_class().handle()
+        finally:
+            PeriodicTaskState.release(name, lease_id)
+        return True
@@ -3,10 +3,12 @@ Thirdparty module includes the interfaces for the third party.
 
 Each implemented third party module should implement these classes.
 """
+import hashlib
+import importlib
+import json
 import time
-from threading import Lock
+from threading import Event as ThreadingEvent, Lock
 
-from wait_for import wait_for
 from cached_property import cached_property
 
 from nudgebot.base import SubclassesGetterMixin, Singleton, Thread
@@ -201,6 +203,36 @@ class Event(SubclassesGetterMixin):
         """Return the endpoint of the event."""
         return self.Endpoint
 
+    def to_message(self) -> dict:
+        """
+        Return a serializable (JSON) representation of the event, used to send the event to another process.
+
+        @see: `from_message`
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def from_message(message: dict):
+        """
+        Build the event from its message.
+
+        @param message: `dict` The message, as returned by `to_message`, it should include the event class
+                        path in 'event_class'.
+        @rtype: `Event`
+        """
+        module_name, class_name = message['event_class'].rsplit('.', 1)
+        event_class = getattr(importlib.import_module(module_name), class_name)
+        return event_class.build_from_message(message)
+
+    @classmethod
+    def build_from_message(cls, message: dict):
+        """Instantiate the event from its message, see `from_message`"""
+        raise NotImplementedError()
+
+    @classmethod
+    def class_path(cls):
+        return '{}.{}'.format(cls.__module__, cls.__name__)
+
     @classmethod
     def hash_by_id(cls, event_id):
         """Return the hash for the event using ID only"""
@@ -220,6 +252,8 @@ class EventsFactory(Loggable, Thread, metaclass=Singleton):
     Every X seconds interval (`_check_for_new_events_interval`) it calls to `build_events` which responsible to get
     new data, classify the events and store them in the events buffer.
     Each time the parent is calling to `pull_event`, it's popping the first event in the buffer and return it.
+    A push based factory (e.g. one that's fed by a connection) overwrites `run` and calls `add_events` as soon as
+    events arrive, `new_events` is set whenever events are added so the bot slave wakes up immediately.
 
     Should be defined in subclass:
         * Endpoint: `Endpoint` The events factory's endpoint.
@@ -227,7 +261,8 @@ class EventsFactory(Loggable, Thread, metaclass=Singleton):
 
     Endpoint: Endpoint = None
     _dilivered_events_stack = CachedStack('delivered_events',
-                                          length=CurrentProject().config.config.events.delivered_stack_length)
+                                          length=CurrentProject().config.config.events.delivered_stack_length,
+                                          write_behind=True)
     _check_for_new_events_interval = CurrentProject().config.config.events.check_interval
 
     def __init__(self):
@@ -235,6 +270,7 @@ class EventsFactory(Loggable, Thread, metaclass=Singleton):
         Loggable.__init__(self)
         self._events_buffer = []
         self._buffer_buisy_mutex = Lock()
+        self.new_events = ThreadingEvent()
 
     def __repr__(self):
         return f'<Events factory {self.__class__.__name__}>'
@@ -255,11 +291,17 @@ class EventsFactory(Loggable, Thread, metaclass=Singleton):
         events = self.build_events()
         if not events:
             self.logger.debug('No new events.')
+        self.add_events(events)
+
+    def add_events(self, events: list):
+        """Push the events into the events buffer and wake up the bot slave"""
         for event in events:
             self.logger.info('A new event has been detected: {}'.format(event))
             self._buffer_buisy_mutex.acquire()
             self._events_buffer.append(event)
             self._buffer_buisy_mutex.release()
+        if events:
+            self.new_events.set()
 
     def pull_event(self):
         """
@@ -317,12 +359,16 @@ class BotSlave(Thread):
         * Endpoint: `Endpoint` The bot's endpoint.
         * EventsFactory: `EventsFactory` The bot's events factory.
         * ScopeCollector (Optional): `ScopeCollector` In case that the bot is pollable you should provide this.
+        * DISTRIBUTABLE (Optional): `bool` Whether the events could be handled by celery workers in other processes,
+                                    i.e. the events are serializable (see `Event.to_message`) and the tasks don't depend
+                                    on a state of this process (like a connection), default is False.
 
     """
 
     Endpoint: Endpoint = None
     EventsFactory = None
     ScopeCollector = None
+    DISTRIBUTABLE = False
     handle_events_every = 10  # The timeout between the events handling, optional to overwrite.
 
     def __init__(self, statistics: list, tasks: list):
@@ -338,6 +384,7 @@ class BotSlave(Thread):
         self._statistics = statistics
         self._tasks = tasks
         self._busy_mutext = Lock()
+        self._stopped = ThreadingEvent()
 
     def __repr__(self):
         return f'<Bot slave {self.__class__.__name__}>'
@@ -366,6 +413,7 @@ class BotSlave(Thread):
         If the bot is pollable, performing a poll, collecting all the scopes from the scopes collectors,
         updating statistics and handling tasks.
         """
+        from nudgebot.statistics.recollection import RecollectionScheduler
         if not self.pollable:
             self.logger.warning('Poll has been triggered but the bot is not pollable! Return;')
             return
@@ -385,38 +433,72 @@ class BotSlave(Thread):
                 for task_cls in self.get_conditional_tasks(scope):
                     task = task_cls(scope, stats_collection)
                     task.handle()
+            RecollectionScheduler().flush(self.Endpoint.key)
 
             self.logger.info('Finished poll')
 
         finally:
             self._busy_mutext.release()
 
+    @property
+    def distributed(self):
+        """Return whether the events of this bot are handled by the celery workers (see `dispatch_event`)"""
+        return self.DISTRIBUTABLE and CurrentProject().config.get('config', 'distributed', 'enabled', default=False)
+
+    def event_queue(self, event):
+        """
+        Return the name of the celery queue of the event.
+
+        The event is routed by a hash of its scope primary keys, hence the events of the same scope always get into
+        the same queue, and as long as each queue is consumed by a single worker process they are handled in order.
+        """
+        queues = CurrentProject().config.get('config', 'distributed', 'queues', default=1)
+        scope_keys = json.dumps([event.data[k] for k in event.EndpointScope.primary_keys], default=str)
+        return 'nudgebot.scopes.{}'.format(int(hashlib.md5(scope_keys.encode()).hexdigest(), 16) % queues)
+
+    def dispatch_event(self, event):
+        """Publishing the event to the celery queue of its scope, it'll be handled by a worker (see `handle_event`)"""
+        from nudgebot.celery_runner import handle_event
+        queue = self.event_queue(event)
+        self.logger.debug(f'Dispatching event {event} to queue {queue}')
+        handle_event.apply_async((self.Endpoint.key, event.to_message()), queue=queue, routing_key=queue)
+
+    def handle_event(self, event):
+        """Collecting the statistics of the event scope and handling the tasks"""
+        self.logger.debug('Handling new event: {}'.format(event.id))
+        event_endpoint_scope_classes = event.EndpointScope.get_static_hierarchy()
+        stat_collection = []
+        for statistics_cls in self._statistics:
+            if statistics_cls.EndpointScope in event_endpoint_scope_classes:
+                statistics = statistics_cls.init_by_event(event)
+                self.logger.debug(f'Collecting statistics: {statistics}')
+                stat_collection.append(statistics)
+                statistics.collect()
+        self.logger.debug('Checking for tasks to run')
+        for task_cls in self.get_conditional_tasks():
+            if task_cls.EndpointScope in event_endpoint_scope_classes:
+                task_endpoint_scope_classes = task_cls.EndpointScope.get_static_hierarchy()
+                statistics = []
+                for stats in stat_collection:
+                    if stats.Endpoint == task_cls.Endpoint and stats.EndpointScope in task_endpoint_scope_classes:
+                        statistics.append(stats)
+                task = task_cls(event.EndpointScope.init_by_event(event), statistics, event)
+                task.handle()
+
     def handle_events(self):
-        """Pulling new events from the event factory, collecting statistics and handling tasks"""
+        """Pulling new events from the event factory and handle them (or dispatch them in distributed mode)"""
+        from nudgebot.statistics.recollection import RecollectionScheduler
         self._busy_mutext.acquire()
         try:
             event = self.EventsFactory.pull_event()
             while event:
-                self.logger.debug('Handling new event: {}'.format(event.id))
-                event_endpoint_scope_classes = event.EndpointScope.get_static_hierarchy()
-                stat_collection = []
-                for statistics_cls in self._statistics:
-                    if statistics_cls.EndpointScope in event_endpoint_scope_classes:
-                        statistics = statistics_cls.init_by_event(event)
-                        self.logger.debug(f'Collecting statistics: {statistics}')
-                        stat_collection.append(statistics)
-                        statistics.collect()
-                self.logger.debug('Checking for tasks to run')
-                for task_cls in self.get_conditional_tasks():
-                    if task_cls.EndpointScope in event_endpoint_scope_classes:
-                        task_endpoint_scope_classes = task_cls.EndpointScope.get_static_hierarchy()
-                        statistics = []
-                        for stats in stat_collection:
-                            if stats.Endpoint == task_cls.Endpoint and stats.EndpointScope in task_endpoint_scope_classes:
-                                statistics.append(stats)
-                        task = task_cls(event.EndpointScope.init_by_event(event), statistics, event)
-                        task.handle()
+                if self.distributed:
+                    self.dispatch_event(event)
+                else:
+                    self.handle_event(event)
                 event = self.EventsFactory.pull_event()
+            # Collecting the statistics that the tasks of this events batch affected, once per scope.
+            RecollectionScheduler().flush(self.Endpoint.key)
         finally:
             self._busy_mutext.release()
 
@@ -428,15 +510,25 @@ class BotSlave(Thread):
 
         @param poll_first: `bool` Whether to poll first or not.
         """
+        from nudgebot.statistics.recollection import RecollectionScheduler
+        # The recollections of the statistics of this endpoint are done in this thread, see `handle_events`
+        RecollectionScheduler().register_wakeup(self.Endpoint.key, self.EventsFactory.new_events)
         if self.pollable:
             self.poll()
         if not self.EventsFactory.is_alive():
             self.EventsFactory.start()
-        while True:
+        while not self._stopped.is_set():
             if not self.EventsFactory.is_alive():
                 self.logger.error(f'{self} events factory has died..')
                 raise SubThreadException(self.EventsFactory)
             update_start_time = time.time()
+            # Clearing before handling, so a wakeup that arrives during the handling isn't lost
+            self.EventsFactory.new_events.clear()
             self.handle_events()
-            wait_for(lambda: time.time() - update_start_time > self.handle_events_every and not self._busy_mutext.locked(),
-                     logger=self.logger, message='Waiting for work timeout to finish.')
+            # Waking up once new events arrive, or after `handle_events_every` at the latest
+            self.EventsFactory.new_events.wait(max(0, self.handle_events_every - (time.time() - update_start_time)))
+
+    def stop(self):
+        """Stop the main loop once the current events handling is done"""
+        self._stopped.set()
+        self.EventsFactory.new_events.set()
@@ -12,15 +12,63 @@ class GithubEventBase(Event):
     """A base class for Github event."""
     Endpoint = Github()
 
-    def __init__(self, data: dict, artifacts: dict):
+    def __init__(self, data: dict, artifacts: dict, artifacts_refs: dict = None):
+        """
+        @param data: `dict` The event data.
+        @param artifacts: `dict` The event artifacts, see `nudgebot.thirdparty.github.event.Event.artifacts`.
+        @keyword artifacts_refs: `dict` The references of the artifacts (as returned by `artifacts_refs`), used to
+                                 fetch the artifacts lazily in case that they are not provided.
+        """
         assert isinstance(data, dict)
         self._data = data
         self._artifacts = artifacts
+        self._artifacts_refs = artifacts_refs
 
     @property
     def artifacts(self) -> dict:
+        if self._artifacts is None and self._artifacts_refs is not None:
+            self._artifacts = self._fetch_artifacts(self._artifacts_refs)
         return self._artifacts
 
+    @property
+    def artifacts_refs(self) -> dict:
+        """Return the references of the artifacts, i.e. the minimal data required in order to fetch them again."""
+        if self._artifacts_refs is not None:
+            return self._artifacts_refs
+        refs = {}
+        artifacts = self._artifacts or {}
+        if artifacts.get('actor'):
+            refs['actor'] = artifacts['actor'].login
+        if artifacts.get('issue'):
+            refs['issue'] = {'number': artifacts['issue'].number,
+                             'pull_request': isinstance(artifacts['issue'], PullRequest)}
+        if artifacts.get('comment'):
+            refs['comment'] = artifacts['comment'].id
+        return refs
+
+    def _fetch_artifacts(self, refs: dict) -> dict:
+        """Fetch the artifacts by their references"""
+        repo = Repository.init_by_keys(organization=self._data['organization'], repository=self._data['repository'])
+        artifacts = {'org': repo.parent, 'repo': repo}
+        if 'actor' in refs:
+            artifacts['actor'] = self.Endpoint.client.get_user(refs['actor'])
+        if 'issue' in refs:
+            number = refs['issue']['number']
+            issue = artifacts['issue'] = (repo.get_pull(number) if refs['issue']['pull_request'] else repo.get_issue(number))
+            if 'comment' in refs:
+                try:
+                    artifacts['comment'] = issue.get_issue_comment(refs['comment'])
+                except UnknownObjectException:
+                    pass  # Happens when the comment is deleted.
+        return artifacts
+
+    def to_message(self) -> dict:
+        return {'event_class': self.class_path(), 'data': self._data, 'artifacts_refs': self.artifacts_refs}
+
+    @classmethod
+    def build_from_message(cls, message: dict):
+        return cls(message['data'], None, artifacts_refs=message['artifacts_refs'])
+
     @property
     def type(self):
         return self.data['type']
@@ -127,3 +175,4 @@ class GithubBot(BotSlave):
     Endpoint = Github()
     EventsFactory = GithubEventsFactory()
     ScopeCollector = GithubScopesCollector()
+    DISTRIBUTABLE = True
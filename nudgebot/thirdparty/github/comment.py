@@ -1,12 +1,10 @@
-import re
-
 from cached_property import cached_property
 from github.IssueComment import IssueComment as PyGithubIssueComment
 from github.PullRequestComment import PullRequestComment as PyGithubPullRequestComment
-from github.GithubException import UnknownObjectException
 
 from nudgebot.thirdparty.base import APIclass
 from nudgebot.thirdparty.github.base import PyGithubObjectWrapper
+from nudgebot.thirdparty.mentions import MentionResolver
 
 
 class Comment(PyGithubObjectWrapper, APIclass):
@@ -15,15 +13,10 @@ class Comment(PyGithubObjectWrapper, APIclass):
     @cached_property
     def mentioned_users(self):
         """
-        Return a list of the mentioned users in this comment.
+        Return a list of the mentioned users in this comment, the configured users are resolved without API calls
+        (see `MentionResolver`).
             e.g. '@octocat hello world!' --> [NamedUser(login="octocat")]
 
         @rtype: (`list` of `User`) The list of the mentioned users.
         """
-        mentioned_users = []
-        for login in set(re.findall(r' @([\-\w\d_]+)', ' ' + self.body)):
-            try:
-                mentioned_users.append(self.Endpoint.client.get_user(login))
-            except UnknownObjectException:
-                pass
-        return mentioned_users
+        return MentionResolver().github_mentions(self.body)
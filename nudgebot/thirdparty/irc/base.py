@@ -1,14 +1,19 @@
-import re
+import socket
+import selectors
+from collections import deque
+from functools import partial
+from threading import Condition, Lock, current_thread
+from types import MethodType, FunctionType
 
-from nudgebot.log import Loggable
 from cached_property import cached_property
 
-import socket
-from types import MethodType, FunctionType
-from threading import RLock
-import logging
-from nudgebot.utils import RunEvery
+from nudgebot.base import Thread
+from nudgebot.log import Loggable
 from nudgebot.thirdparty.base import Endpoint
+from nudgebot.thirdparty.irc.outbound import MAX_LINE_BYTES, PREFIX_RESERVE, OutboundQueue, split_message
+from nudgebot.thirdparty.irc.protocol import (LineBuffer, NICK_IN_USE_REPLIES, RPL_WELCOME, irc_lower,
+                                              parse_line)
+from nudgebot.thirdparty.mentions import MentionMatcher
 
 
 class required_connection(object):
@@ -18,134 +23,304 @@ class required_connection(object):
         self._method = method
 
     def __get__(self, obj, cls):
-        self._cls = cls
-        self._obj = obj
-        return self
+        if obj is None:
+            return self
+        return partial(self, obj)
 
-    def __call__(self, *args, **kwargs):
-        if not self._obj.is_connected():
+    def __call__(self, obj, *args, **kwargs):
+        if not obj.is_connected():
             raise Exception('You must connect first before running this function')
-        return self._method(self._obj, *args, **kwargs)
+        return self._method(obj, *args, **kwargs)
+
+
+class IRCioThread(Thread):
+    """The I/O thread of an IRC client, see `IRCclient.io_loop`"""
+
+    def __init__(self, client):
+        Thread.__init__(self)
+        self._client = client
+
+    def run(self):
+        self._client.io_loop()
 
 
 class IRCclient(Loggable):
     """
     An IRC Client.
 
+    The socket is non-blocking and is served by a selector loop in the client's I/O thread (`io_loop`), the reads
+    and the writes are separated:
+        * The read path splits the received bytes into lines (on '\r\n'), parses them (see
+          `nudgebot.thirdparty.irc.protocol`) and calls the line callbacks (see `add_line_callback`) from the I/O
+          thread as soon as each line arrives.
+        * The write path (`raw_send`) only appends to the outbound buffer and wakes the loop, which writes it once
+          the socket is writable, so sending never waits behind a read.
+        * The messages (`msg`, `notice`) are queued in the outbound queue, which releases them into the outbound
+          buffer as fast as the flood control allows, see `nudgebot.thirdparty.irc.outbound`.
+    The client answers the server PINGs, picks another nick if its nick is in use and joins the channels once it's
+    registered (RPL_WELCOME).
+
+    The client is a single connection, the endpoint uses a pool of them (see `nudgebot.thirdparty.irc.pool`).
+
     Example:
         client = IRCclient('chat.freenode.net', 'Nudgebot')
+        client.add_line_callback(lambda message: print(message.nick, message.command, message.params))
         client.connect()
         client.join('##bot-testing')
         client.msg('##bot-testing', 'Hello all')
-
-    @todo: Support servers with password.
     """
 
-    READ_TIMEOUT = 1  # seconds
-    PONG_SERVER_TIMER = 60  # seconds
-    _line_splitter = r'\r\n'
-    _max_msg_length = 256  # The max message length in characters
+    CONNECT_TIMEOUT = 30  # seconds
+    RECV_SIZE = 4096  # bytes
+    MAX_PENDING_LINES = 10000  # Max number of received lines that are kept for `read_lines`
+    _encoding = 'utf-8'
 
-    def __init__(self, server: str, nick: str, port=6667):
+    def __init__(self, server: str, nick: str, port=6667, flood_control=None, password=None, mention_nicks=None):
+        """
+        @param server: `str` The server host.
+        @param nick: `str` The nick of the bot.
+        @keyword port: `int` The server port.
+        @keyword password: `str` The server password.
+        @keyword mention_nicks: (`list` of `str`) More nicks that count as mentions of the client (see `mentions_me`),
+                                e.g. the main nick of the bot when this connection uses another one.
+        @keyword flood_control: `dict` The keyword arguments of the `OutboundQueue` (rate, burst, target_rate,
+                                target_burst, coalesce).
+        """
         assert isinstance(server, str), f'server must be an `str`, got {server}'
         assert isinstance(nick, str), f'nick must be an `str`, got {nick}'
         Loggable.__init__(self)
-        self._ircsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._ircsock.settimeout(self.READ_TIMEOUT)
+        self._ircsock = None
         self._server = server
+        self._port = port
         self._nick = nick
+        self._password = password
+        self._mention_nicks = list(mention_nicks or [])
+        self._mention_matcher = (None, None)  # (<nick>, `MentionMatcher`), recompiled once the nick changes
         self._connected = False
-        self._io_mutex = RLock()
-        self._pong_server_timer = RunEvery(self.PONG_SERVER_TIMER, self.pong_server)
+        self._selector = None
+        self._waker_r, self._waker_w = None, None
+        self._line_buffer = LineBuffer(self._encoding)
+        self._registered = False
+        self._state_lock = Lock()
+        self._outbound = bytearray()
+        self._written_head = bytearray()  # The written bytes of the line that's partially written
+        self._outbound_lock = Lock()
+        self._outbound_queue = OutboundQueue(**(flood_control or {}))
+        self._lines = deque(maxlen=self.MAX_PENDING_LINES)
+        self._lines_condition = Condition()
+        self._line_callbacks = []
+        self._io_thread = None
         self._channels = []
 
-    def _split_data(self, msg: str):
+    def max_text_bytes(self, target: str, command='PRIVMSG'):
+        """Return the max length in bytes of a message text to the target, so the relayed line fits in 512 bytes"""
+        return MAX_LINE_BYTES - PREFIX_RESERVE - len(f'{command} {target} :\r\n'.encode(self._encoding))
+
+    def _split_data(self, msg: str, target: str, command='PRIVMSG'):
         """
-        This is in order to prevent flood.
+        Split the message into lines that fit in an IRC line, this is in order to prevent flood.
 
-        @param data: `str` The data.
+        @param msg: `str` The message.
+        @param target: `str` The channel or nick.
         @see: https://www.quakenet.org/help/general/what-do-those-quit-messages-mean
         """
         assert isinstance(msg, str)
-        lines = [ln for ln in msg.split('\n')]
-        chunks = []
-        for line in lines:
-            if len(line) > self._max_msg_length:
-                for word in line.split(' '):
-                    chunk = word
-                    while chunk < self._max_msg_length:
-                        chunk += ' ' + word
-                        line = line[len(word):]
-                    chunks.append(chunk)
-            else:
-                chunks.append(line)
-        return chunks
+        return split_message(msg, self.max_text_bytes(target, command), self._encoding)
 
     @property
     def server(self):
         return self._server
 
+    @property
+    def port(self):
+        return self._port
+
     @property
     def nick(self):
         return self._nick
 
+    @property
+    def registered(self):
+        """Return whether the server has accepted the registration (i.e. sent RPL_WELCOME)"""
+        return self._registered
+
+    def add_line_callback(self, callback):
+        """
+        Add a callback that's called with each received line, parsed (`IRCMessage`).
+        The callbacks are called from the I/O thread, so they should be quick (e.g. push into a buffer).
+        """
+        self._line_callbacks.append(callback)
+
     def connect(self):
-        self._ircsock.connect((self._server, 6667))
+        self._ircsock = socket.create_connection((self._server, self._port), timeout=self.CONNECT_TIMEOUT)
+        self._ircsock.setblocking(False)
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._ircsock, selectors.EVENT_READ)
+        self._selector.register(self._waker_r, selectors.EVENT_READ)
         self._connected = True
+        self._io_thread = IRCioThread(self)
+        self._io_thread.start()
+        if self._password:
+            self.send('PASS', self._password)
         self.send('USER', ' '.join([self._nick, self._nick, self._nick, self._nick]))
         self.send('NICK', self._nick)
-        self._pong_server_timer.start()
-        self.logger.info(f'Connected to IRC: server="{self._server}", nick="{self._nick}"')
+        self.logger.info(f'Connected to IRC: server="{self._server}", port={self._port}, nick="{self._nick}"')
 
     def disconnect(self):
-        self._pong_server_timer.cancel()
-        self._ircsock.close()
         self._connected = False
+        self._wakeup()
+        if self._io_thread and self._io_thread is not current_thread():
+            self._io_thread.join()
 
     def is_connected(self):
         return self._connected
 
+    def wait(self, timeout=None):
+        """Wait until the connection is closed (either by `disconnect` or by the server)"""
+        if self._io_thread:
+            self._io_thread.join(timeout)
+
+    def _wakeup(self):
+        try:
+            self._waker_w.send(b'\0')
+        except (OSError, AttributeError):  # Already woken up, not connected or closed
+            pass
+
+    def _update_interest(self):
+        with self._outbound_lock:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self._outbound else 0)
+        self._selector.modify(self._ircsock, events)
+
+    def _release_outbound(self):
+        """
+        Move the messages that the flood control allows from the outbound queue into the outbound buffer.
+
+        @return: `float` The number of seconds until the next message may be released, None if there are none.
+        """
+        with self._outbound_lock:
+            line, delay = self._outbound_queue.pop()
+            while line:
+                self._outbound += line.encode(self._encoding)
+                line, delay = self._outbound_queue.pop()
+        return delay
+
+    def io_loop(self):
+        """The I/O loop, served by the I/O thread until the connection is closed"""
+        try:
+            while self._connected:
+                timeout = self._release_outbound()
+                self._update_interest()
+                for key, mask in self._selector.select(timeout):
+                    if key.fileobj is self._waker_r:
+                        self._waker_r.recv(self.RECV_SIZE)
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._handle_writable()
+                    if mask & selectors.EVENT_READ:
+                        self._handle_readable()
+        except ConnectionError as error:
+            self.logger.error(f'IRC connection error: {error}')
+        except Exception:
+            if self._connected:
+                self.logger.exception('IRC I/O loop failed')
+        finally:
+            self._connected = False
+            self._registered = False
+            self._selector.close()
+            for sock in (self._ircsock, self._waker_r, self._waker_w):
+                sock.close()
+            self.logger.info(f'Disconnected from IRC: server="{self._server}"')
+
+    def _handle_writable(self):
+        with self._outbound_lock:
+            try:
+                sent = self._ircsock.send(self._outbound)
+            except BlockingIOError:
+                return
+            newline = self._outbound.rfind(b'\n', 0, sent)
+            if newline == -1:
+                self._written_head += self._outbound[:sent]
+            else:
+                self._written_head = self._outbound[newline + 1:sent]
+            del self._outbound[:sent]
+
+    def _handle_readable(self):
+        try:
+            data = self._ircsock.recv(self.RECV_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionError('The connection has been closed by the server')
+        for line in self._line_buffer.feed(data):
+            self._on_line(line)
+
+    def _handle_protocol(self, message):
+        """Handle the messages that the connection itself has to respond to"""
+        if message.command == 'PING':
+            self.raw_send(f'PONG :{message.text or self._server}\r\n')  # Not queued, it's not a flood
+        elif message.command == RPL_WELCOME:
+            with self._state_lock:
+                self._nick = message.target or self._nick
+                self._registered = True
+                channels = list(self._channels)
+            self.logger.info(f'Registered to IRC server "{self._server}" as "{self._nick}"')
+            for channels_batch in self._join_batches(channels):
+                self.send('JOIN', ','.join(channels_batch))
+        elif message.command in NICK_IN_USE_REPLIES and not self._registered:
+            self._nick += '_'
+            self.logger.warning(f'Nick is in use, trying "{self._nick}"')
+            self.send('NICK', self._nick)
+        elif message.command == 'NICK' and message.nick and irc_lower(message.nick) == irc_lower(self._nick):
+            self._nick = message.text
+
+    def _on_line(self, line: str):
+        self.logger.debug(f'Read line: {line}')
+        try:
+            message = parse_line(line)
+        except ValueError as error:
+            self.logger.warning(str(error))
+            return
+        self._handle_protocol(message)
+        if not self._line_callbacks:
+            with self._lines_condition:
+                self._lines.append(line)
+                self._lines_condition.notify_all()
+            return
+        for callback in self._line_callbacks:
+            try:
+                callback(message)
+            except Exception:
+                self.logger.exception(f'IRC line callback {callback} failed on line: {line}')
+
     @required_connection
     def raw_send(self, data: str):
+        """Append the data to the outbound buffer, it's written by the I/O thread once the socket is writable"""
         assert isinstance(data, str)
-        self._io_mutex.acquire()
         self.logger.debug(f'Sending data: {data}')
-        self._ircsock.send(bytes(data.encode()))
-        self._io_mutex.release()
-
-    @required_connection
-    def raw_read(self, buffersize=1024, timeout=None):
-        self._io_mutex.acquire()
-        if timeout:
-            assert isinstance(timeout, (int, float)), f'timeout must be a number, got: {timeout}'
-            self._ircsock.settimeout(timeout)
-        try:
-            data = str(self._ircsock.recv(buffersize))
-        except socket.timeout:
-            data = ''
-        finally:
-            if timeout:
-                self._ircsock.settimeout(self.READ_TIMEOUT)
-        if self.logger.level == logging.DEBUG:
-            for line in data.split(self._line_splitter):
-                self.logger.debug(f'Read data - line: {line}')
-        self._io_mutex.release()
-        return data
+        with self._outbound_lock:
+            self._outbound += data.encode(self._encoding)
+        self._wakeup()
 
     def send(self, command, data):
-        self.logger.debug(f'Sending: {command} {data}')
-        self.raw_send(f'{command} {data}\n')
-
-    def read(self, timeout=None):
-        recv = self.raw_read(timeout=timeout)
-        out = ''
-        while recv:
-            out += recv
-            recv = self.raw_read(timeout=timeout)
-        return out
+        self.raw_send(f'{command} {data}\r\n')
 
     def read_lines(self, timeout=None):
-        return self.read(timeout).split(self._line_splitter)
+        """
+        Return the lines that have been received since the last call, for consumers that poll rather than register
+        a line callback (the lines are kept only as long as there are no line callbacks).
+
+        @keyword timeout: `float` Wait up to that number of seconds for a line in case that there are none.
+        @rtype: `list` of `str`
+        """
+        with self._lines_condition:
+            if not self._lines and timeout:
+                self._lines_condition.wait(timeout)
+            lines = list(self._lines)
+            self._lines.clear()
+        return lines
 
     @property
     def channels(self):
@@ -160,24 +335,96 @@ class IRCclient(Loggable):
     def pong(self, to):
         self.send('PONG', f':{to}')
 
+    @required_connection
+    def queue_message(self, command: str, target: str, msg: str):
+        """Split the message and queue its lines in the outbound queue, as a batch (see `OutboundQueue.put`)"""
+        batch = object()
+        with self._outbound_lock:
+            for line in self._split_data(msg, target, command):
+                self._outbound_queue.put(command, target, line, batch)
+        self._wakeup()
+
+    def _unwritten_messages(self):
+        """
+        Return the messages of the lines in the outbound buffer that haven't been written completely, a line that
+        was partially written is returned whole (the protocol lines are not, they're sent again on reconnect).
+
+        @rtype: `list` of (command, target, text)
+        """
+        messages = []
+        for line in (self._written_head + self._outbound).decode(self._encoding, errors='replace').split('\r\n'):
+            try:
+                message = parse_line(line) if line else None
+            except ValueError:
+                continue
+            if message and message.command in ('PRIVMSG', 'NOTICE') and len(message.params) == 2:
+                messages.append((message.command, message.target, message.text))
+        return messages
+
+    def drain_messages(self):
+        """
+        Remove and return the messages that haven't been sent, the ones in the outbound buffer that haven't been
+        written to the socket and then the ones that are still queued (see `OutboundQueue.drain`).
+
+        @rtype: `list` of (command, target, text)
+        """
+        with self._outbound_lock:
+            messages = self._unwritten_messages()
+            self._outbound.clear()
+            self._written_head.clear()
+            return messages + self._outbound_queue.drain()
+
     def msg(self, channel: str, msg: str):
-        for chunk in self._split_data(msg):
-            for line in chunk.split('\n'):
-                self.send('PRIVMSG', f'{channel} :{line}')
+        self.queue_message('PRIVMSG', channel, msg)
+
+    def notice(self, target: str, msg: str):
+        self.queue_message('NOTICE', target, msg)
 
     def join(self, channel: str):
+        """Join the channel, in case that the client isn't registered yet it joins once it's registered"""
         self.logger.info(f'Joining channel: {channel}')
-        self._channels.append(channel)
-        self.send('JOIN', channel)
-
-    def pong_server(self):
-        self.send('PONG', f':{self._server}')
+        with self._state_lock:
+            self._channels.append(channel)
+            registered = self._registered
+        if registered:
+            self.send('JOIN', channel)
+
+    def _join_batches(self, channels: list):
+        """Split the channels into batches that fit in a single JOIN line"""
+        batch, length = [], 0
+        for channel in channels:
+            if batch and length + len(channel) + 1 > MAX_LINE_BYTES - PREFIX_RESERVE:
+                yield batch
+                batch, length = [], 0
+            batch.append(channel)
+            length += len(channel) + 1
+        if batch:
+            yield batch
+
+    def mentions_me(self, text: str):
+        """Return whether the text mentions the nick of the client (or one of the mention nicks)"""
+        nick, matcher = self._mention_matcher
+        if nick != self._nick:
+            nick = self._nick
+            matcher = MentionMatcher(dict.fromkeys([nick] + self._mention_nicks, True), normalize=irc_lower)
+            self._mention_matcher = (nick, matcher)
+        return matcher.search(text)
 
     def parse_messages(self, line: str, with_me_only=False):
-        records = re.findall(r'([\w\d_\-]+)\!.+ PRIVMSG ([\w\d_\-\#]+) \:(.+)', line)
-        if with_me_only:
-            records = list(filter(lambda r: self._nick in r[-1], records))
-        return records  # [(<sender>, <channel>, <message>), ]
+        """
+        Return the PRIVMSG of the line.
+
+        @rtype: `list` of (<sender>, <channel>, <message>)
+        """
+        try:
+            message = parse_line(line)
+        except ValueError:
+            return []
+        if message.command != 'PRIVMSG' or len(message.params) < 2 or not message.nick:
+            return []
+        if with_me_only and not self.mentions_me(message.text):
+            return []
+        return [(message.nick, message.target, message.text)]
 
 
 class IRCendpoint(Endpoint):
@@ -185,8 +432,12 @@ class IRCendpoint(Endpoint):
 
     @cached_property
     def client(self):
-        client = IRCclient(self.credentials['server'], self.credentials['nick'], port=self.credentials['port'])
-        client.connect()
-        for channel in self.config['channels']:
-            client.join(channel)
-        return client
+        """
+        Return the connection pool of the endpoint, it's started on first access.
+
+        @rtype: `IRCconnectionPool`
+        """
+        from nudgebot.thirdparty.irc.pool import IRCconnectionPool
+        pool = IRCconnectionPool(self.credentials, self.config)
+        pool.start()
+        return pool
@@ -4,6 +4,7 @@ import hashlib
 from nudgebot.thirdparty.base import Event, EventsFactory, BotSlave
 from nudgebot.thirdparty.irc.base import IRCendpoint
 from nudgebot.thirdparty.irc.message import Message
+from nudgebot.thirdparty.mentions import MentionResolver
 
 
 class IRCevent(Event):
@@ -13,12 +14,23 @@ class IRCevent(Event):
 class MessageEvent(IRCevent):
     EndpointScope = Message
 
-    def __init__(self, server, sender, channel, content, datetime_obj):
+    def __init__(self, server, sender, channel, content, datetime_obj, connection=None, mentioned_users=None):
+        """
+        @keyword connection: `str` The key of the connection that the message came from, see `IRCconnectionPool`.
+        @keyword mentioned_users: (`list` of `str`) The keys of the configured users that are mentioned in the
+                                  message, see `MentionResolver`.
+        """
         self._server = server
         self._sender = sender
         self._channel = channel
         self._content = content
         self._datetime = datetime_obj
+        self._connection = connection
+        self._mentioned_users = list(mentioned_users or [])
+
+    @property
+    def connection(self):
+        return self._connection
 
     @property
     def id(self):
@@ -28,7 +40,8 @@ class MessageEvent(IRCevent):
     def data(self) -> dict:
         return {
             'server': self._server, 'sender': self._sender, 'channel': self._channel,
-            'content': self._content, 'datetime': self._datetime
+            'content': self._content, 'datetime': self._datetime, 'connection': self._connection,
+            'mentioned_users': self._mentioned_users
         }
 
 
@@ -37,23 +50,42 @@ class MessageMentionedMeEvent(MessageEvent):
 
 
 class IRCeventsFactory(EventsFactory):
+    """
+    The IRC events factory is fed by the connections pool, each received line is classified in the I/O thread of
+    its connection and the events are pushed into the events buffer as soon as the line arrives
+    (see `IRCconnectionPool.add_line_callback`).
+    """
     Endpoint = IRCendpoint()
-    _check_for_new_events_interval = 1
+
+    def build_events_from_message(self, connection, message) -> list:
+        """
+        Classify the message.
+
+        @param connection: `IRCconnectionSupervisor` The connection that the message came from.
+        @param message: `IRCMessage` The parsed line.
+        @rtype: `list` of `MessageEvent`
+        """
+        if message.command != 'PRIVMSG' or len(message.params) < 2 or not message.nick:
+            return []
+        event_class = MessageMentionedMeEvent if connection.client.mentions_me(message.text) else MessageEvent
+        mentioned_users = [user.key for user in MentionResolver().irc_mentions(message.text)]
+        return [event_class(connection.server, message.nick, message.target, message.text, datetime.now(),
+                            connection=connection.key, mentioned_users=mentioned_users)]
+
+    def on_line(self, connection, message):
+        self.add_events(self.build_events_from_message(connection, message))
 
     def build_events(self) -> list:
-        events = []
-        lines = self.Endpoint.client.read_lines()
-        if lines:
-            now = datetime.now()
-            for line in lines:
-                records = self.Endpoint.client.parse_messages(line)
-                if records:
-                    for sender, channel, content in records:
-                        if self.Endpoint.client.nick in content:
-                            events.append(MessageMentionedMeEvent(self.Endpoint.client.server, sender, channel, content, now))
-                        else:
-                            events.append(MessageEvent(self.Endpoint.client.server, sender, channel, content, now))
-        return events
+        """The events are pushed by `on_line`"""
+        return []
+
+    def run(self):
+        """Register to the lines of the connections and keep alive as long as the connections are kept"""
+        self.logger.info(f'Running {self.__class__.__name__}')
+        pool = self.Endpoint.client
+        pool.add_line_callback(self.on_line)
+        pool.wait()
+        self.logger.error(f'IRC connections have been stopped: {pool}')
 
 
 class IRCbot(BotSlave):
@@ -0,0 +1,217 @@
+"""
+IRC outbound messages.
+
+The messages (PRIVMSG and NOTICE) are not written to the socket directly, they're queued in the `OutboundQueue`
+and released by the client's I/O loop as fast as the flood control allows:
+    * A global token bucket limits the rate of the whole connection (the limit the server kicks for).
+    * A token bucket per target limits the rate of a single channel or user.
+    * The targets are served round robin, so a burst to one channel doesn't delay the others.
+    * A message that's identical to one that's still pending to the same target is coalesced into it, and sent once
+      with the number of repetitions, e.g. 'PR #12 has been merged (x3)'. The lines of the same message (see
+      `split_message`) are never coalesced with each other.
+"""
+import time
+from collections import OrderedDict
+
+
+MAX_LINE_BYTES = 512  # Including the CRLF, see RFC 1459 section 2.3
+PREFIX_RESERVE = 100  # The bytes that the server adds as a prefix when it relays the line (':<nick>!<user>@<host> ')
+
+
+def split_message(text: str, max_bytes: int, encoding='utf-8'):
+    """
+    Split the text into lines that are up to `max_bytes` long once encoded.
+    The text is split on new lines and then on spaces, a word that doesn't fit is split between characters (never
+    inside a multi byte character). The empty lines are skipped, IRC doesn't allow sending an empty text.
+
+    @param text: `str` The text.
+    @param max_bytes: `int` The max length of a line in bytes.
+    @keyword encoding: `str` The encoding of the lines.
+    @rtype: `list` of `str`
+    """
+    assert max_bytes > 0
+    lines = []
+    for paragraph in text.split('\n'):
+        paragraph = paragraph.rstrip('\r')
+        if len(paragraph.encode(encoding)) <= max_bytes:
+            lines.append(paragraph)
+            continue
+        line, line_bytes = '', 0
+        for word in paragraph.split(' '):
+            word_bytes = len(word.encode(encoding))
+            separator = 1 if line else 0
+            if line_bytes + separator + word_bytes <= max_bytes:
+                line, line_bytes = line + ' ' * separator + word, line_bytes + separator + word_bytes
+                continue
+            if line:
+                lines.append(line)
+            line, line_bytes = '', 0
+            for char in word:
+                char_bytes = len(char.encode(encoding))
+                if line_bytes + char_bytes > max_bytes:
+                    lines.append(line)
+                    line, line_bytes = '', 0
+                line, line_bytes = line + char, line_bytes + char_bytes
+        lines.append(line)
+    return [line for line in lines if line]
+
+
+class TokenBucket(object):
+    """
+    A token bucket, allows bursts of `capacity` messages and `rate` messages per second on average.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        @param rate: `float` The number of tokens that are added per second.
+        @param capacity: `float` The max number of tokens, i.e. the max burst.
+        """
+        assert rate > 0 and capacity >= 1
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = None
+
+    def _refill(self, now: float):
+        if self._updated_at is not None:
+            self._tokens = min(self.capacity, self._tokens + max(0, now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def delay(self, now=None):
+        """Return the number of seconds until a token is available (0 if it's available now)"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def consume(self, now=None):
+        """Take a token, return whether there was one available"""
+        if self.delay(now):
+            return False
+        self._tokens -= 1
+        return True
+
+    @property
+    def full(self):
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+
+class PendingMessage(object):
+    """A queued message, `count` is the number of identical messages that have been coalesced into it"""
+
+    def __init__(self, command: str, target: str, text: str, batch):
+        self.command = command
+        self.target = target
+        self.text = text
+        self.count = 1
+        self.batches = {batch}  # The batches of the messages that have been coalesced into it
+
+    @property
+    def line(self):
+        text = self.text if self.count == 1 else f'{self.text} (x{self.count})'
+        return f'{self.command} {self.target} :{text}\r\n'
+
+
+class OutboundQueue(object):
+    """
+    The outbound messages queue of an IRC connection.
+
+    The queue is not thread safe, it's owned by the client which guards it with a lock.
+    Example:
+        queue = OutboundQueue(rate=2, burst=5, target_rate=1, target_burst=3)
+        queue.put('PRIVMSG', '#channel', 'Hello')
+        line, delay = queue.pop()  # line is None until the flood control allows to send, retry after delay
+    """
+
+    def __init__(self, rate=2., burst=5, target_rate=1., target_burst=3, coalesce=True):
+        """
+        @keyword rate: `float` Max number of messages per second of the connection.
+        @keyword burst: `int` Max burst of messages of the connection.
+        @keyword target_rate: `float` Max number of messages per second to a single target.
+        @keyword target_burst: `int` Max burst of messages to a single target.
+        @keyword coalesce: `bool` Whether to coalesce identical pending messages.
+        """
+        self._bucket = TokenBucket(rate, burst)
+        self._target_rate = target_rate
+        self._target_burst = target_burst
+        self._coalesce = coalesce
+        self._queues = OrderedDict()  # target --> `list` of `PendingMessage`, in round robin order
+        self._buckets = {}  # target --> `TokenBucket`
+
+    def __len__(self):
+        return sum(len(messages) for messages in self._queues.values())
+
+    def put(self, command: str, target: str, text: str, batch=None):
+        """
+        Queue a message (a single line, see `split_message`).
+
+        @param command: `str` 'PRIVMSG' or 'NOTICE'.
+        @param target: `str` The channel or the nick.
+        @param text: `str` The text.
+        @keyword batch: A hashable that's shared by the lines of the same message, a line isn't coalesced into a
+                        pending line of the same batch. Default is a batch of its own.
+        @return: `bool` Whether the message has been queued, or False if it has been coalesced into a pending one.
+        """
+        batch = object() if batch is None else batch
+        messages = self._queues.setdefault(target, [])
+        if self._coalesce:
+            for message in messages:
+                if message.command == command and message.text == text and batch not in message.batches:
+                    message.count += 1
+                    message.batches.add(batch)
+                    return False
+        messages.append(PendingMessage(command, target, text, batch))
+        return True
+
+    def drain(self):
+        """
+        Remove and return all the pending messages, in the order they were queued in each target.
+
+        @rtype: `list` of (command, target, text)
+        """
+        messages = [(message.command, message.target, message.text)
+                    for target_messages in self._queues.values() for message in target_messages
+                    for _ in range(message.count)]
+        self._queues.clear()
+        return messages
+
+    def _bucket_of(self, target: str):
+        if target not in self._buckets:
+            self._buckets[target] = TokenBucket(self._target_rate, self._target_burst)
+        return self._buckets[target]
+
+    def pop(self, now=None):
+        """
+        Return the next line to send, according to the flood control and the fairness among the targets.
+
+        @return: (`str`, `float`) The line (or None if nothing may be sent now) and the number of seconds until the
+                 next line may be sent (None if the queue is empty).
+        """
+        now = time.monotonic() if now is None else now
+        if not self._queues:
+            return None, None
+        delay = self._bucket.delay(now)
+        if delay:
+            return None, delay
+        target_delays = []
+        for target in list(self._queues):
+            bucket = self._bucket_of(target)
+            target_delay = bucket.delay(now)
+            if target_delay:
+                target_delays.append(target_delay)
+                continue
+            bucket.consume(now)
+            self._bucket.consume(now)
+            messages = self._queues.pop(target)
+            message = messages.pop(0)
+            if messages:
+                self._queues[target] = messages  # Moved to the end of the round
+            self._drop_idle_buckets()
+            return message.line, (0 if self._queues else None)
+        return None, min(target_delays)
+
+    def _drop_idle_buckets(self):
+        """The buckets of the targets without pending messages are dropped once they're full again"""
+        if len(self._buckets) > 2 * len(self._queues) + 100:
+            for target in [t for t, b in self._buckets.items() if t not in self._queues and b.full]:
+                del self._buckets[target]
@@ -0,0 +1,280 @@
+"""
+IRC connection pool.
+
+The IRC endpoint holds a pool of connections to one or more servers (networks):
+    * Each server has one connection per shard of its channels, a connection joins up to
+      `irc.max_channels_per_connection` channels (servers limit the number of channels per client).
+    * Each connection is kept by a supervisor thread that reconnects with an exponential backoff (with jitter) once
+      the connection drops, the channels are joined again once the new connection is registered. The messages that
+      are sent while the connection is down, and the ones that the dropped connection hasn't written, are kept and
+      sent once it's back, ahead of any message that's sent after it.
+    * The received lines are passed to the pool line callbacks along with the connection they came from.
+
+Credentials (credentials.yaml), either a single server or a list of servers:
+    irc:
+      nick: `str` The nick of the bot.
+      server: `str`
+      port: `int`
+      password: `str` (optional)
+      servers:  # Instead of server/port/password
+        - {server: <server>, port: <port>, password: <password>, nick: <nick, optional>}
+Configuration (config.yaml):
+    irc:
+      channels: Either a `list` of channels (of the first server) or a `dict` of server --> `list` of channels.
+      max_channels_per_connection: `int`
+      reconnect:
+        initial_delay: `float` The delay in seconds before the first reconnect attempt, doubled on each attempt.
+        max_delay: `float` Max delay in seconds between attempts.
+"""
+import random
+import time
+from collections import deque
+from threading import Event, Lock
+
+from nudgebot.base import Thread
+from nudgebot.log import Loggable
+from nudgebot.thirdparty.irc.protocol import RPL_WELCOME, irc_lower
+from nudgebot.thirdparty.mentions import MentionMatcher
+
+
+class IRCconnectionSupervisor(Thread):
+    """Keeps an IRC connection, reconnects with an exponential backoff whenever it drops"""
+    MAX_BACKLOG = 1000  # Max number of messages that are kept while the connection is down
+    STABLE_AFTER = 60  # seconds, a connection that was registered that long resets the backoff
+
+    def __init__(self, pool, key: str, server: str, port: int, nick: str, channels: list, password=None):
+        """
+        @param pool: `IRCconnectionPool` The pool.
+        @param key: `str` The key of the connection, e.g. 'irc.freenode.net/0'.
+        @param server: `str` The server host.
+        @param port: `int` The server port.
+        @param nick: `str` The nick.
+        @param channels: (`list` of `str`) The channels of the connection.
+        @keyword password: `str` The server password.
+        """
+        Thread.__init__(self)
+        self.name = f'{self.__class__.__name__}({key})'
+        self.key = key
+        self.server = server
+        self.port = port
+        self.nick = nick
+        self.channels = list(channels)
+        self._password = password
+        self._pool = pool
+        self._client = None
+        self._backlog = deque(maxlen=self.MAX_BACKLOG)
+        self._ready = False  # Whether the backlog has been flushed into the registered client
+        self._lock = Lock()
+        self._stopped = Event()
+        self.attempts = 0
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.key}>'
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def connected(self):
+        return bool(self._client and self._client.registered and self._ready)
+
+    def backoff(self):
+        """Return the delay before the next reconnect attempt"""
+        delay = min(self._pool.max_delay, self._pool.initial_delay * 2 ** max(0, self.attempts - 1))
+        return delay * random.uniform(0.5, 1)
+
+    def _on_line(self, message):
+        if message.command == RPL_WELCOME:
+            self._flush_backlog()
+        self._pool.on_line(self, message)
+
+    def _flush_backlog(self):
+        """Queue the backlog in the registered client, the messages that are sent meanwhile wait for it"""
+        with self._lock:
+            while self._backlog:  # Removed once queued, so a drop meanwhile neither loses nor repeats messages
+                self._client.queue_message(*self._backlog[0])
+                self._backlog.popleft()
+            self._ready = True
+
+    def _keep_unsent(self, client):
+        """Keep the messages that the dropped client hasn't sent, ahead of the ones that were sent meanwhile"""
+        unsent = client.drain_messages()
+        if unsent:
+            with self._lock:
+                self._backlog = deque(unsent + list(self._backlog), maxlen=self.MAX_BACKLOG)
+
+    def send(self, command: str, target: str, text: str):
+        """Queue the message in the connection, or keep it until the connection is back"""
+        with self._lock:
+            client = self._client if self.connected else None
+            if client is None:
+                self._backlog.append((command, target, text))
+                return
+        try:
+            client.queue_message(command, target, text)
+        except Exception:  # Dropped meanwhile
+            with self._lock:
+                self._backlog.append((command, target, text))
+
+    def _connect(self):
+        from nudgebot.thirdparty.irc.base import IRCclient
+        client = IRCclient(self.server, self.nick, port=self.port, password=self._password,
+                           flood_control=self._pool.flood_control, mention_nicks=[self._pool.nick])
+        client.add_line_callback(self._on_line)
+        for channel in self.channels:
+            client.join(channel)  # Joined once registered
+        with self._lock:
+            self._client = client
+            self._ready = False
+        client.connect()
+        return client
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.attempts += 1
+            try:
+                client = self._connect()
+                connected_at = time.time()
+                client.wait()
+                self._keep_unsent(client)
+                if time.time() - connected_at >= self.STABLE_AFTER:
+                    self.attempts = 0
+            except Exception as error:
+                self._pool.logger.error(f'{self}: failed to connect to {self.server}:{self.port}: {error}')
+            if self._stopped.is_set():
+                break
+            delay = self.backoff()
+            self._pool.logger.warning(f'{self}: disconnected, reconnecting in {delay:.1f}s (attempt {self.attempts})')
+            self._stopped.wait(delay)
+
+    def stop(self):
+        self._stopped.set()
+        if self._client:
+            self._client.disconnect()
+
+
+class IRCconnectionPool(Loggable):
+    """
+    A pool of IRC connections, serves as the client of the IRC endpoint.
+
+    Example:
+        pool = IRCconnectionPool(credentials, config)
+        pool.add_line_callback(lambda connection, message: print(connection.key, message))
+        pool.start()
+        pool.msg('#channel', 'Hello all')  # On the connection that joined the channel
+        pool.msg('#channel', 'Hello all', server='irc.freenode.net')
+    """
+
+    def __init__(self, credentials: dict, config: dict):
+        """
+        @param credentials: `dict` The IRC credentials, see the module doc.
+        @param config: `dict` The IRC config, see the module doc.
+        """
+        Loggable.__init__(self)
+        self.nick = credentials['nick']
+        self._mention_matcher = MentionMatcher({self.nick: True}, normalize=irc_lower)
+        self.flood_control = config.get('flood_control')
+        reconnect = config.get('reconnect') or {}
+        self.initial_delay = reconnect.get('initial_delay', 1)
+        self.max_delay = reconnect.get('max_delay', 300)
+        max_channels = config.get('max_channels_per_connection') or 50
+        servers = credentials.get('servers') or [
+            {'server': credentials['server'], 'port': credentials.get('port', 6667),
+             'password': credentials.get('password')}
+        ]
+        channels = config.get('channels') or []
+        if not isinstance(channels, dict):
+            channels = {servers[0]['server']: channels}
+        self._line_callbacks = []
+        self._connections = []
+        for server in servers:
+            server_channels = list(channels.get(server['server']) or [])
+            shards = [server_channels[i:i + max_channels]
+                      for i in range(0, len(server_channels), max_channels)] or [[]]
+            for i, shard in enumerate(shards):
+                nick = server.get('nick', self.nick)
+                self._connections.append(IRCconnectionSupervisor(
+                    self, f"{server['server']}/{i}", server['server'], server.get('port', 6667),
+                    nick if i == 0 else f'{nick}{i}', shard, server.get('password')))
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, [c.key for c in self._connections])
+
+    @property
+    def connections(self):
+        return self._connections
+
+    @property
+    def server(self):
+        """The first (default) server"""
+        return self._connections[0].server
+
+    @property
+    def servers(self):
+        return list(dict.fromkeys(connection.server for connection in self._connections))
+
+    def add_line_callback(self, callback):
+        """
+        Add a callback that's called with each received line, from the I/O thread of the connection.
+            callback(<`IRCconnectionSupervisor`>, <`IRCMessage`>)
+        """
+        self._line_callbacks.append(callback)
+
+    def on_line(self, connection, message):
+        for callback in self._line_callbacks:
+            try:
+                callback(connection, message)
+            except Exception:
+                self.logger.exception(f'IRC line callback {callback} failed on line: {message.raw}')
+
+    def start(self):
+        for connection in self._connections:
+            if not connection.is_alive():
+                connection.start()
+
+    def stop(self):
+        for connection in self._connections:
+            connection.stop()
+
+    def wait(self, timeout=None):
+        """Wait until all the connections are stopped"""
+        for connection in self._connections:
+            connection.join(timeout)
+
+    def is_connected(self):
+        return any(connection.connected for connection in self._connections)
+
+    def get_connection(self, target: str, server=None):
+        """
+        Return the connection of the target: the connection that joined the channel, or the first connection of
+        the server (e.g. for a nick).
+
+        @param target: `str` A channel or a nick.
+        @keyword server: `str` The server, default is any server that has the channel, or the first server.
+        @rtype: `IRCconnectionSupervisor`
+        """
+        connections = [c for c in self._connections if server is None or c.server == server]
+        assert connections, f'Unknown IRC server "{server}", should be one of {self.servers}'
+        target = irc_lower(target)
+        for connection in connections:
+            if any(irc_lower(channel) == target for channel in connection.channels):
+                return connection
+        return connections[0]
+
+    def msg(self, channel: str, msg: str, server=None):
+        """
+        Send a message to the channel (or nick).
+
+        @param channel: `str` The channel or nick.
+        @param msg: `str` The message.
+        @keyword server: `str` The server, default is the server that has the channel (see `get_connection`).
+        """
+        self.get_connection(channel, server).send('PRIVMSG', channel, msg)
+
+    def notice(self, target: str, msg: str, server=None):
+        self.get_connection(target, server).send('NOTICE', target, msg)
+
+    def mentions_me(self, text: str):
+        """Return whether the text mentions the nick of the bot"""
+        return self._mention_matcher.search(text)
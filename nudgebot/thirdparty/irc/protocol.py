@@ -0,0 +1,153 @@
+"""
+The IRC protocol.
+
+A parser of the IRC lines (RFC 1459 with IRCv3 message tags) and the line buffer that splits the received bytes into
+lines. The parsing is plain string splitting, a line is scanned once:
+    [@<tags> ][:<prefix> ]<command>[ <param>...][ :<trailing>]
+"""
+
+
+RPL_WELCOME = '001'
+ERR_NICKNAMEINUSE = '433'
+ERR_NICKCOLLISION = '436'
+ERR_UNAVAILRESOURCE = '437'
+NICK_IN_USE_REPLIES = (ERR_NICKNAMEINUSE, ERR_NICKCOLLISION, ERR_UNAVAILRESOURCE)
+
+_TAG_VALUE_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+# RFC 1459 case mapping, the nicks '[Bot]' and '{bot}' are the same
+_RFC1459_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~', 'abcdefghijklmnopqrstuvwxyz{}|^')
+_NICK_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-[]\\`^{}|_')
+
+
+def irc_lower(text: str):
+    """Return the text in lower case according to the RFC 1459 case mapping"""
+    return text.translate(_RFC1459_LOWER)
+
+
+def _unescape_tag_value(value: str):
+    if '\\' not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            escaped = next(chars, '')
+            out.append(_TAG_VALUE_ESCAPES.get(escaped, escaped))
+        else:
+            out.append(char)
+    return ''.join(out)
+
+
+class IRCMessage(object):
+    """A parsed IRC line"""
+    __slots__ = ('raw', 'tags', 'prefix', 'command', 'params')
+
+    def __init__(self, raw: str, tags: dict, prefix: str, command: str, params: list):
+        self.raw = raw
+        self.tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+
+    def __repr__(self):
+        return '<{} {} {} {}>'.format(self.__class__.__name__, self.prefix, self.command, self.params)
+
+    @property
+    def nick(self):
+        """Return the nick of the sender (or the server name), None if the line has no prefix"""
+        if self.prefix is None:
+            return None
+        return self.prefix.split('!', 1)[0].split('@', 1)[0]
+
+    @property
+    def target(self):
+        """Return the first param, e.g. the channel (or nick) of a PRIVMSG"""
+        return self.params[0] if self.params else None
+
+    @property
+    def text(self):
+        """Return the last param, e.g. the content of a PRIVMSG"""
+        return self.params[-1] if self.params else None
+
+    @property
+    def is_numeric(self):
+        return len(self.command) == 3 and self.command.isdigit()
+
+
+def parse_line(line: str):
+    """
+    Parse an IRC line.
+
+    @param line: `str` The line, without the line splitter.
+    @rtype: `IRCMessage`
+    @raise ValueError: If the line has no command.
+    """
+    rest = line
+    tags = {}
+    if rest.startswith('@'):
+        raw_tags, _, rest = rest[1:].partition(' ')
+        for tag in raw_tags.split(';'):
+            if tag:
+                key, _, value = tag.partition('=')
+                tags[key] = _unescape_tag_value(value)
+        rest = rest.lstrip(' ')
+    prefix = None
+    if rest.startswith(':'):
+        prefix, _, rest = rest[1:].partition(' ')
+        rest = rest.lstrip(' ')
+    rest, separator, trailing = rest.partition(' :')
+    if not separator and rest.startswith(':'):  # Only a trailing param
+        rest, trailing, separator = '', rest[1:], ':'
+    params = rest.split()
+    if not params:
+        raise ValueError(f'Invalid IRC line, no command: {line!r}')
+    command = params.pop(0).upper()
+    if separator:
+        params.append(trailing)
+    return IRCMessage(line, tags, prefix, command, params)
+
+
+class LineBuffer(object):
+    """
+    Splits a stream of bytes into decoded lines, the bytes buffer is reused and scanned only once.
+
+    Example:
+        buffer = LineBuffer()
+        buffer.feed(b'PING :a\\r\\nPRIVMSG #c')  --> ['PING :a']
+        buffer.feed(b'h :hi\\r\\n')  --> ['PRIVMSG #ch :hi']
+    """
+    SPLITTER = b'\r\n'
+
+    def __init__(self, encoding='utf-8', max_length=64 * 1024):
+        """
+        @keyword encoding: `str` The encoding of the lines, undecodable bytes are replaced.
+        @keyword max_length: `int` Max length of an incomplete line in bytes, a longer line is dropped.
+        """
+        self._buffer = bytearray()
+        self._scanned = 0  # The buffer is known not to contain the splitter before this offset
+        self._encoding = encoding
+        self._max_length = max_length
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data: bytes):
+        """
+        Append the data and return the complete lines.
+
+        @rtype: `list` of `str`
+        """
+        self._buffer += data
+        lines = []
+        start = 0
+        end = self._buffer.find(self.SPLITTER, max(0, self._scanned - 1))
+        while end != -1:
+            if end > start:
+                lines.append(self._buffer[start:end].decode(self._encoding, errors='replace'))
+            start = end + len(self.SPLITTER)
+            end = self._buffer.find(self.SPLITTER, start)
+        del self._buffer[:start]
+        if len(self._buffer) > self._max_length:
+            self._buffer.clear()
+        self._scanned = len(self._buffer)
+        return lines
@@ -0,0 +1,229 @@
+"""
+Mentions detection.
+
+The mentions of the configured users are resolved by a shared service that's built from the users directory
+(see `UserDirectory`) and rebuilt once the configuration is reloaded, instead of scanning the text per user or
+fetching the mentioned users from the API:
+    * IRC: the nicks and the aliases of all the users are compiled into a single Aho-Corasick automaton, a message
+      is scanned once whatever the number of users is.
+    * Github: the logins of the @mentions are resolved into users objects, the configured users are resolved
+      without any API call and any other login is fetched once and cached.
+
+Users configuration (users.yaml):
+    users:
+      -
+        github_login: `str`
+        irc_nick: `str`
+        aliases: `list` of `str` (optional) More names that the user is mentioned by in IRC.
+"""
+import re
+from collections import deque, OrderedDict
+from threading import RLock
+
+from nudgebot.base import Singleton
+from nudgebot.log import Loggable
+from nudgebot.thirdparty.irc.protocol import irc_lower, _NICK_CHARS
+
+
+class MentionMatcher(object):
+    """
+    An Aho-Corasick automaton that finds the names in a text, only as whole words.
+
+    Example:
+        matcher = MentionMatcher({'bob': 'user1', 'bobby': 'user2'})
+        matcher.find('bobby, bob: hi')  --> ['user2', 'user1']
+        matcher.find('bobcat')  --> []
+    """
+
+    def __init__(self, names: dict, normalize=str.lower, word_chars=_NICK_CHARS):
+        """
+        @param names: `dict` name --> value, the value is returned when the name is found.
+        @keyword normalize: `callable` Normalizes the names and the text before matching, it should keep the length
+                            of the text (e.g. `irc_lower`).
+        @keyword word_chars: (`set` of `str`) The characters of a word, a name matches only when the characters
+                             around it are not word characters.
+        """
+        self._normalize = normalize
+        self._word_chars = word_chars
+        self._goto = [{}]  # node --> {char: node}
+        self._fail = [0]
+        self._output = [()]  # node --> ((<name length>, <value>), ...) of the names that end in the node
+        for name, value in names.items():
+            name = normalize(name)
+            if not name:
+                continue
+            node = 0
+            for char in name:
+                if char not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[node][char] = len(self._goto) - 1
+                node = self._goto[node][char]
+            self._output[node] += ((len(name), value), )
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._output[child] += self._output[self._fail[child]]
+
+    def __len__(self):
+        return len(self._goto) - 1
+
+    def finditer(self, text: str):
+        """
+        Yield the names that are found in the text.
+
+        @rtype: generator of (<start>, <end>, <value>)
+        """
+        normalized = self._normalize(text)
+        node = 0
+        for index, char in enumerate(normalized):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, value in self._output[node]:
+                start, end = index + 1 - length, index + 1
+                starts_word = start == 0 or normalized[start - 1] not in self._word_chars
+                ends_word = end == len(normalized) or normalized[end] not in self._word_chars
+                if starts_word and ends_word:
+                    yield start, end, value
+
+    def find(self, text: str):
+        """
+        Return the values of the names that are found in the text, without duplicates, by the order of appearance.
+
+        @rtype: `list`
+        """
+        return list(OrderedDict.fromkeys(value for _, _, value in self.finditer(text)))
+
+    def search(self, text: str):
+        """Return whether any of the names is found in the text"""
+        return next(self.finditer(text), None) is not None
+
+
+class MentionResolver(Loggable, metaclass=Singleton):
+    """
+    Resolves the mentions in IRC messages and Github comments into users.
+
+    Example:
+        MentionResolver().irc_mentions('gshefer, snaim: please review')  --> [<User gshefer>, <User shalomnaim1>]
+        MentionResolver().github_mentions('@gshefer @octocat please review')  --> [NamedUser(login="gshefer"), ...]
+    """
+    GITHUB_MENTION = re.compile(r'(?:^|(?<=\s))@([\-\w]+)')
+    MAX_CACHED_LOGINS = 10000  # Max number of cached logins of users that are not configured
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self._lock = RLock()
+        self._revision = None  # The revision of the `UserDirectory` that the matchers were built from
+        self._users = None  # user key --> `User`
+        self._users_by_login = None  # lower case github login --> `User`
+        self._irc_matcher = None
+        self._github_users = OrderedDict()  # lower case github login --> `NamedUser` (`None` if no such user)
+
+    def reload(self):
+        """Rebuild the users and the matchers from the users configuration"""
+        from nudgebot.config.user import UserDirectory
+        revision = UserDirectory().get_revision()
+        users = OrderedDict((user.key, user) for user in UserDirectory().all())
+        names = {}
+        for user in users.values():
+            for name in [user.irc_nick] + list(user.config_data.get('aliases') or []):
+                if name:
+                    names[name] = user.key
+        with self._lock:
+            self._users = users
+            self._users_by_login = {user.config_data.github_login.lower(): user for user in users.values()
+                                    if user.config_data.get('github_login')}
+            self._irc_matcher = MentionMatcher(names, normalize=irc_lower, word_chars=_NICK_CHARS)
+            self._github_users.clear()
+            self._revision = revision
+        self.logger.debug(f'Mentions of {len(users)} users have been compiled')
+
+    def _ensure_loaded(self):
+        from nudgebot.config.user import UserDirectory
+        if self._revision != UserDirectory().get_revision():
+            self.reload()
+
+    def get_user_by_login(self, login: str):
+        """
+        Return the configured user of the Github login.
+
+        @rtype: `User` or `None`
+        """
+        self._ensure_loaded()
+        return self._users_by_login.get(login.lower())
+
+    def irc_mentions(self, text: str):
+        """
+        Return the configured users that are mentioned in the text by their IRC nick or aliases.
+
+        @rtype: `list` of `User`
+        """
+        self._ensure_loaded()
+        with self._lock:  # The matcher and the users of the same reload
+            matcher, users = self._irc_matcher, self._users
+        return [users[key] for key in matcher.find(text)]
+
+    @classmethod
+    def github_logins(cls, text: str):
+        """
+        Return the @mentioned logins in the text, without duplicates.
+            e.g. '@octocat hello world!' --> ['octocat']
+
+        @rtype: `list` of `str`
+        """
+        return list(OrderedDict.fromkeys(cls.GITHUB_MENTION.findall(text or '')))
+
+    def github_mentions(self, text: str):
+        """
+        Return the users that are @mentioned in the text, the logins that are not users are ignored.
+
+        @rtype: `list` of `NamedUser`
+        """
+        users = []
+        for login in self.github_logins(text):
+            user = self.get_github_user(login)
+            if user is not None:
+                users.append(user)
+        return users
+
+    def get_github_user(self, login: str):
+        """
+        Return the Github user of the login, a configured user is returned as a lazy `NamedUser` that's completed
+        only once any attribute other than the login is accessed, any other login is fetched once.
+
+        @rtype: `NamedUser` or `None` if there is no such user.
+        """
+        from github.GithubException import UnknownObjectException
+        from github.NamedUser import NamedUser
+        from nudgebot.thirdparty.github.base import Github
+        key = login.lower()
+        with self._lock:
+            if key in self._github_users:
+                return self._github_users[key]
+        client = Github().client
+        configured = self.get_user_by_login(login)
+        if configured is not None:
+            login = configured.config_data.github_login
+            user = NamedUser(client._Github__requester, {}, {'login': login, 'url': f'/users/{login}'},
+                             completed=False)
+        else:
+            try:
+                user = client.get_user(login)
+            except UnknownObjectException:
+                user = None
+        with self._lock:
+            self._github_users[key] = user
+            if len(self._github_users) > self.MAX_CACHED_LOGINS + len(self._users_by_login):
+                self._github_users.popitem(last=False)
+        return user
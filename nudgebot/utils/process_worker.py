@@ -0,0 +1,36 @@
+"""
+The functions that run in the worker processes of the statistics process pool (see
+`nudgebot.statistics.process_pool`).
+
+The workers are not forked from the bot process, so the functions are unpickled (i.e. their module is imported) in a
+fresh interpreter before the project is set up, hence this module must not import anything that requires the project.
+"""
+import pickle
+import importlib
+
+
+def initialize_worker(project_package_name: str):
+    """
+    Set up the project in the worker process by importing its package.
+
+    @param project_package_name: `str` The name of the project package.
+    """
+    if project_package_name:
+        importlib.import_module(project_package_name)
+
+
+def compute_statistic(module_name: str, class_qualname: str, statistic_name: str, payload: bytes) -> bytes:
+    """
+    Compute the statistic in the worker process.
+
+    @param module_name: `str` The module of the statistics class.
+    @param class_qualname: `str` The qualified name of the statistics class.
+    @param statistic_name: `str` The name of the statistic in the class.
+    @param payload: `bytes` The pickled inputs.
+    @return: `bytes` The pickled result.
+    """
+    owner = importlib.import_module(module_name)
+    for name in class_qualname.split('.'):
+        owner = getattr(owner, name)
+    compute = vars(owner)[statistic_name].compute_function
+    return pickle.dumps(compute(pickle.loads(payload)), pickle.HIGHEST_PROTOCOL)
@@ -55,6 +55,26 @@ def new_project_via_cmd(workspace):
     shutil.rmtree(PROJECT)
 
 
+@pytest.yield_fixture
+def memory_backend(new_project):
+    """
+    Setup: Switching the project to the in-memory database backend.
+    Teardown: Dropping the in-memory databases and switching back to the previous backend.
+    """
+    from nudgebot.db.backends import MemoryBackend
+    from nudgebot.settings import CurrentProject
+    database_config = CurrentProject().config['config'].setdefault('database', {})
+    previous_backend = database_config.get('backend')
+    database_config['backend'] = 'memory'
+    yield MemoryBackend()
+    for database_name in MemoryBackend().database_names():
+        MemoryBackend().drop_database(database_name)
+    if previous_backend is None:
+        del database_config['backend']
+    else:
+        database_config['backend'] = previous_backend
+
+
 @pytest.fixture(scope='session')
 def statistics_classes():
     """New statistics classes"""
@@ -86,3 +106,44 @@ def statistics_classes():
         MyPrStatistics.COLLECTION_NAME: MyPrStatistics,
         MyRepositoryStatistics.COLLECTION_NAME: MyRepositoryStatistics
     }
+
+
+@pytest.fixture(scope='session')
+def conditional_task_class():
+    """A conditional task of a repository scope, its condition is set by `CONDITION` and its runs are counted in `runs`"""
+    from cached_property import cached_property
+    from nudgebot.tasks import ConditionalTask
+    from nudgebot.thirdparty.base import EndpointScope
+
+    class Repository(EndpointScope):
+        primary_keys = ['organization', 'repository']
+
+        def __init__(self, organization, repository):
+            self.organization = organization
+            self.repository = repository
+
+        @classmethod
+        def init_by_keys(cls, **query):
+            return cls(**query)
+
+        @cached_property
+        def query(self):
+            return {'organization': self.organization, 'repository': self.repository}
+
+    class MyConditionalTask(ConditionalTask):
+        NAME = 'MyConditionalTask'
+        EndpointScope = Repository
+        CONDITION = True
+        runs = []
+
+        @property
+        def condition(self):
+            return self.CONDITION
+
+        def get_artifacts(self):
+            return [self.scope.repository]
+
+        def run(self):
+            self.runs.append(self.scope.query)
+
+    return MyConditionalTask
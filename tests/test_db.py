@@ -20,3 +20,281 @@ def test_cached_stack(new_project):
     assert 15 in stacks[0]  # Testing __contains__
     assert stacks[1].stack == [12, 13, 14, 15, 16]
     assert stacks[2].stack == [9, 10, 11, 12, 13, 14, 15, 16]
+    assert 13 not in stacks[0] and stacks[0].db_collection.count({'name': 'stack1'}) == 3  # Trimmed
+    stacks[0].push(15)  # Already in the stack
+    assert stacks[0].stack == [14, 15, 16]
+    stacks[0].clear()
+    stacks[0].push(17)
+    assert stacks[0].stack == [17]
+    long_stack = CachedStack('long_stack', length=100)
+    long_stack.clear()
+    for i in range(150):
+        long_stack.push(i)
+    assert long_stack.stack == list(range(50, 150)) and len(long_stack) == 100
+    assert long_stack.db_collection.count({'name': 'long_stack'}) == 100  # Trimmed every 10 pushes
+    long_stack.pop()
+    assert long_stack.stack[0] == 51
+
+
+def test_migrate_legacy_cached_stacks(memory_backend):
+    from nudgebot.db.db import CachedStack, get_collection
+    legacy_collection = get_collection(CachedStack.DATABASE_NAME, CachedStack.LEGACY_COLLECTION_NAME)
+    legacy_collection.insert_one({'name': 'legacy_stack', 'stack': ['a', 'b', 'c']})
+    assert CachedStack.migrate_legacy_stacks() == 1
+    assert CachedStack.migrate_legacy_stacks() == 0
+    stack = CachedStack('legacy_stack', length=3)
+    assert stack.stack == ['a', 'b', 'c'] and 'b' in stack
+    stack.push('d')
+    assert stack.stack == ['b', 'c', 'd']
+
+
+def test_bson_encode():
+    from datetime import date, datetime
+    from nudgebot.db.encoding import bson_encode, register_encoder
+
+    class Wrapper(object):
+        def __init__(self, value):
+            self.value = value
+
+    safe = {'a': [1, 2.5, 'x', None, True], 'b': {'c': datetime(2018, 4, 1)}, 'd': (1, 2)}
+    assert bson_encode(safe) is safe  # Nothing to encode, no copy
+    node = {'safe': safe['b'], 'date': date(2018, 4, 1), 'obj': [Wrapper(3)], 'tags': {'x'}}
+    encoded = bson_encode(node)
+    assert encoded['safe'] is node['safe']  # Unchanged subtrees are not copied
+    assert encoded['date'] == datetime(2018, 4, 1)
+    assert encoded['obj'][0].startswith('<') and encoded['tags'] == ['x']
+    assert isinstance(node['date'], date)  # The original node is not modified
+    register_encoder(Wrapper, lambda wrapper: {'value': wrapper.value})
+    assert bson_encode(node)['obj'] == [{'value': 3}]
+
+
+def test_memory_backend():
+    import pytest
+    from datetime import datetime, timedelta
+    from pymongo import ReturnDocument
+    from pymongo.errors import DuplicateKeyError, OperationFailure
+    from nudgebot.db.backends import MemoryBackend
+    collection = MemoryBackend().get_collection('test_db', 'test_memory_backend')
+    collection.create_index([('name', 1)], unique=True)
+    collection.insert_many([{'name': f'n{i}', 'value': i, 'tags': ['even' if i % 2 == 0 else 'odd']}
+                            for i in range(10)])
+    assert collection.count({'value': {'$gte': 5}, 'tags': 'even'}) == 2
+    assert [doc['value'] for doc in collection.find({}, {'_id': False}, skip=1, limit=3).sort('value', -1)] == [8, 7, 6]
+    collection.update_one({'name': 'n1'},
+                          {'$push': {'tags': {'$each': ['a', 'b'], '$slice': -2}}, '$inc': {'value': 10}})
+    assert collection.find_one({'name': 'n1'}, {'_id': False, 'tags': True}) == {'tags': ['a', 'b']}
+    doc = collection.find_one_and_update({'name': 'new'}, {'$setOnInsert': {'value': -1}}, upsert=True,
+                                         return_document=ReturnDocument.AFTER)
+    assert doc['name'] == 'new' and doc['value'] == -1
+    collection.update_one({'name': 'n2'}, {'$pull': {'tags': 'even'}})
+    assert collection.find_one({'name': 'n2'})['tags'] == []
+    assert list(collection.aggregate([{'$match': {'value': {'$gte': 0}}},
+                                      {'$group': {'_id': None, 'n': {'$sum': 1}, 'total': {'$sum': '$value'}}}])) == \
+        [{'_id': None, 'n': 10, 'total': 55}]
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({'name': 'n3'})
+    with pytest.raises(OperationFailure):  # A failed update keeps the document in the unique index
+        collection.update_one({'name': 'n4'}, {'$set': {'name': 'n44'}, '$push': {'value': 1}})
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({'name': 'n4'})
+    collection.create_index([('created', 1)], expireAfterSeconds=60)
+    collection.insert_one({'name': 'expired', 'created': datetime.utcnow() - timedelta(minutes=2)})
+    collection._expired_at = 0
+    assert collection.find_one({'name': 'expired'}) is None
+    MemoryBackend().drop_database('test_db')
+
+
+def test_write_behind(new_project):
+    from nudgebot.db.db import CachedStack, get_collection
+    from nudgebot.db.write_behind import WriteBehindBuffer
+    stack = CachedStack('write_behind_stack', length=3, write_behind=True)
+    stack.clear()
+    for i in range(5):
+        stack.push(i)
+    assert 4 in stack  # The pending items are visible before the flush
+    assert stack.stack == [2, 3, 4]  # Reading the stack flushes its pending pushes
+    collection = get_collection('tasks', 'test_write_behind')
+    collection.delete_many({})
+    WriteBehindBuffer().update_one(collection, {'key': 'a'}, {'$set': {'condition': True}}, upsert=True)
+    WriteBehindBuffer().update_one(collection, {'key': 'a'}, {'$set': {'condition': False}}, upsert=True)
+    WriteBehindBuffer().sync(collection, {'key': 'a'})
+    assert collection.find_one({'key': 'a'})['condition'] is False  # The writes are flushed in order
+    WriteBehindBuffer().update_one(collection, {'key': 'b'}, {'$inc': {'runs': 1}}, upsert=True)
+    WriteBehindBuffer().flush()
+    assert collection.find_one({'key': 'b'})['runs'] == 1
+    collection.create_index([('key', 1)], unique=True)
+    flushed = []
+    WriteBehindBuffer().update_one(collection, {'key': 'a'}, {'$set': {'key': 'b'}}, on_flush=lambda: flushed.append(1))
+    WriteBehindBuffer().update_one(collection, {'key': 'b'}, {'$inc': {'runs': 1}}, on_flush=lambda: flushed.append(2))
+    WriteBehindBuffer().flush()
+    assert flushed == []  # The failed write and the writes after it are put back in the buffer
+    assert collection.find_one({'key': 'b'})['runs'] == 1
+    for _ in range(3):
+        WriteBehindBuffer().flush()
+    assert flushed == [2]  # The failed write is dropped once it failed `max_retries` times
+    assert collection.find_one({'key': 'b'})['runs'] == 2
+
+
+def test_index_manager(memory_backend):
+    from nudgebot.db.db import DataCollection
+    from nudgebot.db.indexes import Index, IndexManager
+
+    class IndexedCollection(DataCollection):
+        DATABASE_NAME = 'test_db'
+        COLLECTION_NAME = 'test_index_manager'
+        indexes = []
+
+        @classmethod
+        def get_indexes(cls):
+            return cls.indexes
+
+    manager = IndexManager([IndexedCollection])
+
+    def missing_indexes():  # The metadata collections are always managed as well
+        return [index for index in manager.missing_indexes() if index.collection_name == 'test_index_manager']
+
+    IndexedCollection.indexes = [Index('test_db', 'test_index_manager', [('key', 1)]),
+                                 Index('test_db', 'test_index_manager', [('created', 1)], expire_after_seconds=60)]
+    assert missing_indexes() == IndexedCollection.indexes
+    manager.ensure_indexes()
+    assert missing_indexes() == []
+    manager.ensure_indexes()  # Idempotent
+    IndexedCollection.indexes = [Index('test_db', 'test_index_manager', [('key', 1)], unique=True),
+                                 Index('test_db', 'test_index_manager', [('created', 1)], expire_after_seconds=120)]
+    assert missing_indexes() == IndexedCollection.indexes  # The options have changed
+    manager.ensure_indexes()
+    assert missing_indexes() == []
+    information = IndexedCollection.get_db_collection().index_information()
+    assert information['key_1']['unique'] and information['created_1']['expireAfterSeconds'] == 120
+    IndexedCollection.get_db_collection().insert_many([{'key': 1, 'name': 'a'}, {'key': 2, 'name': 'a'}])
+    IndexedCollection.indexes = [Index('test_db', 'test_index_manager', [('name', 1)]),
+                                 Index('test_db', 'test_index_manager', [('name', 1)], unique=True)]
+    manager.ensure_indexes()  # The unique index can't be created over duplicates, the old index is kept
+    assert missing_indexes() == IndexedCollection.indexes[1:]
+
+
+def test_database_backup(memory_backend, tmpdir):
+    import os
+    from datetime import datetime, timedelta
+    from nudgebot.db.backup import DatabaseBackup
+    now = datetime.utcnow().replace(microsecond=0)  # The TTL index would remove older documents
+    collection = memory_backend['test_backup']['records']
+    collection.create_index([('key', 1)], unique=True)
+    collection.create_index([('created', 1)], expireAfterSeconds=3600)
+    documents = [{'_id': i, 'key': f'key{i}', 'created': now - timedelta(minutes=i), 'tags': ['a', i]} for i in range(5)]
+    collection.insert_many(documents)
+    backup = DatabaseBackup(memory_backend, batch_size=2)
+    for fmt in DatabaseBackup.FORMATS:
+        path = os.path.join(str(tmpdir), fmt)
+        assert backup.dump(path, databases=['test_backup'], fmt=fmt)['test_backup.records'] == 5
+        memory_backend.drop_database('test_backup')
+        assert backup.restore(path, databases=['test_backup'])['test_backup.records'] == 5
+        restored = memory_backend['test_backup']['records']
+        assert list(restored.find({}).sort('_id', 1)) == documents
+        information = restored.index_information()
+        assert information['key_1']['unique'] and information['created_1']['expireAfterSeconds'] == 3600
+        # Restoring into a collection that isn't empty, the documents that exist are skipped
+        restored.delete_many({'_id': {'$gte': 3}})
+        assert backup.restore(path, databases=['test_backup'])['test_backup.records'] == 2
+        assert backup.restore(path, databases=['test_backup'])['test_backup.records'] == 0
+        assert list(restored.find({}).sort('_id', 1)) == documents
+        assert backup.restore(path, databases=['test_backup'], drop=True)['test_backup.records'] == 5
+
+
+def test_write_behind_outage(memory_backend):
+    import time
+    from threading import Thread
+    from pymongo.errors import AutoReconnect
+    from nudgebot.db.db import get_collection
+    from nudgebot.db.write_behind import WriteBehindBuffer
+    collection = get_collection('tasks', 'test_write_behind_outage')
+
+    class UnavailableCollection(object):
+        """Fails the first `outages` bulk writes as if the database is down"""
+        full_name = collection.full_name
+
+        def __init__(self, outages):
+            self.outages, self.attempts = outages, []
+
+        def bulk_write(self, requests, ordered=True):
+            self.attempts.append(time.time())
+            if len(self.attempts) <= self.outages:
+                raise AutoReconnect('connection refused')
+            return collection.bulk_write(requests, ordered=ordered)
+
+    buffer = WriteBehindBuffer()
+    settings = buffer._max_staleness, buffer._max_retries, buffer._retry_backoff, buffer._max_pending
+    buffer._max_staleness, buffer._max_retries, buffer._retry_backoff, buffer._max_pending = 0.01, 3, 0.02, 3
+    try:
+        unavailable = UnavailableCollection(outages=5)
+        flushed = []
+        for i in range(3):
+            buffer.update_one(unavailable, {'key': i}, {'$inc': {'runs': 1}}, upsert=True,
+                              on_flush=lambda i=i: flushed.append(i))
+        # The buffer is full, the writer waits for it to drain
+        writer = Thread(target=buffer.update_one, args=(unavailable, {'key': 3}, {'$inc': {'runs': 1}}, True),
+                        daemon=True)
+        writer.start()
+        writer.join(0.05)
+        assert writer.is_alive()
+        for _ in range(500):
+            if collection.count({}) == 4:
+                break
+            time.sleep(0.01)
+        assert sorted(doc['key'] for doc in collection.find({})) == [0, 1, 2, 3]  # Nothing is dropped
+        assert flushed == [0, 1, 2] and not writer.is_alive()
+        gaps = [after - before for before, after in zip(unavailable.attempts, unavailable.attempts[1:])]
+        assert gaps[3] > gaps[0] * 2  # Backing off
+    finally:
+        buffer.flush()
+        buffer._max_staleness, buffer._max_retries, buffer._retry_backoff, buffer._max_pending = settings
+
+
+def test_database_health_check(new_project):
+    import pytest
+    from nudgebot.db.db import DatabaseClient
+    from nudgebot.exceptions import DatabaseHealthCheckException
+
+    class Admin(object):
+        def __init__(self, is_master):
+            self.is_master = is_master
+
+        def command(self, name):
+            return {'ok': 1.0} if name == 'ping' else {'ok': 1.0, 'ismaster': self.is_master}
+
+    client = DatabaseClient('localhost', 1, connect=False, serverSelectionTimeoutMS=100)
+    with pytest.raises(DatabaseHealthCheckException) as error:  # Not reachable
+        client.health_check()
+    assert 'localhost' in str(error.value)
+    client.admin = Admin(is_master=True)
+    assert client.health_check()['ismaster'] is True
+    client.admin = Admin(is_master=False)  # e.g. the primary is being elected
+    with pytest.raises(DatabaseHealthCheckException) as error:
+        client.health_check()
+    assert 'there is no primary' in str(error.value)
+
+
+def test_mongo_backend_options(new_project):
+    import pytest
+    from pymongo import ReadPreference
+    from nudgebot.db.backends import MongoBackend, get_read_preference
+    from nudgebot.settings import CurrentProject
+    mongo_client_config = CurrentProject().config['config']['database'].setdefault('mongo_client', {})
+    previous_config = dict(mongo_client_config)
+    mongo_client_config.update({'write_concerns': {'tasks': {'w': 'majority', 'j': True}, 'statistics': {'w': 1}},
+                                'read_preferences': {'dashboard': 'secondaryPreferred'}})
+    try:
+        backend = type('ConfiguredMongoBackend', (MongoBackend, ), {})()  # Reading the config above
+        assert get_read_preference('dashboard') == 'secondaryPreferred' and get_read_preference('reports') is None
+        tasks = backend.get_collection('tasks', 'test_mongo_backend_options')
+        assert tasks.write_concern.document == {'w': 'majority', 'j': True}
+        statistics = backend.get_collection('statistics', 'test_mongo_backend_options', get_read_preference('dashboard'))
+        assert statistics.write_concern.document == {'w': 1}
+        assert statistics.read_preference == ReadPreference.SECONDARY_PREFERRED
+        metadata = backend.get_collection('metadata', 'test_mongo_backend_options')  # The client's defaults
+        assert metadata.write_concern.document == {} and metadata.read_preference == ReadPreference.PRIMARY
+        with pytest.raises(AssertionError):
+            backend.get_collection('statistics', 'test_mongo_backend_options', 'fastest')
+    finally:
+        mongo_client_config.clear()
+        mongo_client_config.update(previous_config)
@@ -21,3 +21,165 @@ def test_pull_request_statistics(new_project, statistics_classes):
     assert db_data == stat_inst.db_data
     assert db_data in new_project.db_client.dump('statistics')['github_pull_request']
     new_project.db_client.clear_db(i_really_want_to_do_this=True)
+
+
+def test_statistics_reload_cache(new_project, statistics_classes):
+    new_project.db_client.clear_db(i_really_want_to_do_this=True)
+    stats_cls = statistics_classes['github_repository']
+    stat_inst = stats_cls(organization='gshefer', repository='TestingRepo')
+    stat_inst.collect()
+    reloaded = stats_cls.reload()
+    assert stats_cls.reload() is reloaded  # Cached
+    assert [s.query for s in stats_cls.find(projection=['number_of_open_pull_requests'], limit=1)] == [stat_inst.query]
+    stat_inst.collect()
+    assert stats_cls.reload() is reloaded  # Nothing has changed
+    stat_inst.db_collection.update_one(stat_inst.query, {'$set': {'number_of_open_pull_requests': -1}})
+    stat_inst.collect()
+    assert stats_cls.reload() is not reloaded  # Invalidated by the changes of the collection
+    new_project.db_client.clear_db(i_really_want_to_do_this=True)
+
+
+def test_statistics_snapshot(new_project, statistics_classes):
+    from nudgebot.statistics.snapshot import StatisticsSnapshotService
+    new_project.db_client.clear_db(i_really_want_to_do_this=True)
+    stats_cls = statistics_classes['github_repository']
+    stat_inst = stats_cls(organization='gshefer', repository='TestingRepo')
+    stat_inst.collect()
+    snapshot = StatisticsSnapshotService().get()
+    assert StatisticsSnapshotService().get() is snapshot  # Shared until the statistics change
+    table = snapshot[stats_cls.COLLECTION_NAME]
+    assert len(table) == len(table.find({'repository': 'TestingRepo'})) == 1
+    assert list(table.column('repository')) == ['TestingRepo']
+    stat_inst.db_collection.update_one(stat_inst.query, {'$set': {'number_of_open_pull_requests': -1}})
+    stat_inst.collect()
+    assert StatisticsSnapshotService().get() is not snapshot
+    new_project.db_client.clear_db(i_really_want_to_do_this=True)
+
+
+def test_statistics_aggregation(new_project, statistics_classes):
+    from nudgebot.statistics.aggregation import aggregate, Count, Sum
+    from nudgebot.statistics.snapshot import StatisticsSnapshotService
+    new_project.db_client.clear_db(i_really_want_to_do_this=True)
+    stats_cls = statistics_classes['github_pull_request']
+    for number in (18, 19):
+        stats_cls(organization='gshefer', repository='TestingRepo', issue_number=number).collect()
+    aggregators = {'prs': Count(), 'commits': Sum('number_of_commits')}
+    in_db = aggregate(stats_cls.COLLECTION_NAME, group_by=['repository'], **aggregators)
+    assert in_db[0]['repository'] == 'TestingRepo' and in_db[0]['prs'] == 2
+    columnar = aggregate(stats_cls.COLLECTION_NAME, group_by=['repository'],
+                         snapshot=StatisticsSnapshotService().get(), **aggregators)
+    assert columnar == in_db
+    new_project.db_client.clear_db(i_really_want_to_do_this=True)
+
+
+def test_statistics_database(memory_backend):
+    from nudgebot.db.db import get_collection
+    from nudgebot.statistics.base import StatisticsCache, StatisticsDatabase
+    get_collection('statistics', 'test_statistics_database').insert_many(
+        [{'repository': f'repo{i}', 'open': i % 2 == 0, 'title': f'title{i}'} for i in range(10)])
+    documents = StatisticsDatabase().test_statistics_database
+    assert 'test_statistics_database' in StatisticsDatabase().keys()
+    open_prs = documents.find({'open': True}, ['repository'])
+    assert len(open_prs) == 5
+    assert [doc.repository for doc in open_prs] == ['repo0', 'repo2', 'repo4', 'repo6', 'repo8']
+    assert 'title' not in open_prs[0]  # Projected
+    first = open_prs[0]
+    assert open_prs[0] is first  # Cached
+    StatisticsCache().invalidate('test_statistics_database')
+    assert open_prs[0] is not first and open_prs[0] == first  # Reloaded once invalidated
+
+
+class _DirtyStatistics(object):
+    """A stub of statistics that counts its collections"""
+
+    def __init__(self, endpoint_key, **query):
+        self.Endpoint = type('Endpoint', (object, ), {'key': endpoint_key})
+        self.query, self.collections = query, 0
+
+    def uncache_all(self):
+        pass
+
+    def collect(self):
+        self.collections += 1
+
+
+def test_statistics_recollection():
+    import time
+    from threading import Event
+    from nudgebot.statistics.recollection import RecollectionScheduler
+    scheduler = RecollectionScheduler()
+    debounce, scheduler._debounce = scheduler._debounce, 0.05
+    try:
+        wakeup = Event()
+        scheduler.register_wakeup('github', wakeup)
+        pr, other_pr = _DirtyStatistics('github', number=1), _DirtyStatistics('github', number=2)
+        duplicate = _DirtyStatistics('github', number=1)
+        scheduler.mark_dirty([pr, duplicate])
+        scheduler.mark_dirty([other_pr])
+        assert wakeup.wait(5)  # The debounce window is over, the slave is woken up to flush
+        assert (pr.collections, other_pr.collections) == (0, 0)
+        scheduler.flush('github')
+        assert (pr.collections, duplicate.collections, other_pr.collections) == (1, 0, 1)
+        scheduler.flush('github')
+        assert pr.collections == 1
+        # Without a registered slave, the statistics are collected once the debounce window is over
+        channel = _DirtyStatistics('irc', channel='#nudgebot')
+        scheduler.mark_dirty([channel])
+        for _ in range(500):
+            if channel.collections:
+                break
+            time.sleep(0.01)
+        assert channel.collections == 1
+    finally:
+        scheduler._debounce = debounce
+        scheduler._wakeups.pop('github', None)
+
+
+def test_statistics_snapshot_page(memory_backend):
+    from nudgebot.db.db import get_collection
+    from nudgebot.statistics.snapshot import StatisticsSnapshot
+    hydrated = []
+
+    class PageStatistics(object):
+        COLLECTION_NAME = 'test_statistics_snapshot_page'
+
+        @classmethod
+        def from_document(cls, data):
+            hydrated.append(data['repository'])
+            return data['repository']
+
+    get_collection('statistics', PageStatistics.COLLECTION_NAME).insert_many(
+        [{'repository': f'repo{i}'} for i in range(10)])
+    snapshot = StatisticsSnapshot({})
+    page = snapshot.statistics_page(PageStatistics, skip=4, limit=3)
+    assert page == ('repo4', 'repo5', 'repo6')
+    assert hydrated == list(page)  # Only the page is loaded
+    assert snapshot.statistics_page(PageStatistics, skip=4, limit=3) is page
+    assert snapshot.statistics_page(PageStatistics, skip=8, limit=3) == ('repo8', 'repo9')
+    del hydrated[:]
+    assert len(snapshot.statistics_page(PageStatistics)) == 10  # The whole collection is loaded
+    assert snapshot.statistics_page(PageStatistics, skip=1, limit=2) == ('repo1', 'repo2')
+    assert len(hydrated) == 10
+
+
+def test_statistics_history(memory_backend):
+    from datetime import datetime, timedelta
+    from nudgebot.statistics.history import StatisticsHistory
+    scope_class = type('PullRequest', (object, ), {'primary_keys': ['repository', 'issue_number']})
+    statistics_class = type('PrStatistics', (object, ), {'COLLECTION_NAME': 'test_statistics_history',
+                                                         'EndpointScope': scope_class, 'HISTORY': ['comments']})
+    history = StatisticsHistory(statistics_class)
+    scope = {'repository': 'TestingRepo', 'issue_number': 1}
+    changes = [(datetime(2018, 4, 1, 10), 1), (datetime(2018, 4, 1, 23), 2), (datetime(2018, 4, 2, 0, 30), 3),
+               (datetime(2018, 4, 4, 12), 4)]
+    for time, comments in changes:
+        history.record(scope, {'comments': comments, 'state': 'open', 'issue_number': 1}, time=time)
+    history.record(dict(scope, issue_number=2), {'comments': 9}, time=datetime(2018, 4, 1, 12))
+    assert history.db_collection.count(scope) == 3  # A bucket per day
+    assert history.db_collection.find_one(dict(scope, day=datetime(2018, 4, 1)))['count'] == 2
+    assert history.query(scope) == {'comments': changes}  # Untracked statistics are ignored
+    daily = history.query(scope, ['comments'], resolution=timedelta(days=1))
+    assert daily == {'comments': [(datetime(2018, 4, 1), 2), (datetime(2018, 4, 2), 3), (datetime(2018, 4, 4), 4)]}
+    in_range = history.query(scope, start=datetime(2018, 4, 1, 12), end=datetime(2018, 4, 4, 12),
+                             resolution=timedelta(days=2))
+    assert in_range == {'comments': [(datetime(2018, 4, 1), 3)]}  # The last value in the interval
@@ -0,0 +1,208 @@
+from tests.fixtures import *  # noqa
+
+
+def _handle(task_cls, scope, condition):
+    """Handle the task of the scope with the condition and wait for the run"""
+    from nudgebot.db.write_behind import WriteBehindBuffer
+    from nudgebot.tasks.executor import TaskExecutor
+    task_cls.CONDITION = condition
+    task_cls(scope, []).handle()
+    TaskExecutor().shutdown()
+    WriteBehindBuffer().flush()
+
+
+def test_conditional_task_key(conditional_task_class):
+    scope = conditional_task_class.EndpointScope.init_by_keys(organization='gshefer', repository='TestingRepo')
+    task = conditional_task_class(scope, [])
+    assert task.query == {'key': task.key}
+    assert task.key == conditional_task_class.get_key({'repository': 'TestingRepo', 'organization': 'gshefer'})
+    assert task.key != conditional_task_class.get_key({'organization': 'gshefer', 'repository': 'OtherRepo'})
+    other_task_class = type('OtherTask', (conditional_task_class, ), {'NAME': 'OtherTask'})
+    assert other_task_class(scope, []).key != task.key
+
+
+def test_conditional_task_records(memory_backend, conditional_task_class):
+    scope = conditional_task_class.EndpointScope.init_by_keys(organization='gshefer', repository='TestingRepo')
+    del conditional_task_class.runs[:]
+    _handle(conditional_task_class, scope, True)
+    assert conditional_task_class.runs == [scope.query]
+    task = conditional_task_class(scope, [])
+    assert task.is_done_in_the_past and task.db_data['condition'] is True
+    [record] = task.records
+    assert (record['hash'], record['artifacts'], record['status'], record['runs']) == (task.hash, ['TestingRepo'], 'done', 1)
+    _handle(conditional_task_class, scope, True)  # The condition hasn't changed
+    _handle(conditional_task_class, scope, False)
+    _handle(conditional_task_class, scope, True)  # Changed, but RUN_ONCE and it's done in the past
+    assert len(conditional_task_class.runs) == 1
+    assert task.get_db_collection().count({}) == task.get_records_collection().count({}) == 1
+
+
+def test_migrate_legacy_task_documents(memory_backend, conditional_task_class):
+    from datetime import datetime
+    scope = conditional_task_class.EndpointScope.init_by_keys(organization='gshefer', repository='LegacyRepo')
+    other_scope = conditional_task_class.EndpointScope.init_by_keys(organization='gshefer', repository='OtherRepo')
+    task, other_task = conditional_task_class(scope, []), conditional_task_class(other_scope, [])
+    record = {'datetime': datetime(2018, 4, 1), 'artifacts': ['LegacyRepo']}
+    conditional_task_class.get_db_collection().insert_many([
+        {'name': conditional_task_class.NAME, 'condition': True, 'records': [dict(record, hash=task.hash)],
+         'statistics_queries': {'github_organization': {'organization': 'gshefer'},
+                                'github_repository': {'organization': 'gshefer', 'repository': 'LegacyRepo'}}},
+        {'key': other_task.key, 'condition': False, 'records': {other_task.hash: record}},
+        {'name': conditional_task_class.NAME, 'condition': False, 'statistics_queries': {}, 'records': []}
+    ])
+    assert conditional_task_class.migrate_legacy_documents() == 2  # The scope of the last one is unknown
+    assert conditional_task_class.migrate_legacy_documents() == 0
+    assert task.is_done_in_the_past and task.db_data['condition'] is True
+    assert other_task.is_done_in_the_past and 'records' not in other_task.db_data
+    del conditional_task_class.runs[:]
+    _handle(conditional_task_class, other_scope, True)
+    assert conditional_task_class.runs == []  # Done before the upgrade
+
+
+def test_conditional_task_state_sync(memory_backend, conditional_task_class):
+    from nudgebot.db.indexes import Index
+    scope = conditional_task_class.EndpointScope.init_by_keys(organization='gshefer', repository='SyncRepo')
+    task_cls = type('RepeatedTask', (conditional_task_class, ), {'NAME': 'RepeatedTask', 'RUN_ONCE': False,
+                                                                 'RECORDS_RETENTION': 3600})
+    task_cls.CONDITION = False
+    task_cls(scope, []).handle()
+    task = task_cls(scope, [])
+    assert task.get_db_collection().find_one(task.query) is None  # The state write is buffered
+    assert task.db_data['condition'] is False  # Reading the state flushes it
+    assert task.get_db_collection().find_one(task.query)['scope'] == scope.query
+    _handle(task_cls, scope, True)
+    _handle(task_cls, scope, True)  # Not RUN_ONCE, it runs whenever the condition is True
+    [record] = task.records
+    assert record['runs'] == 2 and record['status'] == 'done'
+    assert Index(task_cls.DATABASE_NAME, task_cls.records_collection_name(), [('datetime', 1)],
+                 expire_after_seconds=3600) in task_cls.get_indexes()
+
+
+class _ExecutorTask(object):
+    """A stub of a task run that logs its runs and fails the first `failures` attempts"""
+    MAX_RETRIES = 2
+    RETRY_BACKOFF = 0
+
+    def __init__(self, name, scope_key, log, failures=0, gate=None):
+        self.name, self.scope_key, self.log, self.failures, self.gate = name, scope_key, log, failures, gate
+        self.result, self.after_run_called = None, False
+
+    def run(self):
+        if self.gate:
+            assert self.gate.wait(5)
+        self.log.append(self.name)
+        if self.failures:
+            self.failures -= 1
+            raise ValueError(self.name)
+
+    def report_result(self, status, attempts, error=None):
+        self.result = (status, attempts, error)
+
+    def after_run(self):
+        self.after_run_called = True
+
+
+def test_task_executor_lanes():
+    import time
+    from threading import Event
+    from nudgebot.tasks.executor import TaskExecutor
+    log, gate = [], Event()
+    tasks = [_ExecutorTask('a1', 'a', log, gate=gate), _ExecutorTask('a2', 'a', log), _ExecutorTask('b1', 'b', log),
+             _ExecutorTask('a3', 'a', log, failures=1)]
+    for task in tasks:
+        TaskExecutor().submit(task)
+    for _ in range(500):  # The other scope isn't blocked by the busy one
+        if 'b1' in log:
+            break
+        time.sleep(0.01)
+    assert log == ['b1']
+    gate.set()
+    TaskExecutor().shutdown()
+    assert [name for name in log if name != 'b1'] == ['a1', 'a2', 'a3', 'a3']
+    assert [task.result for task in tasks] == [('done', 1, None)] * 3 + [('done', 2, None)]
+
+
+def test_task_executor_retries():
+    from nudgebot.tasks.executor import TaskExecutor
+    log = []
+    flaky, failing = _ExecutorTask('flaky', 'a', log, failures=2), _ExecutorTask('failing', 'b', log, failures=3)
+    assert TaskExecutor().execute(flaky) is True
+    assert flaky.result == ('done', 3, None) and flaky.after_run_called
+    assert TaskExecutor().execute(failing) is False
+    assert failing.result == ('failed', 3, repr(ValueError('failing'))) and not failing.after_run_called
+    assert log == ['flaky'] * 3 + ['failing'] * 3
+
+
+def _periodic_task_class(name, clock, **attributes):
+    """Return a periodic task class that ticks every 5 minutes by the clock and logs its runs"""
+    from celery.schedules import crontab
+    from nudgebot.tasks import PeriodicTask
+    attributes.setdefault('run', lambda self: self.runs.append(clock[0]))
+    schedule = crontab(minute='*/5', nowfun=lambda: clock[0])
+    return type(name, (PeriodicTask, ), dict(NAME=name, CRONTAB=schedule, runs=[], **attributes))
+
+
+def _registered(*task_classes):
+    """Return the registry with the task classes, they should be removed by `_unregistered`"""
+    from nudgebot.tasks.periodic import PeriodicTasksRegistry
+    registry = PeriodicTasksRegistry()
+    registry._tasks.update({task_class.__name__: task_class for task_class in task_classes})
+    return registry
+
+
+def _unregistered(*task_classes):
+    from nudgebot.tasks.periodic import PeriodicTasksRegistry
+    for task_class in task_classes:
+        PeriodicTasksRegistry()._tasks.pop(task_class.__name__, None)
+
+
+def test_periodic_task_leases(memory_backend):
+    from datetime import datetime
+    from nudgebot.tasks.periodic import PeriodicTaskState
+    clock = [datetime(2018, 4, 1, 12, 0)]
+    overlaps = []
+
+    def run(self):
+        self.runs.append(clock[0])
+        if clock[0] == datetime(2018, 4, 1, 12, 5):  # The next ticks arrive while this run is still running
+            clock[0] = datetime(2018, 4, 1, 12, 10)
+            overlaps.append(registry.dispatch('Report'))
+            clock[0] = datetime(2018, 4, 1, 13, 10)  # The lease of this run has expired
+            overlaps.append(registry.dispatch('Report'))
+
+    task_class = _periodic_task_class('Report', clock, run=run)
+    registry = _registered(task_class)
+    try:
+        assert registry.dispatch('Report') is True
+        clock[0] = datetime(2018, 4, 1, 12, 1)
+        assert registry.dispatch('Report') is False  # Already run in this tick
+        clock[0] = datetime(2018, 4, 1, 12, 5)
+        last_run = PeriodicTaskState.get('Report')['last_run']
+        assert registry.dispatch('Report') is True
+        assert overlaps == [False, True]
+        assert task_class.runs == [datetime(2018, 4, 1, 12, 0), datetime(2018, 4, 1, 12, 5), datetime(2018, 4, 1, 13, 10)]
+        # A duplicate message of a tick that has been taken already
+        assert PeriodicTaskState.acquire(task_class, last_run) is None
+        assert PeriodicTaskState.get('Report')['leases'] == []
+    finally:
+        _unregistered(task_class)
+
+
+def test_periodic_task_catch_up(memory_backend):
+    from datetime import datetime
+    clock = [datetime(2018, 4, 1, 12, 0)]
+    catch_up_class = _periodic_task_class('CatchUpReport', clock, CATCH_UP=True)
+    other_class = _periodic_task_class('OtherReport', clock)
+    registry = _registered(catch_up_class, other_class)
+    try:
+        assert registry.missed() == []  # Never run
+        assert registry.dispatch('CatchUpReport') and registry.dispatch('OtherReport')
+        clock[0] = datetime(2018, 4, 1, 12, 3)
+        assert registry.missed() == []
+        clock[0] = datetime(2018, 4, 1, 14, 3)  # The bot was down
+        assert registry.missed() == [catch_up_class]
+        assert registry.dispatch('CatchUpReport') is True
+        assert registry.missed() == []
+        assert catch_up_class.runs == [datetime(2018, 4, 1, 12, 0), datetime(2018, 4, 1, 14, 3)]
+    finally:
+        _unregistered(catch_up_class, other_class)
@@ -79,3 +79,28 @@ def test_toggled_cached_properties_dict():
     assert 'first_call' in T.dict()
     T.uncache_all()
     assert 'first_call' not in T.dict(cached_only=True)
+
+
+def test_toggled_cached_property_bound_per_instance():
+    """The property is bound to the instance it's accessed from, even when accessed concurrently"""
+    from threading import Thread
+
+    class Value(ToggledCachedProperties):
+        def __init__(self, value):
+            self.value = value
+
+        @toggled_cached_property
+        def cached_value(self):
+            time.sleep(0.01)
+            return self.value
+
+    values = [Value(i) for i in range(20)]
+    getter = values[0].cached_value
+    values[1].cached_value  # Binding another instance doesn't rebind the first one
+    assert getter() == 0
+    threads = [Thread(target=value.cached_value) for value in values]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [value.cached_value() for value in values] == list(range(20))
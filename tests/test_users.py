@@ -0,0 +1,17 @@
+from tests.fixtures import *  # noqa
+
+
+def test_user_directory(new_project):
+    from nudgebot.settings import CurrentProject
+    from nudgebot.config.user import User, UserDirectory
+    directory = UserDirectory()
+    assert directory.keys() == ['gshefer', 'jhenner', 'shalomnaim1']
+    user = User.get_user(github_login='shalomnaim1')
+    assert user is User.get_user(irc_nick='snaim') is User.get_user(email='snaim@redhat.com')  # Built once
+    assert User.get_user(irc_nick='snaim', email='gshefer@redhat.com') is None
+    assert User('jhenner').email == 'jhenner@redhat.com'
+    revision = directory.get_revision()
+    assert directory.get_revision() == revision
+    CurrentProject().config.reload()
+    assert directory.get_revision() == revision + 1  # Rebuilt on reload
+    assert User.get_user(github_login='shalomnaim1') is not user
@@ -0,0 +1,56 @@
+import json
+
+from tests.fixtures import *  # noqa
+
+
+def _events():
+    from nudgebot.thirdparty.github.bot import RepositoryEvent, IssueEvent, PullRequestEvent
+    repository_data = {'id': '1001', 'type': 'PushEvent', 'organization': 'gshefer', 'repository': 'TestingRepo'}
+    issue_data = dict(repository_data, id='1002', type='IssueCommentEvent', issue_number=7)
+    pull_request_data = dict(issue_data, id='1003', type='PullRequestEvent', issue_number=8)
+    return [
+        RepositoryEvent(repository_data, None, artifacts_refs={'actor': 'gshefer'}),
+        IssueEvent(issue_data, None, artifacts_refs={'actor': 'gshefer', 'comment': 42,
+                                                     'issue': {'number': 7, 'pull_request': False}}),
+        PullRequestEvent(pull_request_data, None, artifacts_refs={'issue': {'number': 8, 'pull_request': True}})
+    ]
+
+
+def _restore(event):
+    """Return the event as it's restored by the worker, the message is sent as JSON"""
+    from nudgebot.thirdparty.base import Event
+    return Event.from_message(json.loads(json.dumps(event.to_message())))
+
+
+def test_event_message_round_trip(new_project):
+    for event in _events():
+        restored = _restore(event)
+        assert restored.__class__ is event.__class__
+        assert (restored.data, restored.id, restored.hash) == (event.data, event.id, event.hash)
+        assert restored.artifacts_refs == event.artifacts_refs
+        assert restored._artifacts is None  # The artifacts are fetched lazily by the worker
+
+
+def test_event_queue_routing(new_project):
+    from nudgebot.settings import CurrentProject
+    from nudgebot.thirdparty.github.bot import GithubBot, IssueEvent
+    distributed_config = CurrentProject().config['config'].setdefault('distributed', {})
+    previous_queues = distributed_config.get('queues')
+    distributed_config['queues'] = 4
+    try:
+        bot = GithubBot([], [])
+        issue_event = _events()[1]
+        queue = bot.event_queue(issue_event)
+        assert queue in {f'nudgebot.scopes.{i}' for i in range(4)}
+        # The events of the same scope always get into the same queue, whatever the event is
+        same_scope_event = IssueEvent(dict(issue_event.data, id='2002', type='IssuesEvent'), None, artifacts_refs={})
+        assert bot.event_queue(same_scope_event) == queue
+        assert bot.event_queue(_restore(issue_event)) == queue
+        scopes_queues = {bot.event_queue(IssueEvent(dict(issue_event.data, issue_number=number), None, {}))
+                         for number in range(100)}
+        assert len(scopes_queues) == 4
+    finally:
+        if previous_queues is None:
+            del distributed_config['queues']
+        else:
+            distributed_config['queues'] = previous_queues
@@ -0,0 +1,70 @@
+import socket
+import time
+
+from tests.fixtures import *  # noqa
+
+
+class _IRCserver(object):
+    """The server side of a single client connection on the loopback interface"""
+
+    def __init__(self):
+        self._listener = socket.socket()
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(1)
+        self.port = self._listener.getsockname()[1]
+        self._connection = None
+        self._received = b''
+
+    def accept(self):
+        self._connection = self._listener.accept()[0]
+        self._connection.settimeout(5)
+        self._listener.close()
+
+    def send(self, data: bytes):
+        self._connection.sendall(data)
+
+    def read_line(self):
+        """Return the next line that the client has sent"""
+        while b'\r\n' not in self._received:
+            data = self._connection.recv(4096)
+            assert data, 'The client has closed the connection'
+            self._received += data
+        line, self._received = self._received.split(b'\r\n', 1)
+        return line.decode()
+
+    def close(self):
+        self._connection.close()
+
+
+def test_irc_client_io_loop():
+    from nudgebot.thirdparty.irc.base import IRCclient
+    server = _IRCserver()
+    client = IRCclient('127.0.0.1', 'nudgebot', port=server.port, flood_control={'burst': 10, 'target_burst': 10})
+    messages = []
+    client.add_line_callback(messages.append)
+    client.join('#nudgebot')  # Joined once registered
+    client.connect()
+    server.accept()
+    try:
+        assert [server.read_line(), server.read_line()] == ['USER nudgebot nudgebot nudgebot nudgebot', 'NICK nudgebot']
+        server.send(b'PING :irc.te')  # A line that arrives in parts
+        server.send(b'st\r\n:irc.test 433 * nudgebot :Nickname is already in use\r\n')
+        assert [server.read_line(), server.read_line()] == ['PONG :irc.test', 'NICK nudgebot_']
+        server.send(b':irc.test 001 nudgebot_ :Welcome\r\n')
+        assert server.read_line() == 'JOIN #nudgebot'
+        assert client.registered and client.nick == 'nudgebot_'
+        server.send(b':alice!a@host PRIVMSG #nudgebot :hi nudgebot_\r\n')
+        for _ in range(500):
+            if len(messages) == 4:
+                break
+            time.sleep(0.01)
+        message = messages[-1]
+        assert (message.nick, message.target, message.text) == ('alice', '#nudgebot', 'hi nudgebot_')
+        client.msg('#nudgebot', 'hello\nall')
+        assert [server.read_line(), server.read_line()] == ['PRIVMSG #nudgebot :hello', 'PRIVMSG #nudgebot :all']
+        assert client.mentions_me(message.text)
+        assert [m.command for m in messages] == ['PING', '433', '001', 'PRIVMSG']
+    finally:
+        server.close()  # The I/O loop stops once the server closes the connection
+    client.wait(5)
+    assert not client.is_connected() and not client.registered
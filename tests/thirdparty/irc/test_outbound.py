@@ -0,0 +1,50 @@
+from tests.fixtures import *  # noqa
+
+
+def test_split_message():
+    from nudgebot.thirdparty.irc.outbound import split_message
+    assert split_message('short\nlines', 10) == ['short', 'lines']
+    lines = split_message('one two three four', 9)
+    assert lines == ['one two', 'three', 'four']
+    lines = split_message('\xe9' * 7, 4)  # 2 bytes per character, never split inside a character
+    assert lines == ['\xe9\xe9', '\xe9\xe9', '\xe9\xe9', '\xe9']
+    assert all(len(line.encode()) <= 30 for line in split_message('word ' * 50 + 'x' * 100, 30))
+    assert split_message('first\n\nsecond\r\n', 10) == ['first', 'second']  # No empty lines
+    assert split_message('', 10) == []
+
+
+def test_outbound_queue():
+    from nudgebot.thirdparty.irc.outbound import OutboundQueue
+    queue = OutboundQueue(rate=10, burst=4, target_rate=1, target_burst=2)
+    for i in range(3):
+        queue.put('PRIVMSG', '#a', f'a{i}')
+    queue.put('PRIVMSG', '#b', 'b0')
+    assert not queue.put('PRIVMSG', '#b', 'b0')  # Coalesced
+    now = 100.
+    sent = []
+    line, delay = queue.pop(now)
+    while line:
+        sent.append(line)
+        line, delay = queue.pop(now)
+    # Round robin among the targets, up to the burst of each target
+    assert sent == ['PRIVMSG #a :a0\r\n', 'PRIVMSG #b :b0 (x2)\r\n', 'PRIVMSG #a :a1\r\n']
+    assert delay == 1  # #a waits for a token
+    assert queue.pop(now + 1)[0] == 'PRIVMSG #a :a2\r\n'
+    assert queue.pop(now + 1) == (None, None)
+
+
+def test_outbound_queue_coalesce_batches():
+    from nudgebot.thirdparty.irc.outbound import OutboundQueue
+    queue = OutboundQueue(rate=10, burst=10, target_rate=10, target_burst=10)
+    first_message, second_message = object(), object()
+    for line in ('-----', 'merged', '-----'):  # The identical lines of the same message are kept
+        queue.put('PRIVMSG', '#a', line, first_message)
+    for line in ('-----', 'merged', '-----'):
+        queue.put('PRIVMSG', '#a', line, second_message)
+    assert not queue.put('PRIVMSG', '#a', 'merged')
+    sent = []
+    line = queue.pop(100.)[0]
+    while line:
+        sent.append(line)
+        line = queue.pop(100.)[0]
+    assert sent == ['PRIVMSG #a :----- (x2)\r\n', 'PRIVMSG #a :merged (x3)\r\n', 'PRIVMSG #a :----- (x2)\r\n']
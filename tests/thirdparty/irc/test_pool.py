@@ -0,0 +1,107 @@
+import time
+from threading import Event
+
+from tests.fixtures import *  # noqa
+
+
+class _FakeIRCclient(object):
+    """An IRC client that's registered and dropped by the test, instead of by a server"""
+    instances = []
+
+    def __init__(self, server, nick, port=6667, password=None, flood_control=None, mention_nicks=None):
+        self.server, self.nick = server, nick
+        self.channels, self.queued, self.unsent = [], [], []
+        self.registered = False
+        self._callbacks = []
+        self._dropped = Event()
+        self.instances.append(self)
+
+    def add_line_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def join(self, channel):
+        self.channels.append(channel)
+
+    def connect(self):
+        pass
+
+    def register(self):
+        from nudgebot.thirdparty.irc.protocol import parse_line
+        self.registered = True
+        for callback in self._callbacks:
+            callback(parse_line(f':irc.test 001 {self.nick} :Welcome'))
+
+    def queue_message(self, command, target, text):
+        assert self.registered, 'Not connected'
+        self.queued.append((command, target, text))
+
+    def drain_messages(self):
+        unsent, self.unsent = self.unsent, []
+        return unsent
+
+    def drop(self):
+        self.registered = False
+        self._dropped.set()
+
+    disconnect = drop
+
+    def wait(self, timeout=None):
+        self._dropped.wait(timeout)
+
+
+def _wait_for(predicate):
+    for _ in range(500):
+        if predicate():
+            return
+        time.sleep(0.01)
+    assert predicate()
+
+
+def test_irc_connection_pool_shards():
+    from nudgebot.thirdparty.irc.pool import IRCconnectionPool
+    credentials = {'nick': 'nudgebot', 'servers': [{'server': 'irc.a', 'port': 6667}, {'server': 'irc.b', 'nick': 'nb'}]}
+    pool = IRCconnectionPool(credentials, {'channels': {'irc.a': ['#1', '#2', '#3'], 'irc.b': ['#B']},
+                                           'max_channels_per_connection': 2})
+    assert [(c.key, c.nick, c.channels) for c in pool.connections] == [
+        ('irc.a/0', 'nudgebot', ['#1', '#2']), ('irc.a/1', 'nudgebot1', ['#3']), ('irc.b/0', 'nb', ['#B'])]
+    assert pool.get_connection('#3').key == 'irc.a/1' and pool.get_connection('#b').key == 'irc.b/0'
+    assert pool.get_connection('someone').key == 'irc.a/0'
+    assert pool.get_connection('someone', server='irc.b').key == 'irc.b/0'
+
+
+def test_irc_connection_pool_reconnect():
+    from nudgebot.thirdparty.irc import base
+    from nudgebot.thirdparty.irc.pool import IRCconnectionPool
+    irc_client, base.IRCclient = base.IRCclient, _FakeIRCclient
+    del _FakeIRCclient.instances[:]
+    pool = IRCconnectionPool({'nick': 'nudgebot', 'server': 'irc.test'},
+                             {'channels': ['#nudgebot'], 'reconnect': {'initial_delay': 0.01, 'max_delay': 0.02}})
+    [connection] = pool.connections
+    try:
+        pool.msg('#nudgebot', 'm1')  # Kept until the connection is registered
+        pool.start()
+        _wait_for(lambda: _FakeIRCclient.instances)
+        first_client = _FakeIRCclient.instances[0]
+        assert first_client.channels == ['#nudgebot']
+        pool.msg('#nudgebot', 'm2')
+        assert not pool.is_connected() and first_client.queued == []
+        first_client.register()
+        assert pool.is_connected()
+        pool.msg('#nudgebot', 'm3')
+        assert [text for _, _, text in first_client.queued] == ['m1', 'm2', 'm3']
+        first_client.unsent = [('PRIVMSG', '#nudgebot', 'm3')]  # Not written before the connection dropped
+        first_client.drop()
+        pool.msg('#nudgebot', 'm4')
+        _wait_for(lambda: len(_FakeIRCclient.instances) == 2)
+        second_client = _FakeIRCclient.instances[1]
+        assert second_client.channels == ['#nudgebot'] and connection.attempts == 2
+        second_client.register()
+        pool.msg('#nudgebot', 'm5')
+        # The unsent messages go first, then the ones that were sent while the connection was down
+        assert [text for _, _, text in second_client.queued] == ['m3', 'm4', 'm5']
+        assert 0.005 <= connection.backoff() <= 0.02
+    finally:
+        pool.stop()
+        pool.wait(5)
+        base.IRCclient = irc_client
+    assert not connection.is_alive()
@@ -0,0 +1,23 @@
+from tests.fixtures import *  # noqa
+
+
+def test_parse_line():
+    from nudgebot.thirdparty.irc.protocol import parse_line
+    message = parse_line('@time=2018-04-01T12:00:00.000Z;msgid=a\\sb\\:c :nick!user@host PRIVMSG #channel :hi: there')
+    assert message.tags == {'time': '2018-04-01T12:00:00.000Z', 'msgid': 'a b;c'}
+    assert (message.nick, message.command, message.target, message.text) == ('nick', 'PRIVMSG', '#channel', 'hi: there')
+    message = parse_line(':irc.example.net 433 * Nudgebot :Nickname is already in use')
+    assert message.is_numeric and message.nick == 'irc.example.net'
+    assert message.params == ['*', 'Nudgebot', 'Nickname is already in use']
+    message = parse_line('PING :irc.example.net')
+    assert message.prefix is None and message.params == ['irc.example.net']
+    assert parse_line(':a!b@c MODE #channel +o  nick').params == ['#channel', '+o', 'nick']
+
+
+def test_line_buffer():
+    from nudgebot.thirdparty.irc.protocol import LineBuffer
+    buffer = LineBuffer()
+    assert buffer.feed(b'PING :a\r\nPRIVMSG #c :\xc3') == ['PING :a']
+    assert buffer.feed(b'\xa9\r') == []  # The splitter may be split between reads
+    assert buffer.feed(b'\n\r\nNOTICE') == ['PRIVMSG #c :\xe9']
+    assert len(buffer) == len(b'NOTICE')
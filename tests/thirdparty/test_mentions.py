@@ -0,0 +1,23 @@
+from tests.fixtures import *  # noqa
+
+
+def test_mention_matcher():
+    from nudgebot.thirdparty.irc.protocol import irc_lower
+    from nudgebot.thirdparty.mentions import MentionMatcher
+    matcher = MentionMatcher({'bob': 1, 'bobby': 2, 'ob': 3, '[Bot]': 4}, normalize=irc_lower)
+    assert matcher.find('bobby, bob: hi, bob') == [2, 1]
+    assert matcher.find('bobcat, robot, ob!') == [3]
+    assert matcher.find('hey {bot}') == [4]  # RFC 1459 case mapping
+    assert not matcher.search('nobody here')
+
+
+def test_mention_resolver(new_project):
+    from nudgebot.thirdparty.mentions import MentionResolver
+    resolver = MentionResolver()
+    resolver.reload()
+    assert [user.key for user in resolver.irc_mentions('snaim, gshefer: please review, thanks snaim')] == \
+        ['shalomnaim1', 'gshefer']
+    assert resolver.irc_mentions('gshefer_bot is not gshefer2') == []
+    assert resolver.get_user_by_login('GShefer').irc_nick == 'gshefer'
+    assert resolver.github_logins('@gshefer please review\n@jhenner, cc @gshefer (not an@email)') == \
+        ['gshefer', 'jhenner']